@@ -1,78 +1,416 @@
+import hashlib
 import os
+import resource
+import signal
 import subprocess
 import tempfile
+import time
 import shutil
 from django.conf import settings
+from .artifacts import LOG_SUFFIX, SYNCTEX_SUFFIX, write_synctex_archive
+from .bibliography import get_bibliography_cache
+from .builddirs import get_build_dirs, safe_join
+from .deps import scan_dependencies
+from .diagnostics import parse_log, summarize_errors
+from .formats import get_format_cache
+from .profiler import PROFILE_HOOKS, build_report
+from .synctex import SYNCTEX_DATA_SUFFIX, write_synctex_data
+from . import metrics
+
+# Files read back by the next pass; a change in any of them means the
+# document may not have reached a fixed point yet
+RERUN_CHECK_EXTENSIONS = ('.aux', '.toc', '.lof', '.lot', '.out')
+
+# Log messages from LaTeX and common packages asking for another pass
+RERUN_LOG_MARKERS = (
+    'Rerun to get',
+    'Rerun LaTeX',
+    'Please rerun LaTeX',
+    'Label(s) may have changed',
+)
 
 class LatexCompiler:
     def __init__(self):
         # Create a base directory for temporary files if needed
         self.base_dir = getattr(settings, 'LATEX_TEMP_DIR', '/tmp/cotex')
         os.makedirs(self.base_dir, exist_ok=True)
-    
-    def compile_latex(self, main_tex_content, related_files=None):
+        # -file-line-error puts the file and line in error messages (see
+        # diagnostics.py)
+        self.tex_options = ['-interaction=nonstopmode', '-file-line-error']
+        # -synctex=-1 writes uncompressed SyncTeX data, for full compiles only
+        self.synctex_options = ['-synctex=-1'] if getattr(settings, 'LATEX_SYNCTEX', True) else []
+        self.command = ['pdflatex'] + self.tex_options + self.synctex_options + ['main.tex']
+        # Preview compiles skip loading images (and SyncTeX); graphicx draws
+        # placeholder boxes of the same size so the layout matches the full compile
+        self.preview_command = [
+            'pdflatex', *self.tex_options, '-jobname=main',
+            r'\PassOptionsToPackage{draft}{graphicx}\input{main.tex}',
+        ]
+        # Fixed build date so identical inputs always produce identical PDFs
+        self.source_date_epoch = str(getattr(settings, 'LATEX_SOURCE_DATE_EPOCH', 0))
+        # Upper bound on pdflatex passes per compile
+        self.max_passes = max(1, getattr(settings, 'LATEX_MAX_PASSES', 3))
+        # Start from a precompiled format of the preamble when possible
+        self.use_format_cache = getattr(settings, 'LATEX_FORMAT_CACHE', True)
+        # Run bibtex/biber (through the .bbl cache) for documents with a bibliography
+        self.use_bibliography = getattr(settings, 'LATEX_BIBLIOGRAPHY', True)
+        # Leave the log and SyncTeX next to output_path for the artifact store
+        self.keep_artifacts = getattr(settings, 'LATEX_ARTIFACTS', True)
+        # Number of passes the last compile_latex call ran
+        self.passes = 0
+        # Whether the last compile_latex call was restricted with \includeonly
+        self.partial = False
+        # Wall/CPU time of each pass of the last compile, and its profile
+        # report when profiling was requested (see profiler.py)
+        self.pass_stats = []
+        self.profile = None
+        # Errors and warnings parsed from the log of the last compile
+        self.diagnostics = []
+        self.used_format = False
+        # Throwaway compile directories go to a tmpfs scratch area when available
+        default_scratch = '/dev/shm/cotex' if os.path.isdir('/dev/shm') else self.base_dir
+        self.scratch_dir = getattr(settings, 'LATEX_SCRATCH_DIR', default_scratch)
+        os.makedirs(self.scratch_dir, exist_ok=True)
+        # Resource limits for a single compile so a runaway document can't
+        # starve other users. Wall-clock time covers all passes together.
+        self.wall_time_limit = getattr(settings, 'LATEX_WALL_TIME_LIMIT', 120)
+        self.cpu_time_limit = getattr(settings, 'LATEX_CPU_TIME_LIMIT', 60)
+        self.memory_limit = getattr(settings, 'LATEX_MEMORY_LIMIT', 1024 * 1024 * 1024)
+        # rlimits are set in a preexec_fn, which is only safe from a
+        # single-threaded process; compile workers (see workers.py) turn this on
+        self.apply_rlimits = False
+
+    def settings_fingerprint(self):
+        """Settings that change the compiled output, used in compile cache keys"""
+        return {
+            'command': self.command,
+            'source_date_epoch': self.source_date_epoch,
+            'max_passes': self.max_passes,
+            'format_cache': self.use_format_cache,
+            'bibliography': self.use_bibliography,
+        }
+
+    def build_env(self):
+        """Environment for TeX subprocesses with reproducible builds turned on"""
+        env = os.environ.copy()
+        # pdfTeX uses SOURCE_DATE_EPOCH for the creation date and trailer ID,
+        # FORCE_SOURCE_DATE makes \today and friends use it as well
+        env['SOURCE_DATE_EPOCH'] = self.source_date_epoch
+        env['FORCE_SOURCE_DATE'] = '1'
+        # Don't wrap log lines, so file paths and messages can be parsed back
+        env['max_print_line'] = '10000'
+        return env
+
+    def set_rlimits(self):
+        """Runs in the forked pdflatex child before exec"""
+        resource.setrlimit(resource.RLIMIT_CPU, (self.cpu_time_limit, self.cpu_time_limit + 1))
+        resource.setrlimit(resource.RLIMIT_AS, (self.memory_limit, self.memory_limit))
+        # TeX never needs to dump core
+        resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+
+    def aux_checksums(self, work_dir):
+        """Checksums of the main document's auxiliary files ({extension: digest or None})"""
+        checksums = {}
+        for ext in RERUN_CHECK_EXTENSIONS:
+            try:
+                with open(os.path.join(work_dir, 'main' + ext), 'rb') as f:
+                    checksums[ext] = hashlib.sha256(f.read()).hexdigest()
+            except FileNotFoundError:
+                checksums[ext] = None
+        return checksums
+
+    def needs_rerun(self, work_dir, before):
+        """
+        Decide whether another pass is needed after a successful run
+
+        Args:
+            work_dir (str): Directory the pass ran in
+            before (dict): aux_checksums() taken before the pass
+        """
+        try:
+            with open(os.path.join(work_dir, 'main.log'), 'r', errors='replace') as f:
+                log = f.read()
+        except FileNotFoundError:
+            log = ''
+        if any(marker in log for marker in RERUN_LOG_MARKERS):
+            return True
+
+        after = self.aux_checksums(work_dir)
+        for ext in RERUN_CHECK_EXTENSIONS:
+            if after[ext] == before[ext] or after[ext] is None:
+                continue
+            if before[ext] is not None:
+                return True
+            # A freshly created file only matters if the next pass has
+            # something to read from it. A new .aux with labels is already
+            # reported by LaTeX's "Label(s) may have changed" warning.
+            if ext != '.aux' and os.path.getsize(os.path.join(work_dir, 'main' + ext)) > 0:
+                return True
+        return False
+
+    def format_command(self, work_dir, fmt_path, preview=False):
+        """Link a cached preamble format into `work_dir` and return the pdflatex command using it"""
+        link_path = os.path.join(work_dir, 'cotexpreamble.fmt')
+        if os.path.lexists(link_path):
+            os.remove(link_path)
+        try:
+            # A hard link keeps the format readable even if it is evicted mid-compile
+            os.link(fmt_path, link_path)
+        except OSError:
+            shutil.copyfile(fmt_path, link_path)
+        options = self.tex_options if preview else self.tex_options + self.synctex_options
+        return ['pdflatex'] + options + ['-fmt=cotexpreamble', 'main.tex']
+
+    def prefixed_command(self, command, prefix):
+        """Make `command` run the TeX code `prefix` before reading main.tex"""
+        if command[-1] == 'main.tex':
+            return command[:-1] + ['-jobname=main', prefix + r'\input{main.tex}']
+        return command[:-1] + [prefix + command[-1]]
+
+    def partial_command(self, command, include_only):
+        """Restrict `command` to the given \\include'd files with \\includeonly"""
+        return self.prefixed_command(command, r'\includeonly{%s}' % ','.join(include_only))
+
+    def can_compile_partially(self, work_dir, main_tex_content, include_only):
+        """
+        Whether every chapter left out of an \\includeonly compile has an .aux
+        from an earlier full compile, so page numbers and references to it
+        stay correct
+        """
+        for kind, target in scan_dependencies(main_tex_content):
+            if kind == 'include' and target not in include_only:
+                if not os.path.exists(os.path.join(work_dir, target + '.aux')):
+                    return False
+        return True
+
+    def read_log(self, work_dir):
+        try:
+            with open(os.path.join(work_dir, 'main.log'), 'r', errors='replace') as f:
+                return f.read()
+        except FileNotFoundError:
+            return ''
+
+    def run_passes(self, work_dir, command, env, max_passes=None, deadline=None):
+        """
+        Run pdflatex until cross-references converge or max_passes is reached,
+        updating the bibliography after the first pass
+
+        Args:
+            deadline (float): time.monotonic() by which all passes must be
+                done; defaults to wall_time_limit from now
+
+        Returns:
+            CompletedProcess: The last pdflatex run
+        """
+        max_passes = max_passes or self.max_passes
+        self.passes = 0
+        self.pass_stats = []
+        if deadline is None:
+            deadline = time.monotonic() + self.wall_time_limit
+        while True:
+            before = self.aux_checksums(work_dir)
+            started = time.monotonic()
+            usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+            process = subprocess.run(
+                command,
+                cwd=work_dir,
+                capture_output=True,
+                text=True,
+                env=env,
+                timeout=max(deadline - time.monotonic(), 0.1),
+                preexec_fn=self.set_rlimits if self.apply_rlimits else None
+            )
+            self.passes += 1
+            usage_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+            self.pass_stats.append({
+                'pass': self.passes,
+                'wall_seconds': round(time.monotonic() - started, 3),
+                # Children of this process only; exact in the single-threaded compile workers
+                'cpu_seconds': round(
+                    (usage_after.ru_utime - usage_before.ru_utime)
+                    + (usage_after.ru_stime - usage_before.ru_stime), 3
+                ),
+                'returncode': process.returncode,
+            })
+            if process.returncode != 0:
+                return process
+            bbl_changed = False
+            if self.passes == 1 and max_passes > 1 and self.use_bibliography:
+                # The first pass has written the citations; a new .bbl needs another pass
+                bbl_changed = get_bibliography_cache().update_bbl(
+                    work_dir, env, max(deadline - time.monotonic(), 0.1),
+                    preexec_fn=self.set_rlimits if self.apply_rlimits else None
+                )
+            if self.passes >= max_passes:
+                return process
+            if not bbl_changed and not self.needs_rerun(work_dir, before):
+                return process
+
+    def compile_latex(self, main_tex_content, related_files=None, build_key=None, output_path=None,
+                      preview=False, include_only=None, profile=False):
         """
         Compile LaTeX content to PDF
-        
+
         Args:
             main_tex_content (str): Content of the main .tex file
             related_files (dict): Dict of {filename: content} for additional files
-            
+            build_key (str): Optional key (e.g. project id) of a persistent build
+                directory. Auxiliary files from the previous compile with the
+                same key are reused. Without a key a throwaway directory is used.
+            output_path (str): Optional path to move the PDF to. When given,
+                the result is this path instead of the PDF content, so large
+                PDFs are never read into memory.
+            preview (bool): Run a single pass with draft graphics for a fast
+                preview. Cross-references come from the build directory's
+                previous .aux, so pair it with a build_key.
+            include_only (list): Optional \\include targets (e.g. ['ch3']) to
+                typeset; the other chapters keep their page numbers and labels
+                from their .aux files in the persistent build directory. Runs a
+                full compile instead if any of those .aux files is missing.
+            profile (bool): Record per-pass and per-file timings, pages and
+                fonts into `self.profile` (see profiler.build_report)
+
         Returns:
             tuple: (success, result_or_error)
-                - If success is True, result is the PDF file content
+                - If success is True, result is the PDF file content (or output_path)
                 - If success is False, result is the error message
+
+        The number of pdflatex passes that ran is left in `self.passes`, and
+        whether \\includeonly was applied in `self.partial`.
         """
-        # Create temporary directory
-        temp_dir = tempfile.mkdtemp(dir=self.base_dir)
-        
+        sources = dict(related_files or {})
+        sources['main.tex'] = main_tex_content
+
+        if build_key is None:
+            # Create temporary directory
+            temp_dir = tempfile.mkdtemp(dir=self.scratch_dir)
+            try:
+                return self._compile_in(
+                    temp_dir, sources, output_path=output_path, preview=preview, include_only=include_only,
+                    profile=profile
+                )
+            finally:
+                # Clean up
+                shutil.rmtree(temp_dir)
+
+        build_dirs = get_build_dirs()
+        with build_dirs.acquire(build_key) as build_dir:
+            success, result = self._compile_in(
+                build_dir, sources, build_dirs, output_path, preview, include_only, profile
+            )
+            if not success:
+                # Don't let a half-written .aux break the next compile
+                build_dirs.clear_aux_files(build_dir)
+            return success, result
+
+    def _compile_in(self, work_dir, sources, build_dirs=None, output_path=None, preview=False,
+                    include_only=None, profile=False):
+        env = self.build_env()
+        # One wall-clock budget for the format build and every pass,
+        # including a retry without the format
+        deadline = time.monotonic() + self.wall_time_limit
+        self.passes = 0
+        self.partial = False
+        self.pass_stats = []
+        self.profile = None
+        self.diagnostics = []
+
         try:
-            # Write main tex file
-            main_file_path = os.path.join(temp_dir, 'main.tex')
-            with open(main_file_path, 'w') as f:
-                f.write(main_tex_content)
-            
-            # Write related files
-            if related_files:
-                for filename, content in related_files.items():
+            if build_dirs is not None:
+                # Warm directory: only rewrite files that changed
+                build_dirs.sync_sources(work_dir, sources)
+            else:
+                for filename, content in sources.items():
                     # Create subdirectories if needed
-                    file_path = os.path.join(temp_dir, filename)
+                    file_path = safe_join(work_dir, filename)
                     os.makedirs(os.path.dirname(file_path), exist_ok=True)
-                    
+
                     with open(file_path, 'w') as f:
                         f.write(content)
-            
-            # Compile the LaTeX document
-            process = subprocess.run(
-                ['pdflatex', '-interaction=nonstopmode', 'main.tex'],
-                cwd=temp_dir,
-                capture_output=True,
-                text=True
-            )
-            
-            # Run it twice for references and citations
-            if process.returncode == 0:
-                subprocess.run(
-                    ['pdflatex', '-interaction=nonstopmode', 'main.tex'],
-                    cwd=temp_dir,
-                    capture_output=True,
-                    text=True
+
+            # Never return the PDF (or SyncTeX data) of a previous run
+            pdf_path = os.path.join(work_dir, 'main.pdf')
+            for stale_path in (pdf_path, os.path.join(work_dir, 'main.synctex')):
+                if os.path.exists(stale_path):
+                    os.remove(stale_path)
+
+            plain_command = self.preview_command if preview else self.command
+            max_passes = 1 if preview else self.max_passes
+            if include_only:
+                self.partial = self.can_compile_partially(work_dir, sources['main.tex'], include_only)
+                if self.partial:
+                    plain_command = self.partial_command(plain_command, include_only)
+                else:
+                    metrics.incr('compile.partial_fallbacks')
+            if profile:
+                plain_command = self.prefixed_command(plain_command, PROFILE_HOOKS)
+            command = plain_command
+            self.used_format = False
+            # With a format graphicx is already loaded, so previews that use
+            # one keep their images but still save the preamble time
+            if self.use_format_cache:
+                related = {name: content for name, content in sources.items() if name != 'main.tex'}
+                fmt_path = get_format_cache().get_format(
+                    sources['main.tex'], related, env,
+                    timeout=max(deadline - time.monotonic(), 0.1),
+                    preexec_fn=self.set_rlimits if self.apply_rlimits else None
                 )
-            
+                if fmt_path is not None:
+                    command = self.format_command(work_dir, fmt_path, preview)
+                    if self.partial:
+                        command = self.partial_command(command, include_only)
+                    if profile:
+                        command = self.prefixed_command(command, PROFILE_HOOKS)
+                    self.used_format = True
+
+            process = self.run_passes(work_dir, command, env, max_passes, deadline)
+
+            if process.returncode != 0 and self.used_format:
+                # Some preambles dump fine but misbehave when loaded from a
+                # format; fall back to a regular compile
+                metrics.incr('format_cache.fallbacks')
+                get_format_cache().mark_failed(fmt_path)
+                self.used_format = False
+                process = self.run_passes(work_dir, plain_command, env, max_passes, deadline)
+
+            log = self.read_log(work_dir)
+            self.diagnostics = parse_log(log)
+            if output_path is not None and self.keep_artifacts:
+                # Collected into the artifact store by the pipeline
+                with open(output_path + LOG_SUFFIX, 'w') as f:
+                    f.write(log)
+            if profile:
+                self.profile = build_report(log, self.pass_stats, self.used_format)
+
+            if process.returncode in (-signal.SIGXCPU, -signal.SIGKILL):
+                metrics.incr('compile.limit_exceeded')
+                return False, "Compilation was stopped for exceeding its CPU time or memory limit"
+
             # Check if compilation succeeded
             if process.returncode == 0:
-                pdf_path = os.path.join(temp_dir, 'main.pdf')
                 if os.path.exists(pdf_path):
+                    if output_path is not None:
+                        # The pipeline stores the SyncTeX data next to the PDF
+                        write_synctex_data(
+                            os.path.join(work_dir, 'main.synctex'), work_dir, output_path + SYNCTEX_DATA_SUFFIX
+                        )
+                        if self.keep_artifacts:
+                            write_synctex_archive(
+                                os.path.join(work_dir, 'main.synctex'), output_path + SYNCTEX_SUFFIX
+                            )
+                        shutil.move(pdf_path, output_path)
+                        return True, output_path
                     with open(pdf_path, 'rb') as f:
                         pdf_content = f.read()
                     return True, pdf_content
                 else:
                     return False, "PDF file was not created"
             else:
-                return False, process.stderr
-                
+                # pdflatex reports errors on stdout and in the log, rarely on stderr
+                return False, summarize_errors(self.diagnostics) or process.stderr or "LaTeX compilation failed"
+
+        except subprocess.TimeoutExpired:
+            metrics.incr('compile.timeouts')
+            return False, f"Compilation timed out after {self.wall_time_limit}s"
         except Exception as e:
             return False, str(e)
-        finally:
-            # Clean up
-            shutil.rmtree(temp_dir)
\ No newline at end of file
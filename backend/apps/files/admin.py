@@ -1,14 +1,30 @@
 from django.contrib import admin
-from .models import File, Folder
+from .models import File, FileBlob, Folder, CompileJob, CompileArtifact
 
 @admin.register(File)
 class FileAdmin(admin.ModelAdmin):
     list_display = ('name', 'project', 'folder', 'is_main', 'created_at', 'updated_at')
     list_filter = ('is_main', 'created_at', 'updated_at')
-    search_fields = ('name', 'content')
+    search_fields = ('name', 'blob__content')
 
 @admin.register(Folder)
 class FolderAdmin(admin.ModelAdmin):
     list_display = ('name', 'project', 'parent', 'created_at', 'updated_at')
     search_fields = ('name',)
-    list_filter = ('created_at', 'updated_at')
\ No newline at end of file
+    list_filter = ('created_at', 'updated_at')
+
+@admin.register(CompileJob)
+class CompileJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'project', 'requested_by', 'status', 'cache_hit', 'worker_id', 'attempts',
+                    'created_at', 'finished_at')
+    list_filter = ('status', 'created_at')
+
+@admin.register(CompileArtifact)
+class CompileArtifactAdmin(admin.ModelAdmin):
+    list_display = ('id', 'project', 'success', 'passes', 'seconds', 'created_at')
+    list_filter = ('success', 'created_at')
+
+@admin.register(FileBlob)
+class FileBlobAdmin(admin.ModelAdmin):
+    list_display = ('hash', 'size', 'created_at')
+    search_fields = ('hash',)
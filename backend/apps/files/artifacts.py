@@ -0,0 +1,287 @@
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Count
+from django.utils import timezone
+from .models import CompileArtifact
+from . import metrics
+
+# Written by the compiler next to the PDF's output path, then collected
+# into the store by the pipeline
+LOG_SUFFIX = '.log'
+SYNCTEX_SUFFIX = '.synctex.gz'
+
+# kind: (content type, download name)
+ARTIFACT_KINDS = {
+    'pdf': ('application/pdf', 'main.pdf'),
+    'log': ('text/plain; charset=utf-8', 'main.log'),
+    'synctex': ('application/gzip', 'main.synctex.gz'),
+}
+
+
+def write_synctex_archive(synctex_path, archive_path):
+    """Gzip a SyncTeX file (mtime 0, so identical data dedups) as viewers expect it"""
+    if not os.path.exists(synctex_path):
+        return False
+    with open(synctex_path, 'rb') as src, open(archive_path, 'wb') as raw:
+        with gzip.GzipFile(fileobj=raw, mode='wb', mtime=0) as dst:
+            shutil.copyfileobj(src, dst)
+    return True
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ArtifactStore:
+    """
+    Content-addressed store of compile outputs (PDF, log, SyncTeX).
+
+    Files are stored once per distinct content under their sha256, however
+    many compiles produced them. CompileArtifact rows reference them;
+    sweep() applies the retention policy to the rows and then deletes files
+    nothing references any more.
+    """
+
+    def __init__(self, root, keep_per_project, max_age, grace_seconds):
+        self.root = root
+        self.keep_per_project = keep_per_project
+        self.max_age = max_age
+        # Unreferenced files younger than this may belong to a compile
+        # whose row isn't saved yet
+        self.grace_seconds = grace_seconds
+        # Files and bytes stored, as counted by the last sweep plus what
+        # this process stored since; None until the first count
+        self.totals = None
+        self._totals_lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def path_for(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    def put_file(self, path):
+        """
+        Add the file at `path` to the store
+
+        Returns:
+            tuple: (digest, size)
+        """
+        digest = file_digest(path)
+        size = os.path.getsize(path)
+        target = self.path_for(digest)
+        if os.path.exists(target):
+            os.utime(target)
+            metrics.incr('artifacts.dedup')
+            return digest, size
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target), prefix='.tmp-')
+        os.close(fd)
+        try:
+            os.remove(tmp_path)
+            try:
+                # Outputs are never modified in place, so a hard link is a safe copy
+                os.link(path, tmp_path)
+            except OSError:
+                shutil.copyfile(path, tmp_path)
+            os.replace(tmp_path, target)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        metrics.incr('artifacts.stored_bytes', size)
+        with self._totals_lock:
+            if self.totals is not None:
+                self.totals = (self.totals[0] + 1, self.totals[1] + size)
+        return digest, size
+
+    def collect(self, output_path, success):
+        """
+        Store the outputs a compile left at `output_path` (the PDF, when it
+        succeeded) and its LOG_SUFFIX / SYNCTEX_SUFFIX sidecars
+
+        Returns:
+            dict: {kind: (digest, size)} for the files that exist
+        """
+        paths = {'log': output_path + LOG_SUFFIX, 'synctex': output_path + SYNCTEX_SUFFIX}
+        if success:
+            paths['pdf'] = output_path
+        collected = {}
+        for kind, path in paths.items():
+            if os.path.exists(path):
+                collected[kind] = self.put_file(path)
+        return collected
+
+    def prune_project(self, project_id):
+        """Delete a project's artifact rows beyond keep_per_project, newest kept"""
+        stale = list(
+            CompileArtifact.objects.filter(project_id=project_id)
+            .order_by('-created_at')
+            .values_list('id', flat=True)[self.keep_per_project:]
+        )
+        if stale:
+            CompileArtifact.objects.filter(id__in=stale).delete()
+        return len(stale)
+
+    def sweep(self):
+        """
+        Apply the retention policy and delete unreferenced files
+
+        Returns:
+            dict: rows and files removed, and bytes freed
+        """
+        started = time.monotonic()
+        rows, _ = CompileArtifact.objects.filter(
+            created_at__lt=timezone.now() - timedelta(seconds=self.max_age)
+        ).delete()
+        crowded = (
+            CompileArtifact.objects.values('project_id')
+            .annotate(count=Count('id'))
+            .filter(count__gt=self.keep_per_project)
+            .values_list('project_id', flat=True)
+        )
+        for project_id in list(crowded):
+            rows += self.prune_project(project_id)
+
+        referenced = set()
+        for digests in CompileArtifact.objects.values_list('pdf_digest', 'log_digest', 'synctex_digest').iterator():
+            referenced.update(digests)
+        files = freed = kept = kept_bytes = 0
+        cutoff = time.time() - self.grace_seconds
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                    if name in referenced or stat.st_mtime > cutoff:
+                        kept += 1
+                        kept_bytes += stat.st_size
+                        continue
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                files += 1
+                freed += stat.st_size
+        with self._totals_lock:
+            self.totals = (kept, kept_bytes)
+
+        metrics.incr('artifacts.evicted_rows', rows)
+        metrics.incr('artifacts.evicted_files', files)
+        metrics.incr('artifacts.evicted_bytes', freed)
+        metrics.observe('artifacts.sweep', time.monotonic() - started)
+        return {'rows': rows, 'files': files, 'bytes': freed}
+
+    def count(self):
+        """Walk the store and reset the running totals"""
+        files = size = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                try:
+                    size += os.path.getsize(os.path.join(dirpath, name))
+                except FileNotFoundError:
+                    continue
+                files += 1
+        with self._totals_lock:
+            self.totals = (files, size)
+        return files, size
+
+    def stats(self):
+        """Store figures from the running totals; the store is only walked the first time"""
+        with self._totals_lock:
+            totals = self.totals
+        files, size = totals if totals is not None else self.count()
+        counters = metrics.snapshot()['counters']
+        return {
+            'files': files,
+            'bytes': size,
+            'dedup': counters.get('artifacts.dedup', 0),
+            'evicted_rows': counters.get('artifacts.evicted_rows', 0),
+            'evicted_files': counters.get('artifacts.evicted_files', 0),
+        }
+
+
+def record_artifact(project_id, outcome):
+    """
+    Save the artifacts of a compile that ran pdflatex, and trim the
+    project's history to its retention limit
+
+    Nothing is recorded for outcomes served from the cache or joined from
+    another caller's build; that build records its own.
+
+    Returns:
+        CompileArtifact: The new row, or None
+    """
+    if outcome.artifacts is None or outcome.joined:
+        return None
+    store = get_artifact_store()
+    files = outcome.artifacts
+    artifact = CompileArtifact.objects.create(
+        project_id=project_id,
+        cache_key=outcome.cache_key or '',
+        success=outcome.success,
+        passes=outcome.passes,
+        seconds=outcome.seconds or 0,
+        usage=outcome.usage or {},
+        error='' if outcome.success else (outcome.error or ''),
+        pdf_digest=files.get('pdf', ('', 0))[0],
+        log_digest=files.get('log', ('', 0))[0],
+        synctex_digest=files.get('synctex', ('', 0))[0],
+        sizes={kind: size for kind, (_, size) in files.items()},
+    )
+    outcome.artifact_id = artifact.id
+    store.prune_project(project_id)
+    metrics.incr('artifacts.recorded')
+    return artifact
+
+
+class ArtifactSweeper(threading.Thread):
+    """Runs ArtifactStore.sweep() every `interval` seconds in the background"""
+
+    def __init__(self, store, interval):
+        super().__init__(name='cotex-artifact-sweeper', daemon=True)
+        self.store = store
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.store.sweep()
+            except Exception:
+                metrics.incr('artifacts.sweep_errors')
+            finally:
+                close_old_connections()
+
+
+_artifact_store = None
+_artifact_store_lock = threading.Lock()
+
+
+def get_artifact_store():
+    """Return the process-wide artifact store, starting its sweeper on first use"""
+    global _artifact_store
+    if _artifact_store is None:
+        with _artifact_store_lock:
+            if _artifact_store is None:
+                base_dir = getattr(settings, 'LATEX_TEMP_DIR', '/tmp/cotex')
+                store = ArtifactStore(
+                    os.path.join(base_dir, 'artifacts'),
+                    keep_per_project=getattr(settings, 'LATEX_ARTIFACTS_PER_PROJECT', 20),
+                    max_age=getattr(settings, 'LATEX_ARTIFACT_MAX_AGE', 7 * 24 * 3600),
+                    grace_seconds=getattr(settings, 'LATEX_ARTIFACT_GRACE', 3600),
+                )
+                interval = getattr(settings, 'LATEX_ARTIFACT_SWEEP_INTERVAL', 3600)
+                if interval:
+                    ArtifactSweeper(store, interval).start()
+                _artifact_store = store
+    return _artifact_store
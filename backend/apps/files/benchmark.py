@@ -0,0 +1,330 @@
+import math
+import os
+import random
+import resource
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import close_old_connections
+from django.utils import timezone
+from apps.projects.models import Project
+from .deps import scan_dependencies, should_scan
+from .models import File, FileBlob, CompileArtifact
+from .pipeline import load_project_sources
+
+# Synthetic projects for `manage.py compile_benchmark`. Text is generated
+# from a fixed seed, so every run compiles exactly the same documents.
+
+WORDS = (
+    'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore '
+    'et dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip '
+    'ex ea commodo consequat duis aute irure in reprehenderit voluptate velit esse cillum fugiat nulla '
+    'pariatur excepteur sint occaecat cupidatat non proident sunt culpa qui officia deserunt mollit anim'
+).split()
+
+
+def paragraph(rng, sentences=6):
+    text = []
+    for _ in range(sentences):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(8, 18))]
+        text.append(' '.join(words).capitalize() + '.')
+    return ' '.join(text)
+
+
+def small_article(rng):
+    """A few pages: sections, a list, an equation and a table"""
+    body = []
+    for section in range(1, 6):
+        body.append(f'\\section{{Section {section}}}\\label{{sec:{section}}}')
+        body.append(paragraph(rng))
+        body.append(f'\\begin{{equation}}\\label{{eq:{section}}} e^{{i\\pi}} + {section} = {section - 1}\\end{{equation}}')
+        body.append(paragraph(rng) + f' See Section~\\ref{{sec:{max(section - 1, 1)}}}.')
+    body.append('\\begin{itemize}' + ''.join(f'\\item {paragraph(rng, 1)}' for _ in range(5)) + '\\end{itemize}')
+    body.append('\\begin{tabular}{lrr}' + '\\\\'.join(f'row {n} & {n} & {n * n}' for n in range(8)) + '\\end{tabular}')
+    main = (
+        '\\documentclass{article}\n\\usepackage{amsmath}\n\\begin{document}\n'
+        + '\n\n'.join(body) + '\n\\end{document}\n'
+    )
+    return main, {}
+
+
+def book(rng, chapters=30, pages_per_chapter=10):
+    """About 300 pages: \\include'd chapters with sections, cross-references and a table of contents"""
+    related = {}
+    for chapter in range(1, chapters + 1):
+        parts = [f'\\chapter{{Chapter {chapter}}}\\label{{ch:{chapter}}}']
+        for section in range(1, pages_per_chapter + 1):
+            parts.append(f'\\section{{Part {section}}}')
+            # Roughly one page of text per section
+            parts.extend(paragraph(rng, 8) for _ in range(4))
+        parts.append(f'As shown in Chapter~\\ref{{ch:{max(chapter - 1, 1)}}}.')
+        related[f'chapter{chapter}.tex'] = '\n\n'.join(parts) + '\n'
+    main = (
+        '\\documentclass{book}\n\\begin{document}\n\\tableofcontents\n'
+        + ''.join(f'\\include{{chapter{chapter}}}\n' for chapter in range(1, chapters + 1))
+        + '\\end{document}\n'
+    )
+    return main, related
+
+
+def tikz_figures(rng, figures=40):
+    """Pages of TikZ pictures with loops, nodes and plots"""
+    body = []
+    for figure in range(figures):
+        steps = rng.randint(10, 30)
+        body.append(
+            '\\begin{figure}[h]\\centering\\begin{tikzpicture}\n'
+            f'\\foreach \\i in {{1,...,{steps}}} {{\\draw[rotate=\\i*{360 // steps}] (0,0) -- (2,0) circle (0.1);}}\n'
+            f'\\draw[domain=0:6.28,samples=100,smooth] plot (\\x,{{sin(\\x r)*{rng.randint(1, 3)}}});\n'
+            '\\node[draw,rounded corners] at (3,1) {node};\n'
+            f'\\end{{tikzpicture}}\\caption{{Figure {figure}}}\\end{{figure}}'
+        )
+        body.append(paragraph(rng, 3))
+    main = (
+        '\\documentclass{article}\n\\usepackage{tikz}\n\\begin{document}\n'
+        + '\n\n'.join(body) + '\n\\end{document}\n'
+    )
+    return main, {}
+
+
+def bibliography_heavy(rng, entries=300, cited=200):
+    """An article citing a few hundred BibTeX entries"""
+    bib = []
+    for n in range(entries):
+        bib.append(
+            f'@article{{ref{n},\n  author = {{{rng.choice(WORDS).capitalize()}, {rng.choice(WORDS).capitalize()}}},\n'
+            f'  title = {{{paragraph(rng, 1)[:80]}}},\n  journal = {{Journal of {rng.choice(WORDS).capitalize()}}},\n'
+            f'  year = {{{1950 + n % 70}}},\n  volume = {{{n % 40 + 1}}},\n  pages = {{{n}--{n + 10}}}\n}}'
+        )
+    body = []
+    for n in range(0, cited, 5):
+        keys = ','.join(f'ref{key}' for key in range(n, min(n + 5, cited)))
+        body.append(paragraph(rng, 3) + f' \\cite{{{keys}}}')
+    main = (
+        '\\documentclass{article}\n\\begin{document}\n' + '\n\n'.join(body)
+        + '\n\\bibliographystyle{plain}\n\\bibliography{refs}\n\\end{document}\n'
+    )
+    return main, {'refs.bib': '\n\n'.join(bib) + '\n'}
+
+
+GENERATORS = {
+    'article': small_article,
+    'book': book,
+    'tikz': tikz_figures,
+    'bibliography': bibliography_heavy,
+}
+
+
+def generate_sources(kind, seed=0):
+    """
+    Build the sources of a synthetic project
+
+    Returns:
+        tuple: (main_tex_content, {filename: content})
+    """
+    return GENERATORS[kind](random.Random(f'{kind}:{seed}'))
+
+
+def create_project(owner, kind, name=None):
+    """Save a synthetic project as Project and File rows"""
+    main_content, related = generate_sources(kind)
+    project = Project.objects.create(
+        name=name or f'benchmark-{kind}', description='Synthetic compile benchmark project', owner=owner
+    )
+    File.objects.create(project=project, name='main.tex', content=main_content, is_main=True)
+    # bulk_create skips File.save, so fill in what it would have: the blob
+    # and the dependencies, or the first timed compile would scan every file
+    File.objects.bulk_create([
+        File(
+            project=project, name=filename, path=filename, blob=FileBlob.objects.for_content(content),
+            dependencies=scan_dependencies(content) if should_scan(filename) else [],
+        )
+        for filename, content in related.items()
+    ])
+    return project
+
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(p / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def summarize(latencies, errors, wall_seconds):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies) + errors,
+        'errors': errors,
+        'wall_seconds': round(wall_seconds, 3),
+        # Successful compiles per second across all threads
+        'throughput': round(len(latencies) / wall_seconds, 3) if wall_seconds else None,
+        'latency': {
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'mean': round(sum(latencies) / len(latencies), 3) if latencies else None,
+            'max': latencies[-1] if latencies else None,
+        },
+    }
+
+
+class CompileBenchmark:
+    """
+    Runs synthetic projects through the compile endpoint or LatexCompiler
+    at several concurrency levels.
+
+    Every thread has its own project and user, so per-project and per-user
+    scheduler limits behave as they would for that many users. Unless
+    `warm`, each request edits a comment in main.tex first, so it misses
+    the compile cache and measures a real pdflatex run.
+    """
+
+    def __init__(self, kinds, levels, requests, modes, warm=False, keep=False):
+        self.kinds = kinds
+        self.levels = levels
+        self.requests = requests
+        self.modes = modes
+        self.warm = warm
+        self.keep = keep
+        self.run_id = uuid.uuid4().hex[:8]
+        self.users = []
+        self.projects = []
+
+    def run(self):
+        started_at = timezone.now()
+        results = []
+        try:
+            for kind in self.kinds:
+                for mode in self.modes:
+                    for level in self.levels:
+                        results.append(self.run_level(kind, mode, level))
+        finally:
+            if not self.keep:
+                self.cleanup()
+        return {
+            'run_id': self.run_id,
+            'started_at': started_at.isoformat(),
+            'config': {
+                'projects': self.kinds,
+                'concurrency': self.levels,
+                'requests': self.requests,
+                'modes': self.modes,
+                'warm': self.warm,
+                'worker_pool': getattr(settings, 'LATEX_WORKER_POOL', True),
+                'worker_processes': getattr(settings, 'LATEX_WORKER_PROCESSES', 2),
+                'format_cache': getattr(settings, 'LATEX_FORMAT_CACHE', True),
+                'max_passes': getattr(settings, 'LATEX_MAX_PASSES', 3),
+            },
+            'results': results,
+        }
+
+    def slot_projects(self, kind, count):
+        """One user and project per concurrent thread"""
+        slots = []
+        for n in range(count):
+            user = User.objects.create_user(f'cotex-benchmark-{self.run_id}-{kind}-{len(self.users)}')
+            self.users.append(user)
+            project = create_project(user, kind, name=f'benchmark-{kind}-{n}')
+            self.projects.append(project)
+            slots.append((user, project))
+        return slots
+
+    def cleanup(self):
+        for project in self.projects:
+            project.delete()
+        for user in self.users:
+            user.delete()
+
+    def run_level(self, kind, mode, level):
+        slots = self.slot_projects(kind, level)
+        latencies = []
+        errors = [0]
+        compile_rss = [0]
+        lock = threading.Lock()
+
+        def worker(index):
+            user, project = slots[index]
+            main_file = File.objects.get(project=project, is_main=True)
+            base_content = main_file.content
+            compiler = scratch = None
+            if mode == 'compiler':
+                from .LaTeX import LatexCompiler
+                compiler = LatexCompiler()
+                scratch = tempfile.mkdtemp(prefix='cotex-benchmark-')
+            try:
+                for n in range(index, self.requests, level):
+                    if not self.warm:
+                        # Unique across levels and modes too, since the cache is shared
+                        main_file.content = f'{base_content}% benchmark {self.run_id} {mode} {level} {n}\n'
+                        main_file.save(update_fields=['content'])
+                    if mode == 'view':
+                        seconds, ok, rss = self.compile_view(user, project)
+                    else:
+                        seconds, ok, rss = self.compile_direct(compiler, project, scratch, n)
+                    with lock:
+                        if ok:
+                            latencies.append(round(seconds, 3))
+                        else:
+                            errors[0] += 1
+                        compile_rss[0] = max(compile_rss[0], rss or 0)
+            finally:
+                if scratch:
+                    shutil.rmtree(scratch, ignore_errors=True)
+                close_old_connections()
+
+        threads = [threading.Thread(target=worker, args=(index,)) for index in range(level)]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall_seconds = time.monotonic() - started
+
+        result = {'project': kind, 'mode': mode, 'concurrency': level}
+        result.update(summarize(latencies, errors[0], wall_seconds))
+        result['peak_rss_kb'] = {
+            # High-water marks since the command started: this process (the
+            # web worker stand-in) and the largest pdflatex run seen
+            'process': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'compile': max(compile_rss[0], resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss),
+        }
+        return result
+
+    def compile_view(self, user, project):
+        """One POST through ProjectViewSet.compile, as the API would serve it"""
+        from rest_framework.test import APIRequestFactory, force_authenticate
+        from apps.projects.views import ProjectViewSet
+        request = APIRequestFactory().post(f'/api/projects/{project.id}/compile/', {}, format='json')
+        force_authenticate(request, user=user)
+        started = time.monotonic()
+        response = ProjectViewSet.as_view({'post': 'compile'})(request, pk=project.id)
+        if response.streaming:
+            for _ in response.streaming_content:
+                pass
+        seconds = time.monotonic() - started
+        response.close()
+        rss = None
+        if response.has_header('X-Compile-Id'):
+            artifact = CompileArtifact.objects.filter(id=response['X-Compile-Id']).first()
+            if artifact is not None:
+                rss = artifact.usage.get('worker_max_rss_kb')
+        return seconds, response.status_code == 200, rss
+
+    def compile_direct(self, compiler, project, scratch, n):
+        """One LatexCompiler.compile_latex call, without cache, pool or scheduler"""
+        main_file, related_files = load_project_sources(project)
+        output_path = os.path.join(scratch, f'{n}.pdf')
+        started = time.monotonic()
+        success, _ = compiler.compile_latex(
+            main_file.content, related_files, build_key=f'benchmark-{project.id}', output_path=output_path
+        )
+        seconds = time.monotonic() - started
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        return seconds, success, None
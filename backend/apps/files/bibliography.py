@@ -0,0 +1,173 @@
+import filecmp
+import os
+import re
+import shutil
+import subprocess
+import threading
+import time
+from django.conf import settings
+from .builddirs import UnsafePathError, safe_join
+from .cache import DiskLRUCache, hash_inputs
+from . import metrics
+
+CITATION_RE = re.compile(r'\\citation\{([^}]*)\}')
+BIBDATA_RE = re.compile(r'\\bibdata\{([^}]*)\}')
+BIBSTYLE_RE = re.compile(r'\\bibstyle\{([^}]*)\}')
+AUX_INPUT_RE = re.compile(r'\\@input\{([^}]*)\}')
+BCF_DATASOURCE_RE = re.compile(r'<bcf:datasource[^>]*>([^<]+)</bcf:datasource>')
+
+
+def _read(work_dir, filename):
+    try:
+        with open(safe_join(work_dir, filename), 'r', errors='replace') as f:
+            return f.read()
+    except (OSError, UnsafePathError):
+        return None
+
+
+def read_aux(work_dir, filename='main.aux', seen=None):
+    """Text of an .aux file followed by the .aux files it \\@input's (one per \\include'd chapter)"""
+    seen = seen if seen is not None else set()
+    if filename in seen:
+        return ''
+    seen.add(filename)
+    content = _read(work_dir, filename) or ''
+    parts = [content]
+    for child in AUX_INPUT_RE.findall(content):
+        parts.append(read_aux(work_dir, child, seen))
+    return '\n'.join(parts)
+
+
+def bibliography_inputs(work_dir):
+    """
+    Everything the bibliography tool will read for this document
+
+    Returns:
+        tuple: (tool, parts) where tool is 'bibtex' or 'biber' and parts
+        are the inputs to hash, or (None, None) if the document has no
+        bibliography
+    """
+    aux = read_aux(work_dir)
+    bibdata = BIBDATA_RE.findall(aux)
+    if bibdata:
+        # Citation order matters for styles such as unsrt, so keep it
+        citations = []
+        for group in CITATION_RE.findall(aux):
+            for key in group.split(','):
+                key = key.strip()
+                if key and key not in citations:
+                    citations.append(key)
+        styles = BIBSTYLE_RE.findall(aux)
+        style = styles[0].strip() if styles else ''
+        parts = ['bibtex', style, _read(work_dir, style + '.bst') or '', '\n'.join(citations)]
+        for name in ','.join(bibdata).split(','):
+            name = name.strip()
+            parts.append(name)
+            parts.append(_read(work_dir, name if name.endswith('.bib') else name + '.bib') or '')
+        return 'bibtex', parts
+
+    # biblatex with the biber backend lists cited keys and data sources in the .bcf
+    bcf = _read(work_dir, 'main.bcf')
+    if bcf:
+        parts = ['biber', bcf]
+        for name in BCF_DATASOURCE_RE.findall(bcf):
+            parts.append(name)
+            parts.append(_read(work_dir, name.strip()) or '')
+        return 'biber', parts
+    return None, None
+
+
+class BibliographyCache:
+    """
+    Cache of generated .bbl files.
+
+    BibTeX and Biber only see the cited keys, the style and the .bib
+    content, so the .bbl is keyed on exactly those. An edit that doesn't
+    touch citations or the bibliography reuses the cached .bbl instead of
+    reprocessing a large .bib file, and projects sharing a bibliography
+    share its .bbl.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.store = DiskLRUCache('bbl_cache', cache_dir, max_bytes, suffix='.bbl')
+
+    def bbl_key(self, parts):
+        return hash_inputs('cotex-bbl-v1', *parts)
+
+    def update_bbl(self, work_dir, env, timeout, preexec_fn=None):
+        """
+        Bring main.bbl in `work_dir` up to date after a pdflatex pass
+
+        Runs bibtex or biber only when the cache has no .bbl for the current
+        inputs. A failing tool doesn't fail the compile; LaTeX reports the
+        missing references itself.
+
+        Returns:
+            bool: True if main.bbl changed, so another pass is needed
+        """
+        tool, parts = bibliography_inputs(work_dir)
+        if tool is None:
+            return False
+
+        key = self.bbl_key(parts)
+        bbl_path = os.path.join(work_dir, 'main.bbl')
+        cached = self.store.lookup(key)
+        if cached is not None:
+            if os.path.exists(bbl_path) and filecmp.cmp(cached, bbl_path, shallow=False):
+                return False
+            shutil.copyfile(cached, bbl_path)
+            return True
+
+        before = _read(work_dir, 'main.bbl')
+        started = time.monotonic()
+        try:
+            process = subprocess.run(
+                [tool, 'main'],
+                cwd=work_dir,
+                capture_output=True,
+                text=True,
+                env=env,
+                timeout=timeout,
+                preexec_fn=preexec_fn
+            )
+        except OSError:
+            metrics.incr('bibliography.failures')
+            return False
+        finally:
+            metrics.observe('bibliography.run', time.monotonic() - started)
+
+        # bibtex exits with 1 when it only had warnings (e.g. a missing field)
+        ok_codes = (0, 1) if tool == 'bibtex' else (0,)
+        if process.returncode not in ok_codes or not os.path.exists(bbl_path):
+            metrics.incr('bibliography.failures')
+            return False
+
+        metrics.incr(f'bibliography.{tool}_runs')
+        self.store.put_file(key, bbl_path)
+        return _read(work_dir, 'main.bbl') != before
+
+    def stats(self):
+        stats = self.store.stats()
+        counters = metrics.snapshot()['counters']
+        stats['bibtex_runs'] = counters.get('bibliography.bibtex_runs', 0)
+        stats['biber_runs'] = counters.get('bibliography.biber_runs', 0)
+        stats['failures'] = counters.get('bibliography.failures', 0)
+        return stats
+
+
+_bibliography_cache = None
+_bibliography_cache_lock = threading.Lock()
+
+
+def get_bibliography_cache():
+    """Return the process-wide .bbl cache"""
+    global _bibliography_cache
+    if _bibliography_cache is None:
+        with _bibliography_cache_lock:
+            if _bibliography_cache is None:
+                base_dir = getattr(settings, 'LATEX_TEMP_DIR', '/tmp/cotex')
+                _bibliography_cache = BibliographyCache(
+                    os.path.join(base_dir, 'cache', 'bbl'),
+                    getattr(settings, 'LATEX_BBL_CACHE_MAX_BYTES', 256 * 1024 * 1024),
+                )
+    return _bibliography_cache
@@ -0,0 +1,247 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from . import metrics
+
+MANIFEST_NAME = '.cotex-manifest.json'
+
+# Files TeX writes between runs; kept in warm directories so the next
+# compile starts from the previous run's state
+AUX_EXTENSIONS = ('.aux', '.toc', '.lof', '.lot', '.out', '.bbl', '.blg', '.nav', '.snm', '.idx', '.ind')
+
+
+class UnsafePathError(ValueError):
+    """Raised when a project file name would escape the build directory"""
+
+
+def safe_join(root, filename):
+    """Join `filename` onto `root`, refusing paths that point outside of it"""
+    path = os.path.normpath(os.path.join(root, filename))
+    if os.path.commonpath([root, path]) != root or path == root:
+        raise UnsafePathError(f"Invalid file name: {filename}")
+    return path
+
+
+class BuildDirectoryManager:
+    """
+    Persistent per-project build directories under LATEX_TEMP_DIR.
+
+    Each build key (normally a project id) gets its own directory that is
+    kept between compiles, so TeX can reuse .aux/.toc/.bbl files from the
+    previous run. Only sources whose content changed are rewritten. When
+    the directories exceed `quota_bytes`, the least recently used ones are
+    removed.
+
+    The total size is kept as a running figure: after a compile only its
+    own directory is measured again. Every directory is walked only when
+    that total goes over quota, or every `rescan_interval` seconds to pick
+    up what other processes wrote.
+    """
+
+    def __init__(self, root, quota_bytes, rescan_interval=300):
+        self.root = os.path.realpath(root)
+        self.quota_bytes = quota_bytes
+        self.rescan_interval = rescan_interval
+        # {path: bytes} as of the last full walk, updated after each compile
+        self.sizes = None
+        self.scanned_at = 0.0
+        self.sizes_lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def path_for(self, build_key):
+        # Hash the key so arbitrary keys map to flat, safe directory names
+        name = hashlib.sha256(str(build_key).encode('utf-8')).hexdigest()[:32]
+        return os.path.join(self.root, name)
+
+    def lock(self, build_dir, blocking=True):
+        """
+        Take the cross-process lock of a build directory, held on `<dir>.lock`
+
+        Eviction deletes the lock file along with the directory while
+        holding it; anyone who locked the deleted file meanwhile notices
+        (the path no longer leads to the file they hold) and locks the new
+        one, as in SingleFlight.key_lock.
+
+        Returns:
+            file: The locked lock file (closing it unlocks), or None if
+            `blocking` is False and the directory is in use
+        """
+        lock_path = build_dir + '.lock'
+        while True:
+            lock_file = open(lock_path, 'a')
+            try:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    lock_file.close()
+                    return None
+                try:
+                    current = os.stat(lock_path)
+                except FileNotFoundError:
+                    current = None
+                if current is not None and current.st_ino == os.fstat(lock_file.fileno()).st_ino:
+                    return lock_file
+            except BaseException:
+                lock_file.close()
+                raise
+            lock_file.close()
+
+    @contextmanager
+    def acquire(self, build_key):
+        """Lock and yield the build directory for `build_key`"""
+        build_dir = self.path_for(build_key)
+        # One compile at a time per directory, across processes
+        with self.lock(build_dir):
+            os.makedirs(build_dir, exist_ok=True)
+            os.utime(build_dir)
+            yield build_dir
+            size = self.directory_size(build_dir)
+        self.record_size(build_dir, size)
+
+    def record_size(self, build_dir, size):
+        """Update the running total with a directory's new size, enforcing the quota if needed"""
+        with self.sizes_lock:
+            rescan = self.sizes is None or time.monotonic() - self.scanned_at > self.rescan_interval
+            if not rescan:
+                self.sizes[build_dir] = size
+                rescan = sum(self.sizes.values()) > self.quota_bytes
+        if rescan:
+            self.enforce_quota()
+
+    def sync_sources(self, build_dir, sources):
+        """
+        Write `sources` ({filename: content}) into `build_dir`.
+
+        Files whose content hash matches the manifest from the last compile
+        are left untouched, and sources that no longer exist in the project
+        are removed.
+
+        Returns:
+            int: Number of files written
+        """
+        manifest_path = os.path.join(build_dir, MANIFEST_NAME)
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except (FileNotFoundError, ValueError):
+            manifest = {}
+
+        new_manifest = {}
+        written = 0
+        for filename, content in sources.items():
+            file_path = safe_join(build_dir, filename)
+            digest = hashlib.sha256(content.encode('utf-8')).hexdigest()
+            new_manifest[filename] = digest
+            if manifest.get(filename) == digest and os.path.exists(file_path):
+                continue
+
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, 'w') as f:
+                f.write(content)
+            written += 1
+
+        for filename in set(manifest) - set(new_manifest):
+            try:
+                os.remove(safe_join(build_dir, filename))
+            except (FileNotFoundError, UnsafePathError):
+                pass
+
+        with open(manifest_path, 'w') as f:
+            json.dump(new_manifest, f)
+
+        metrics.incr('build_dirs.files_written', written)
+        metrics.incr('build_dirs.files_reused', len(sources) - written)
+        return written
+
+    def clear_aux_files(self, build_dir):
+        """Remove auxiliary files, e.g. after a failed run left them truncated"""
+        for dirpath, _, filenames in os.walk(build_dir):
+            for filename in filenames:
+                if filename.endswith(AUX_EXTENSIONS):
+                    os.remove(os.path.join(dirpath, filename))
+
+    def directory_size(self, path):
+        total = 0
+        for dirpath, _, filenames in os.walk(path):
+            for filename in filenames:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, filename))
+                except FileNotFoundError:
+                    pass
+        return total
+
+    def enforce_quota(self):
+        """Walk every build directory and remove the least recently used ones until under quota"""
+        dirs = []
+        lock_paths = []
+        with os.scandir(self.root) as it:
+            for entry in it:
+                if entry.is_dir():
+                    dirs.append((entry.stat().st_mtime, self.directory_size(entry.path), entry.path))
+                elif entry.name.endswith('.lock'):
+                    lock_paths.append(entry.path)
+
+        sizes = {path: size for _, size, path in dirs}
+        total = sum(sizes.values())
+        for _, size, path in sorted(dirs):
+            if total <= self.quota_bytes:
+                break
+            # Skip directories with a compile in progress
+            if not self.remove(path):
+                continue
+            total -= size
+            del sizes[path]
+            metrics.incr('build_dirs.evictions')
+
+        # Lock files whose directory is gone (e.g. removed by hand)
+        for lock_path in lock_paths:
+            build_dir = lock_path[:-len('.lock')]
+            if not os.path.isdir(build_dir):
+                self.remove(build_dir)
+
+        with self.sizes_lock:
+            self.sizes = sizes
+            self.scanned_at = time.monotonic()
+        metrics.incr('build_dirs.scans')
+
+
+    def remove(self, build_dir):
+        """
+        Delete a build directory and its lock file, unless a compile holds the lock
+
+        Returns:
+            bool: False if the directory is in use
+        """
+        lock_file = self.lock(build_dir, blocking=False)
+        if lock_file is None:
+            return False
+        with lock_file:
+            shutil.rmtree(build_dir, ignore_errors=True)
+            # Before unlocking, so waiters see the file is gone and lock a new one
+            os.remove(build_dir + '.lock')
+        return True
+
+
+_build_dirs = None
+_build_dirs_lock = threading.Lock()
+
+
+def get_build_dirs():
+    """Return the process-wide build directory manager"""
+    global _build_dirs
+    if _build_dirs is None:
+        with _build_dirs_lock:
+            if _build_dirs is None:
+                base_dir = getattr(settings, 'LATEX_TEMP_DIR', '/tmp/cotex')
+                _build_dirs = BuildDirectoryManager(
+                    os.path.join(base_dir, 'builds'),
+                    getattr(settings, 'LATEX_BUILD_DIR_QUOTA_BYTES', 2 * 1024 * 1024 * 1024),
+                    rescan_interval=getattr(settings, 'LATEX_BUILD_DIR_RESCAN_INTERVAL', 300),
+                )
+    return _build_dirs
@@ -0,0 +1,212 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from django.conf import settings
+from . import metrics
+
+
+def hash_inputs(*parts):
+    """
+    Build a stable sha256 hex digest from a sequence of str/bytes parts.
+
+    Each part is length-prefixed so that ('ab', 'c') and ('a', 'bc')
+    never produce the same key.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        digest.update(str(len(part)).encode('ascii'))
+        digest.update(b':')
+        digest.update(part)
+    return digest.hexdigest()
+
+
+class DiskLRUCache:
+    """
+    Content-addressed file cache with a size bound.
+
+    Entries are stored as `<key><suffix>` inside `cache_dir`. The modification
+    time of an entry doubles as its last-access time, so eviction removes the
+    least recently used entries until the cache fits in `max_bytes`.
+
+    The size of the cache is kept as a running total, so storing an entry
+    doesn't list the directory. It's rescanned when the total goes over
+    `max_bytes`, and every `rescan_interval` seconds to pick up entries
+    other processes stored.
+    """
+
+    def __init__(self, name, cache_dir, max_bytes, suffix='', rescan_interval=300):
+        self.name = name
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.rescan_interval = rescan_interval
+        self._lock = threading.Lock()
+        # Running totals as of the last scan; None until the first one
+        self._bytes = None
+        self._count = 0
+        self._scanned_at = 0.0
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def path_for(self, key):
+        return os.path.join(self.cache_dir, f"{key}{self.suffix}")
+
+    def lookup(self, key, record_stats=True):
+        """Return the path of a cached entry (marking it as used), or None"""
+        path = self.path_for(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            if record_stats:
+                metrics.incr(f'{self.name}.misses')
+            return None
+        if record_stats:
+            metrics.incr(f'{self.name}.hits')
+        return path
+
+    def get(self, key, record_stats=True):
+        """Return the cached bytes for `key`, or None on a miss"""
+        path = self.lookup(key, record_stats)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            # Evicted between lookup and read
+            return None
+
+    def put(self, key, data):
+        """Store `data` under `key` and return the entry path"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        return self.commit(key, tmp_path)
+
+    def reserve(self):
+        """
+        Return a temporary path inside the cache directory for a producer to
+        write to directly; publish it with commit() or drop it with discard()
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp-')
+        os.close(fd)
+        return tmp_path
+
+    def discard(self, tmp_path):
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+
+    def put_file(self, key, source_path):
+        """Copy the file at `source_path` into the cache under `key`"""
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix='.tmp-')
+        with os.fdopen(fd, 'wb') as dst, open(source_path, 'rb') as src:
+            while True:
+                chunk = src.read(1024 * 1024)
+                if not chunk:
+                    break
+                dst.write(chunk)
+        return self.commit(key, tmp_path)
+
+    def commit(self, key, tmp_path):
+        """Publish a file written at `tmp_path` as the entry for `key`"""
+        path = self.path_for(key)
+        size = os.path.getsize(tmp_path)
+        try:
+            replaced = os.path.getsize(path)
+        except FileNotFoundError:
+            replaced = None
+        # Atomic rename so readers never see a partially written entry
+        os.replace(tmp_path, path)
+        metrics.incr(f'{self.name}.stores')
+        with self._lock:
+            if self._bytes is not None:
+                self._bytes += size - (replaced or 0)
+                self._count += replaced is None
+        self.evict()
+        return path
+
+    def entries(self):
+        """List (mtime, size, path) for every entry in the cache"""
+        result = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if entry.name.startswith('.tmp-') or not entry.is_file():
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                result.append((stat.st_mtime, stat.st_size, entry.path))
+        return result
+
+    def _stale(self):
+        return self._bytes is None or time.monotonic() - self._scanned_at > self.rescan_interval
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in max_bytes
+
+        Only scans the directory when the running total is over max_bytes or
+        due for a refresh.
+        """
+        with self._lock:
+            if not self._stale() and self._bytes <= self.max_bytes:
+                return 0
+            entries = self.entries()
+            total = sum(size for _, size, _ in entries)
+            evicted = 0
+            if total > self.max_bytes:
+                for _, size, path in sorted(entries):
+                    if total <= self.max_bytes:
+                        break
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    total -= size
+                    evicted += 1
+                metrics.incr(f'{self.name}.evictions', evicted)
+            self._bytes = total
+            self._count = len(entries) - evicted
+            self._scanned_at = time.monotonic()
+            metrics.incr(f'{self.name}.scans')
+            return evicted
+
+    def stats(self):
+        self.evict()
+        with self._lock:
+            count, size = self._count, self._bytes
+        counters = metrics.snapshot()['counters']
+        return {
+            'entries': count,
+            'bytes': size,
+            'max_bytes': self.max_bytes,
+            'hits': counters.get(f'{self.name}.hits', 0),
+            'misses': counters.get(f'{self.name}.misses', 0),
+            'evictions': counters.get(f'{self.name}.evictions', 0),
+        }
+
+
+_compile_cache = None
+_compile_cache_lock = threading.Lock()
+
+
+def get_compile_cache():
+    """Return the process-wide cache of compiled PDFs"""
+    global _compile_cache
+    if _compile_cache is None:
+        with _compile_cache_lock:
+            if _compile_cache is None:
+                base_dir = getattr(settings, 'LATEX_TEMP_DIR', '/tmp/cotex')
+                _compile_cache = DiskLRUCache(
+                    'compile_cache',
+                    getattr(settings, 'LATEX_CACHE_DIR', os.path.join(base_dir, 'cache', 'pdf')),
+                    getattr(settings, 'LATEX_CACHE_MAX_BYTES', 512 * 1024 * 1024),
+                    suffix='.pdf',
+                )
+    return _compile_cache
@@ -0,0 +1,409 @@
+import asyncio
+import itertools
+import threading
+import time
+from collections import defaultdict, deque
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from .models import File
+from .edits import apply_edits, diff_edits, transform_edits
+from . import metrics
+
+# Collaborative editing keeps one CollabDocument per open file in the
+# process serving its WebSocket connections (see websocket.py). Clients
+# send edits against the revision they last saw; the document transforms
+# them against everything applied since, applies them and broadcasts the
+# result, so every client converges on the same text. Content is written
+# to the File's blob every COLLAB_FLUSH_INTERVAL seconds rather than per
+# edit. Documents live in memory, so every connection to a given file
+# must reach the same process (route on the file id when running several).
+
+
+class StaleRevision(Exception):
+    """Raised for edits against a revision the document no longer has history for"""
+
+
+class InMemoryChannelLayer:
+    """
+    Delivers messages between the connections of this process
+
+    Follows the new_channel / send / receive / group_add / group_discard /
+    group_send interface of Django Channels layers. A connection that
+    falls `capacity` messages behind is dropped from its groups and sent a
+    single {'type': 'overflow'} message, since skipping operations would
+    leave it with different content than everyone else.
+    """
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self._channels = {}
+        self._groups = defaultdict(set)
+        self._names = itertools.count(1)
+
+    def new_channel(self, prefix='collab'):
+        name = f'{prefix}.{next(self._names)}'
+        self._channels[name] = asyncio.Queue(self.capacity)
+        return name
+
+    def close_channel(self, channel):
+        self._channels.pop(channel, None)
+        for group in list(self._groups):
+            self._discard(group, channel)
+
+    async def send(self, channel, message):
+        queue = self._channels.get(channel)
+        if queue is None:
+            return
+        try:
+            queue.put_nowait(message)
+        except asyncio.QueueFull:
+            metrics.incr('collab.overflows')
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait({'type': 'overflow'})
+            for group in list(self._groups):
+                self._discard(group, channel)
+
+    async def receive(self, channel):
+        return await self._channels[channel].get()
+
+    def pending(self, channel):
+        """Messages already waiting for `channel`, without blocking"""
+        queue = self._channels.get(channel)
+        messages = []
+        while queue is not None and not queue.empty():
+            messages.append(queue.get_nowait())
+        return messages
+
+    async def group_add(self, group, channel):
+        self._groups[group].add(channel)
+
+    async def group_discard(self, group, channel):
+        self._discard(group, channel)
+
+    def _discard(self, group, channel):
+        members = self._groups.get(group)
+        if members is not None:
+            members.discard(channel)
+            if not members:
+                del self._groups[group]
+
+    async def group_send(self, group, message):
+        for channel in list(self._groups.get(group, ())):
+            await self.send(channel, message)
+
+
+def database_sync_to_async(function):
+    """Run a blocking ORM call from the event loop, like Channels' database_sync_to_async"""
+    def call(*args, **kwargs):
+        close_old_connections()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            close_old_connections()
+    return sync_to_async(call, thread_sensitive=True)
+
+
+@database_sync_to_async
+def _load_file(file_id):
+    file = File.objects.select_related('blob').filter(id=file_id).first()
+    if file is None:
+        return None
+    return file.project_id, file.content, file.blob_id
+
+
+@database_sync_to_async
+def _save_file(file_id, base_hash, content):
+    """
+    Returns:
+        tuple: ('saved', hash), ('changed', hash, content) when the file
+        was saved elsewhere since `base_hash`, or ('deleted',)
+    """
+    file = File.objects.filter(id=file_id).first()
+    if file is None:
+        return ('deleted',)
+    if file.replace_content(base_hash, content):
+        return ('saved', file.blob_id)
+    file = File.objects.select_related('blob').filter(id=file_id).first()
+    if file is None:
+        return ('deleted',)
+    return ('changed', file.blob_id, file.content)
+
+
+class CollabDocument:
+    """The live content of one file and the operations applied to it since it was opened"""
+
+    def __init__(self, file_id, project_id, content, blob_hash, history_limit):
+        self.file_id = file_id
+        self.project_id = project_id
+        self.group = f'file.{file_id}'
+        self.content = content
+        self.revision = 0
+        # Edits of revisions history_start + 1 .. revision
+        self.history = deque()
+        self.history_start = 0
+        self.history_limit = history_limit
+        # What the database holds, and the operations that turn it into
+        # the content at saved_revision (empty unless a save made outside
+        # the session was merged since the last flush)
+        self.saved_content = content
+        self.saved_hash = blob_hash
+        self.saved_revision = 0
+        self.saved_bridge = []
+        self.dirty_since = None
+        self.clients = set()
+        self.flush_lock = asyncio.Lock()
+
+    def apply(self, revision, edits):
+        """
+        Apply edits a client made at `revision`
+
+        Returns:
+            list: The edits as applied, transformed against everything
+            applied since `revision`
+
+        Raises:
+            StaleRevision: If `revision` is unknown or no longer in the history
+            EditError: If the edits don't fit the content
+        """
+        if not self.history_start <= revision <= self.revision:
+            raise StaleRevision(f"Revision {revision} is not between {self.history_start} and {self.revision}")
+        for applied in itertools.islice(self.history, revision - self.history_start, None):
+            edits = transform_edits(edits, applied)
+        self._append(edits)
+        return edits
+
+    def _append(self, edits):
+        self.content = apply_edits(self.content, edits)
+        self.history.append(edits)
+        self.revision += 1
+        # Keep what a conflicting save elsewhere has to be rebased over
+        while len(self.history) > self.history_limit and self.history_start < self.saved_revision:
+            self.history.popleft()
+            self.history_start += 1
+        if self.dirty_since is None:
+            self.dirty_since = time.monotonic()
+
+    def saved(self, blob_hash, content, revision):
+        self.saved_hash = blob_hash
+        self.saved_content = content
+        self.saved_revision = revision
+        self.saved_bridge = []
+
+    def merge_external(self, blob_hash, content):
+        """
+        Apply a save made outside the session (e.g. through the REST API)
+        as one more operation
+
+        Returns:
+            list: The edits as applied, or [] if nothing changed
+        """
+        edits = diff_edits(self.saved_content, content)
+        # Rebase the change onto the current revision, collecting the same
+        # operations rebased onto the new database content as we go
+        bridge = []
+        unsaved = itertools.chain(
+            self.saved_bridge, itertools.islice(self.history, self.saved_revision - self.history_start, None)
+        )
+        for applied in unsaved:
+            bridge.append(transform_edits(applied, edits, applied_first=False))
+            edits = transform_edits(edits, applied)
+        if edits:
+            self._append(edits)
+        self.saved_hash = blob_hash
+        self.saved_content = content
+        self.saved_revision = self.revision
+        self.saved_bridge = bridge
+        return edits
+
+
+class CollabHub:
+    """
+    Open documents of this process, their connections and the flush loop
+
+    Must be created and used on the event loop serving the connections.
+    """
+
+    def __init__(self, layer, flush_interval, history_limit):
+        self.loop = asyncio.get_running_loop()
+        self.layer = layer
+        self.flush_interval = flush_interval
+        self.history_limit = history_limit
+        self.documents = {}
+        self._opening = {}
+        self._clients = itertools.count(1)
+        # [second, operations] for the last RATE_WINDOW seconds
+        self._rate = deque()
+        self._flusher = self.loop.create_task(self._flush_loop())
+
+    RATE_WINDOW = 10
+
+    async def join(self, file_id, channel):
+        """
+        Open the file's document (loading it if this is its first client)
+        and subscribe `channel` to its operations
+
+        Returns:
+            tuple: (CollabDocument, client id), or (None, None) if the file doesn't exist
+        """
+        while True:
+            document = self.documents.get(file_id)
+            if document is not None:
+                break
+            opening = self._opening.get(file_id)
+            if opening is None:
+                opening = self._opening[file_id] = self.loop.create_task(self._open(file_id))
+                opening.add_done_callback(lambda _: self._opening.pop(file_id, None))
+            document = await opening
+            if document is None:
+                return None, None
+            if self.documents.get(file_id) is document:
+                break
+        client_id = next(self._clients)
+        document.clients.add(channel)
+        await self.layer.group_add(document.group, channel)
+        metrics.incr('collab.connections')
+        return document, client_id
+
+    async def _open(self, file_id):
+        loaded = await _load_file(file_id)
+        if loaded is None:
+            return None
+        project_id, content, blob_hash = loaded
+        document = CollabDocument(file_id, project_id, content, blob_hash, self.history_limit)
+        self.documents[file_id] = document
+        return document
+
+    async def leave(self, document, channel):
+        """Unsubscribe `channel`, saving and closing the document after its last client"""
+        document.clients.discard(channel)
+        await self.layer.group_discard(document.group, channel)
+        if document.clients or self.documents.get(document.file_id) is not document:
+            return
+        await self.flush(document)
+        if not document.clients and self.documents.get(document.file_id) is document:
+            del self.documents[document.file_id]
+
+    async def submit(self, document, channel, client_id, revision, edits, op_id=None):
+        """
+        Apply a client's edits and broadcast them; the sender's copy is
+        delivered as an acknowledgement (see websocket.py)
+
+        Raises:
+            StaleRevision, EditError: See CollabDocument.apply()
+        """
+        received = time.monotonic()
+        applied = document.apply(revision, edits)
+        self._count_operation(received)
+        await self.layer.group_send(document.group, {
+            'type': 'op',
+            'rev': document.revision,
+            'edits': applied,
+            'client': client_id,
+            'id': op_id,
+            'origin': channel,
+            'sent_at': received,
+        })
+
+    def _count_operation(self, now):
+        metrics.incr('collab.ops')
+        second = int(now)
+        if self._rate and self._rate[-1][0] == second:
+            self._rate[-1][1] += 1
+        else:
+            self._rate.append([second, 1])
+        while self._rate and self._rate[0][0] <= second - self.RATE_WINDOW:
+            self._rate.popleft()
+
+    async def flush(self, document):
+        """Write the document's content to its File if it has unsaved operations"""
+        async with document.flush_lock:
+            # A save elsewhere is merged in and the save retried; give up
+            # after a few rounds and try again at the next flush
+            for _ in range(3):
+                if document.dirty_since is None:
+                    return
+                content, revision, dirty_since = document.content, document.revision, document.dirty_since
+                started = time.monotonic()
+                result = await _save_file(document.file_id, document.saved_hash, content)
+                metrics.observe('collab.flush', time.monotonic() - started)
+                if result[0] == 'saved':
+                    metrics.incr('collab.flushes')
+                    metrics.observe('collab.persist_lag', time.monotonic() - dirty_since)
+                    document.saved(result[1], content, revision)
+                    # Operations applied while saving are still unsaved
+                    document.dirty_since = None if document.revision == revision else started
+                    return
+                if result[0] == 'deleted':
+                    await self.close(document, 'deleted')
+                    return
+                metrics.incr('collab.flush_conflicts')
+                now = time.monotonic()
+                applied = document.merge_external(result[1], result[2])
+                if applied:
+                    self._count_operation(now)
+                    await self.layer.group_send(document.group, {
+                        'type': 'op', 'rev': document.revision, 'edits': applied, 'client': None, 'id': None,
+                        'origin': None, 'sent_at': now,
+                    })
+
+    async def close(self, document, reason):
+        """Disconnect every client of a document and forget it"""
+        self.documents.pop(document.file_id, None)
+        await self.layer.group_send(document.group, {'type': 'close', 'reason': reason})
+
+    async def flush_all(self):
+        for document in list(self.documents.values()):
+            try:
+                await self.flush(document)
+            except Exception:
+                metrics.incr('collab.flush_errors')
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush_all()
+
+    def stats(self):
+        now = time.monotonic()
+        documents = list(self.documents.values())
+        rate = sum(count for second, count in list(self._rate) if second > int(now) - self.RATE_WINDOW)
+        unsaved = [now - document.dirty_since for document in documents if document.dirty_since is not None]
+        timings = metrics.snapshot()['timings']
+        return {
+            'documents': len(documents),
+            'clients': sum(len(document.clients) for document in documents),
+            'ops_per_second': round(rate / self.RATE_WINDOW, 2),
+            'fanout': timings.get('collab.fanout'),
+            'persist_lag': timings.get('collab.persist_lag'),
+            'unsaved_documents': len(unsaved),
+            'oldest_unsaved': round(max(unsaved), 3) if unsaved else None,
+        }
+
+
+_hub = None
+_hub_lock = threading.Lock()
+
+
+def get_collab_hub():
+    """
+    Return this process's collaboration hub, creating it on the running
+    event loop (a fresh one if the loop has changed, e.g. between tests)
+    """
+    global _hub
+    loop = asyncio.get_running_loop()
+    if _hub is None or _hub.loop is not loop:
+        with _hub_lock:
+            if _hub is None or _hub.loop is not loop:
+                _hub = CollabHub(
+                    InMemoryChannelLayer(getattr(settings, 'COLLAB_CHANNEL_CAPACITY', 1000)),
+                    flush_interval=getattr(settings, 'COLLAB_FLUSH_INTERVAL', 2.0),
+                    history_limit=getattr(settings, 'COLLAB_HISTORY_LIMIT', 1000),
+                )
+    return _hub
+
+
+def collab_stats():
+    """Stats of this process's hub, or None if no file has been opened for collaboration"""
+    return _hub.stats() if _hub is not None else None
@@ -0,0 +1,227 @@
+import asyncio
+import json
+import random
+import time
+import uuid
+from django.contrib.auth.models import User
+from apps.projects.models import Project
+from .benchmark import WORDS, paragraph, percentile
+from .collab import get_collab_hub
+from .edits import apply_edits, transform_edits
+from .models import File
+from .websocket import collab_application
+from . import metrics
+
+# Load test for collaborative editing (`manage.py collab_loadtest`).
+# Simulated clients talk to the real ASGI application through in-memory
+# ASGI events and the in-memory channel layer, so no server or network is
+# involved, and check at the end that everyone converged on one text.
+
+
+class SimulatedClient:
+    """A browser editor session: types random edits and applies everyone else's, as the protocol asks"""
+
+    def __init__(self, file_id, user, rng):
+        self.file_id = file_id
+        self.scope = {
+            'type': 'websocket',
+            'path': f'/ws/files/{file_id}/',
+            'query_string': b'',
+            'user': user,
+        }
+        self.rng = rng
+        self.inbox = asyncio.Queue()
+        self.content = None
+        self.revision = None
+        self.pending = None
+        self.sent_at = None
+        self.synced = asyncio.Event()
+        self.ready = asyncio.Event()
+        self.closed = None
+        self.latencies = []
+        self.errors = []
+        self.task = None
+
+    async def connect(self):
+        self.task = asyncio.ensure_future(collab_application(self.scope, self.inbox.get, self.send))
+        await self.inbox.put({'type': 'websocket.connect'})
+        await self.ready.wait()
+
+    async def disconnect(self):
+        await self.inbox.put({'type': 'websocket.disconnect', 'code': 1000})
+        await self.task
+
+    async def send(self, event):
+        if event['type'] == 'websocket.close':
+            self.closed = event.get('code')
+            self.ready.set()
+        elif event['type'] == 'websocket.send':
+            self.handle(json.loads(event['text']))
+
+    def handle(self, message):
+        if message['type'] == 'batch':
+            for inner in message['messages']:
+                self.handle(inner)
+        elif message['type'] == 'init':
+            self.content = message['content']
+            self.revision = message['rev']
+            self.synced.set()
+            self.ready.set()
+        elif message['type'] == 'ack':
+            self.revision = message['rev']
+            self.pending = None
+            self.latencies.append(time.monotonic() - self.sent_at)
+            self.synced.set()
+        elif message['type'] == 'op':
+            edits = [(edit['start'], edit['end'], edit['text']) for edit in message['edits']]
+            if self.pending is not None:
+                edits, self.pending = (
+                    transform_edits(edits, self.pending, applied_first=False),
+                    transform_edits(self.pending, edits),
+                )
+            self.content = apply_edits(self.content, edits)
+            self.revision = message['rev']
+        elif message['type'] == 'error':
+            self.errors.append(message['error'])
+
+    def random_edits(self):
+        length = len(self.content)
+        start = self.rng.randint(0, length)
+        roll = self.rng.random()
+        if roll < 0.6 or not length:
+            return [(start, start, self.rng.choice(WORDS) + ' ')]
+        end = min(length, start + self.rng.randint(1, 12))
+        return [(start, end, '' if roll < 0.85 else self.rng.choice(WORDS))]
+
+    async def type(self, operations, interval):
+        for _ in range(operations):
+            await self.synced.wait()
+            if self.closed is not None:
+                return
+            edits = self.random_edits()
+            self.content = apply_edits(self.content, edits)
+            self.pending = edits
+            self.synced.clear()
+            self.sent_at = time.monotonic()
+            await self.inbox.put({'type': 'websocket.receive', 'text': json.dumps({
+                'type': 'op',
+                'rev': self.revision,
+                'edits': [{'start': start, 'end': end, 'text': text} for start, end, text in edits],
+            })})
+            await asyncio.sleep(interval)
+        await self.synced.wait()
+
+
+class CollabLoadTest:
+    """
+    Opens `files` files with `clients` simulated editors each, has every
+    editor send `operations` edits, and reports throughput, latency,
+    fan-out and persistence figures
+    """
+
+    def __init__(self, files, clients, operations, interval, flush_interval, seed=0, keep=False):
+        self.files = files
+        self.clients = clients
+        self.operations = operations
+        self.interval = interval
+        self.flush_interval = flush_interval
+        self.seed = seed
+        self.keep = keep
+        self.run_id = uuid.uuid4().hex[:8]
+
+    def setup(self):
+        rng = random.Random(self.seed)
+        self.users = [
+            User.objects.create_user(f'cotex-collab-{self.run_id}-{n}') for n in range(self.clients)
+        ]
+        self.project = Project.objects.create(name=f'collab-loadtest-{self.run_id}', owner=self.users[0])
+        self.project.collaborators.add(*self.users[1:])
+        self.file_ids = [
+            File.objects.create(
+                project=self.project,
+                name=f'section{n}.tex',
+                content='\n\n'.join(paragraph(rng) for _ in range(20)),
+            ).id
+            for n in range(self.files)
+        ]
+
+    def cleanup(self):
+        self.project.delete()
+        for user in self.users:
+            user.delete()
+
+    def run(self):
+        self.setup()
+        try:
+            metrics.reset()
+            report = asyncio.run(self.simulate())
+            report['persisted'] = all(
+                File.objects.select_related('blob').get(id=file_id).content == content
+                for file_id, content in report.pop('final').items()
+            )
+        finally:
+            if not self.keep:
+                self.cleanup()
+        return report
+
+    async def simulate(self):
+        hub = get_collab_hub()
+        hub.flush_interval = self.flush_interval
+        rng = random.Random(self.seed)
+        sessions = [
+            SimulatedClient(file_id, user, random.Random(rng.random()))
+            for file_id in self.file_ids for user in self.users
+        ]
+        for session in sessions:
+            await session.connect()
+
+        started = time.monotonic()
+        await asyncio.gather(*(session.type(self.operations, self.interval) for session in sessions))
+        wall_seconds = time.monotonic() - started
+
+        # Let the last broadcasts reach everyone, then compare
+        documents = {file_id: hub.documents[file_id] for file_id in self.file_ids}
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline and any(
+            session.revision != documents[session.file_id].revision
+            for session in sessions
+        ):
+            await asyncio.sleep(0.01)
+        converged = all(
+            session.content == documents[session.file_id].content
+            for session in sessions
+        )
+        stats = hub.stats()
+        final = {file_id: document.content for file_id, document in documents.items()}
+        for session in sessions:
+            await session.disconnect()
+
+        snapshot = metrics.snapshot()
+        latencies = sorted(latency for session in sessions for latency in session.latencies)
+        operations = snapshot['counters'].get('collab.ops', 0)
+        return {
+            'run_id': self.run_id,
+            'config': {
+                'files': self.files,
+                'clients_per_file': self.clients,
+                'operations_per_client': self.operations,
+                'interval': self.interval,
+                'flush_interval': self.flush_interval,
+            },
+            'operations': operations,
+            'wall_seconds': round(wall_seconds, 3),
+            'ops_per_second': round(operations / wall_seconds, 1) if wall_seconds else None,
+            'ack_latency': {
+                'p50': percentile(latencies, 50),
+                'p95': percentile(latencies, 95),
+                'p99': percentile(latencies, 99),
+                'max': latencies[-1] if latencies else None,
+            },
+            'fanout': snapshot['timings'].get('collab.fanout'),
+            'persist_lag': snapshot['timings'].get('collab.persist_lag'),
+            'flushes': snapshot['counters'].get('collab.flushes', 0),
+            'hub': stats,
+            'errors': sum(len(session.errors) for session in sessions),
+            'converged': converged,
+            'final': final,
+        }
@@ -0,0 +1,237 @@
+import os
+import re
+
+# Files whose content is TeX source worth scanning for references
+SCANNED_EXTENSIONS = ('.tex', '.sty', '.cls', '.ltx')
+
+# Candidate file names for each kind of reference, in the order TeX tries them
+GRAPHICS_EXTENSIONS = ('.pdf', '.png', '.jpg', '.jpeg', '.eps')
+CANDIDATE_SUFFIXES = {
+    'input': ('', '.tex'),
+    'include': ('.tex',),
+    'graphics': ('',) + GRAPHICS_EXTENSIONS,
+    'file': ('',),
+    'bibliography': ('.bib',),
+    'bibstyle': ('.bst',),
+    'package': ('.sty',),
+    'class': ('.cls',),
+    'svg': ('', '.svg'),
+}
+
+# Beamer themes are packages named after the theme, e.g. \usetheme{foo}
+# loads beamerthemefoo.sty
+CANDIDATE_PREFIXES = {
+    'theme': 'beamertheme',
+    'colortheme': 'beamercolortheme',
+    'fonttheme': 'beamerfonttheme',
+    'innertheme': 'beamerinnertheme',
+    'outertheme': 'beameroutertheme',
+}
+THEME_KINDS = tuple(CANDIDATE_PREFIXES)
+
+# Files TeX and packages load on their own (configuration, font
+# definitions), without any reference in the project's sources
+IMPLICIT_EXTENSIONS = ('.sty', '.cls', '.clo', '.cfg', '.def', '.fd')
+
+COMMAND_KINDS = {
+    'input': 'input',
+    'include': 'include',
+    'subfile': 'input',
+    'InputIfFileExists': 'input',
+    'IfFileExists': 'input',
+    'includegraphics': 'graphics',
+    'includesvg': 'svg',
+    'includepdf': 'file',
+    'lstinputlisting': 'file',
+    'verbatiminput': 'file',
+    'addbibresource': 'file',
+    'bibliography': 'bibliography',
+    'bibliographystyle': 'bibstyle',
+    'usepackage': 'package',
+    'RequirePackage': 'package',
+    'documentclass': 'class',
+    'LoadClass': 'class',
+    'usetheme': 'theme',
+    'usecolortheme': 'colortheme',
+    'usefonttheme': 'fonttheme',
+    'useinnertheme': 'innertheme',
+    'useoutertheme': 'outertheme',
+}
+
+# Commands whose argument is a comma separated list
+LIST_KINDS = ('bibliography', 'package') + THEME_KINDS
+
+COMMENT_RE = re.compile(r'(?<!\\)%.*')
+COMMAND_RE = re.compile(
+    r'\\(' + '|'.join(COMMAND_KINDS) + r')\*?\s*(?:\[[^\]]*\]\s*)?\{([^}]*)\}'
+)
+# Plain TeX form without braces, e.g. `\input chapter1`
+BARE_INPUT_RE = re.compile(r'\\input\s+([^\s{}\\%]+)')
+# The import package's \import{directory}{file} and its variants
+IMPORT_RE = re.compile(
+    r'\\(?:sub)?(?:import|inputfrom|includefrom)\*?\s*\{([^}]*)\}\s*\{([^}]*)\}'
+)
+# Any other command with a file-name-like argument. Packages define their
+# own file-loading commands, so these are kept as 'candidate' references
+# and count as edges when they name a project file
+CANDIDATE_RE = re.compile(r'\\([A-Za-z@]+)\*?\s*(?:\[[^\]]*\]\s*)?\{([\w./-]{1,200})\}')
+
+
+def should_scan(filename):
+    return filename.lower().endswith(SCANNED_EXTENSIONS)
+
+
+def scan_dependencies(content):
+    """
+    Find the files a TeX source references
+
+    Returns:
+        list: [kind, target] pairs in order of appearance. A reference built
+        from a macro (e.g. \\input{\\chapterdir/intro}) can't be resolved
+        statically and is reported as ['dynamic', target]. Arguments of
+        other commands that could be file names are reported as
+        ['candidate', argument].
+    """
+    content = COMMENT_RE.sub('', content)
+    found = []
+    for match in COMMAND_RE.finditer(content):
+        kind = COMMAND_KINDS[match.group(1)]
+        targets = match.group(2).split(',') if kind in LIST_KINDS else [match.group(2)]
+        for target in targets:
+            target = target.strip()
+            if not target:
+                continue
+            found.append(['dynamic' if '\\' in target or '#' in target else kind, target])
+    for match in BARE_INPUT_RE.finditer(content):
+        found.append(['input', match.group(1)])
+    for match in IMPORT_RE.finditer(content):
+        directory, target = match.group(1).strip(), match.group(2).strip()
+        if directory and not directory.endswith('/'):
+            directory += '/'
+        path = directory + target
+        found.append(['dynamic' if '\\' in path or '#' in path else 'input', path])
+    for match in CANDIDATE_RE.finditer(content):
+        if match.group(1) not in COMMAND_KINDS:
+            found.append(['candidate', match.group(2)])
+
+    deps = []
+    for dep in found:
+        if dep not in deps:
+            deps.append(dep)
+    return deps
+
+
+def file_stem(filename):
+    return os.path.splitext(filename)[0]
+
+
+def resolve_dependency(kind, target, filenames, stems=None):
+    """
+    Return the project file a reference points at, or None (e.g. a TeX Live package)
+
+    Args:
+        kind (str): Kind of reference, as reported by scan_dependencies()
+        target (str): Referenced name
+        filenames: Project file names
+        stems (dict): {name without extension: file name}, to resolve
+            'candidate' references by stem as well as by full name
+    """
+    if target.startswith('./'):
+        target = target[2:]
+    if kind == 'candidate':
+        if target in filenames:
+            return target
+        return (stems or {}).get(target)
+    if kind in CANDIDATE_PREFIXES:
+        target = CANDIDATE_PREFIXES[kind] + target
+        kind = 'package'
+    for suffix in CANDIDATE_SUFFIXES.get(kind, ('',)):
+        for candidate in (target + suffix, os.path.basename(target + suffix)):
+            if candidate in filenames:
+                return candidate
+    return None
+
+
+class DependencyGraph:
+    """
+    The reference graph of a project's files
+
+    Built from the per-file dependency lists stored on File (see
+    File.dependencies), so it can be walked without loading file contents.
+    """
+
+    def __init__(self, edges):
+        # {filename: [[kind, target], ...]}
+        self.edges = edges
+        self.stems = {}
+        for filename in sorted(edges):
+            self.stems.setdefault(file_stem(filename), filename)
+
+    def resolve(self, kind, target):
+        return resolve_dependency(kind, target, self.edges, self.stems)
+
+    def resolved(self, filename):
+        """Project files directly referenced by `filename`"""
+        result = []
+        for kind, target in self.edges.get(filename) or []:
+            name = self.resolve(kind, target)
+            if name is not None and name != filename:
+                result.append(name)
+        return result
+
+    def reachable(self, root):
+        """
+        Files transitively referenced from `root`, including `root`
+
+        Returns:
+            tuple: (reachable, complete) where complete is False if a reachable
+            file has a reference that can't be resolved statically, or if an
+            unreached file is one TeX may load implicitly (a .sty, .cfg,
+            ...); callers should then materialize every file
+        """
+        seen = {root}
+        stack = [root]
+        complete = True
+        while stack:
+            filename = stack.pop()
+            for kind, _ in self.edges.get(filename) or []:
+                if kind == 'dynamic':
+                    complete = False
+            for name in self.resolved(filename):
+                if name not in seen:
+                    seen.add(name)
+                    stack.append(name)
+        for filename in self.edges:
+            if filename not in seen and filename.lower().endswith(IMPLICIT_EXTENSIONS):
+                complete = False
+        return seen, complete
+
+    def unresolved(self, root):
+        """References from reachable files that don't match a project file"""
+        reachable, _ = self.reachable(root)
+        result = []
+        for filename in sorted(reachable):
+            for kind, target in self.edges.get(filename) or []:
+                if kind in ('package', 'class', 'bibstyle', 'candidate') + THEME_KINDS:
+                    # Usually installed packages, or arguments that aren't
+                    # file names at all, not missing files
+                    continue
+                if kind == 'dynamic' or self.resolve(kind, target) is None:
+                    result.append({'file': filename, 'kind': kind, 'target': target})
+        return result
+
+    def dependents(self, filename):
+        """Files that reference `filename` directly or transitively"""
+        reverse = {}
+        for source in self.edges:
+            for name in self.resolved(source):
+                reverse.setdefault(name, set()).add(source)
+        seen = set()
+        stack = [filename]
+        while stack:
+            for source in reverse.get(stack.pop(), ()):
+                if source not in seen:
+                    seen.add(source)
+                    stack.append(source)
+        seen.discard(filename)
+        return seen
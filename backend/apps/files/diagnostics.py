@@ -0,0 +1,181 @@
+import json
+import os
+import re
+import threading
+from django.conf import settings
+from .cache import DiskLRUCache
+
+# Compiles run with -file-line-error, so errors read "./ch1.tex:12: message"
+FILE_LINE_ERROR_RE = re.compile(r'^(\.?/?[^\s:]+\.\w+):(\d+): (.*)$')
+TEX_ERROR_RE = re.compile(r'^! (.*)$')
+ERROR_CONTEXT_RE = re.compile(r'^l\.(\d+) ?(.*)$')
+WARNING_RE = re.compile(r'^(LaTeX|Package [\w@-]+|Class [\w@-]+|pdfTeX) warning: (.*)$', re.IGNORECASE)
+INPUT_LINE_RE = re.compile(r'on input line (\d+)')
+BADBOX_RE = re.compile(r'^((?:Overfull|Underfull) \\[hv]box .*?)(?: in paragraph| in alignment| detected)? at lines? (\d+)')
+# "(./ch1.tex" or "(/usr/share/texlive/.../article.cls" opens a file and the
+# matching ")" closes it; other parentheses are tracked so they stay balanced
+FILE_EVENT_RE = re.compile(r'\((\.?/[^\s()]+|[\w.-]+\.(?:tex|sty|cls|bbl|aux))?|\)')
+# Continuation lines of a package warning start with "(pkgname)"
+CONTINUATION_RE = re.compile(r'^\([\w@-]+\)\s+(.*)$')
+
+# Keep responses bounded for documents that produce thousands of warnings
+MAX_DIAGNOSTICS = 200
+
+
+def normalize_source(path):
+    """Project-relative name of a source path from the log, or None for TeX Live files"""
+    if path is None:
+        return None
+    if path.startswith('./'):
+        return path[2:]
+    if not path.startswith('/'):
+        return path
+    return None
+
+
+def _file_stack_positions(log):
+    """Yield (offset, filename or None) each time the current input file changes"""
+    stack = []
+    for match in FILE_EVENT_RE.finditer(log):
+        if match.group(0) == ')':
+            if stack:
+                stack.pop()
+        else:
+            stack.append(match.group(1))
+        yield match.start(), next((name for name in reversed(stack) if name), None)
+
+
+def parse_log(log):
+    """
+    Turn a pdflatex log into structured diagnostics
+
+    Returns:
+        list: dicts with level ('error', 'warning' or 'badbox'), message,
+        file (project-relative name, None when it's a TeX Live file or
+        unknown) and line (None when the log doesn't say)
+    """
+    diagnostics = []
+    # Which file each log line belongs to, from the "(file ... )" nesting
+    changes = list(_file_stack_positions(log))
+    change_index = 0
+    current_file = None
+    offset = 0
+
+    lines = log.splitlines()
+    i = 0
+    while i < len(lines) and len(diagnostics) < MAX_DIAGNOSTICS:
+        line = lines[i]
+        while change_index < len(changes) and changes[change_index][0] < offset:
+            current_file = changes[change_index][1]
+            change_index += 1
+        offset += len(line) + 1
+        i += 1
+
+        match = FILE_LINE_ERROR_RE.match(line)
+        if match:
+            diagnostics.append({
+                'level': 'error',
+                'message': match.group(3).strip(),
+                'file': normalize_source(match.group(1)),
+                'line': int(match.group(2)),
+            })
+            continue
+
+        match = TEX_ERROR_RE.match(line)
+        if match:
+            error = {
+                'level': 'error',
+                'message': match.group(1).strip(),
+                'file': normalize_source(current_file),
+                'line': None,
+            }
+            # The "l.<n>" line after the error gives its position
+            for context in lines[i:i + 10]:
+                context_match = ERROR_CONTEXT_RE.match(context)
+                if context_match:
+                    error['line'] = int(context_match.group(1))
+                    break
+            diagnostics.append(error)
+            continue
+
+        match = WARNING_RE.match(line)
+        if match:
+            message = match.group(2).strip()
+            while i < len(lines):
+                continuation = CONTINUATION_RE.match(lines[i])
+                if continuation is None:
+                    break
+                message += ' ' + continuation.group(1).strip()
+                offset += len(lines[i]) + 1
+                i += 1
+            line_match = INPUT_LINE_RE.search(message)
+            diagnostics.append({
+                'level': 'warning',
+                'message': message.rstrip('.'),
+                'file': normalize_source(current_file),
+                'line': int(line_match.group(1)) if line_match else None,
+            })
+            continue
+
+        match = BADBOX_RE.match(line)
+        if match:
+            diagnostics.append({
+                'level': 'badbox',
+                'message': match.group(1).strip(),
+                'file': normalize_source(current_file),
+                'line': int(match.group(2)),
+            })
+    return diagnostics
+
+
+def summarize_errors(diagnostics):
+    """A one-line error message for a failed compile, or None"""
+    for diagnostic in diagnostics:
+        if diagnostic['level'] == 'error':
+            if diagnostic['file'] and diagnostic['line']:
+                return f"{diagnostic['file']}:{diagnostic['line']}: {diagnostic['message']}"
+            return diagnostic['message']
+    return None
+
+
+def attach_file_ids(diagnostics, file_ids):
+    """
+    Add the id of the project File each diagnostic points at
+
+    Args:
+        diagnostics (list): Output of parse_log()
+        file_ids (dict): {filename: File id}, with 'main.tex' for the main file
+    """
+    return [dict(diagnostic, file_id=file_ids.get(diagnostic['file'])) for diagnostic in diagnostics]
+
+
+class DiagnosticsStore:
+    """Diagnostics of successful compiles, stored next to their PDF by compile cache key"""
+
+    def __init__(self, cache_dir, max_bytes):
+        self.store = DiskLRUCache('diagnostics', cache_dir, max_bytes, suffix='.json')
+
+    def put(self, key, diagnostics):
+        self.store.put(key, json.dumps(diagnostics).encode('utf-8'))
+
+    def get(self, key):
+        data = self.store.get(key)
+        return json.loads(data) if data is not None else None
+
+
+_diagnostics_store = None
+_diagnostics_store_lock = threading.Lock()
+
+
+def get_diagnostics_store():
+    """Return the process-wide store of compile diagnostics"""
+    global _diagnostics_store
+    if _diagnostics_store is None:
+        with _diagnostics_store_lock:
+            if _diagnostics_store is None:
+                base_dir = getattr(settings, 'LATEX_TEMP_DIR', '/tmp/cotex')
+                _diagnostics_store = DiagnosticsStore(
+                    os.path.join(base_dir, 'cache', 'diagnostics'),
+                    getattr(settings, 'LATEX_DIAGNOSTICS_CACHE_MAX_BYTES', 64 * 1024 * 1024),
+                )
+    return _diagnostics_store
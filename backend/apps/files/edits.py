@@ -0,0 +1,205 @@
+from django.conf import settings
+
+
+class EditError(ValueError):
+    """Raised for a malformed or out-of-range list of edits"""
+
+
+def parse_edits(data):
+    """
+    Validate a list of edits from a request body
+
+    Args:
+        data: [{"start": int, "end": int, "text": str}, ...]
+
+    Returns:
+        list: (start, end, text) tuples
+
+    Raises:
+        EditError: If the list or any edit is malformed
+    """
+    if not isinstance(data, list):
+        raise EditError("edits must be a list")
+    max_edits = getattr(settings, 'FILE_EDITS_MAX_OPS', 1000)
+    if len(data) > max_edits:
+        raise EditError(f"At most {max_edits} edits per request")
+    edits = []
+    for index, edit in enumerate(data):
+        if not isinstance(edit, dict):
+            raise EditError(f"Edit {index} must be an object")
+        start, end, text = edit.get('start'), edit.get('end', edit.get('start')), edit.get('text', '')
+        if type(start) is not int or type(end) is not int or not isinstance(text, str):
+            raise EditError(f"Edit {index} needs integer start/end and string text")
+        if not 0 <= start <= end:
+            raise EditError(f"Edit {index} has an invalid range {start}-{end}")
+        edits.append((start, end, text))
+    return edits
+
+
+def apply_edits(content, edits):
+    """
+    Apply edits to `content` in one pass
+
+    Every range refers to the base content (offsets in characters, i.e.
+    Unicode code points), not to the result of the edits before it, so
+    ranges must not overlap. An edit replaces content[start:end] with its
+    text: start == end inserts, empty text deletes.
+
+    Args:
+        content (str): Base content
+        edits: (start, end, text) tuples, as returned by parse_edits()
+
+    Returns:
+        str: The edited content
+
+    Raises:
+        EditError: If a range overlaps another or lies past the end
+    """
+    pieces = []
+    position = 0
+    # Stable sort keeps the request order of several inserts at one offset
+    for start, end, text in sorted(edits, key=lambda edit: (edit[0], edit[1])):
+        if start < position:
+            raise EditError(f"Edit at {start}-{end} overlaps another edit")
+        if end > len(content):
+            raise EditError(f"Edit at {start}-{end} is past the end of the file ({len(content)} characters)")
+        pieces.append(content[position:start])
+        pieces.append(text)
+        position = end
+    pieces.append(content[position:])
+    return ''.join(pieces)
+
+
+def _components(edits, length):
+    """
+    Edits as a sequence of components over the whole content: a positive
+    int retains that many characters, a negative int deletes them, a
+    string inserts itself
+    """
+    components = []
+    position = 0
+    for start, end, text in sorted(edits, key=lambda edit: (edit[0], edit[1])):
+        if start > position:
+            components.append(start - position)
+        if text:
+            components.append(text)
+        if end > start:
+            components.append(start - end)
+        position = end
+    if length > position:
+        components.append(length - position)
+    return components
+
+
+def _edits(components):
+    """Turn components back into (start, end, text) edits, merging adjacent ones"""
+    edits = []
+    position = 0
+    for component in components:
+        if isinstance(component, str):
+            start, end, text = position, position, component
+        elif component < 0:
+            start, end, text = position, position - component, ''
+        else:
+            position += component
+            continue
+        if edits and edits[-1][1] == start:
+            previous = edits.pop()
+            start, text = previous[0], previous[2] + text
+        edits.append((start, end, text))
+        position = end
+    return edits
+
+
+def _transform(first, second):
+    """
+    Transform two component lists made against the same content, giving
+    (first', second') with apply(apply(c, first), second') equal to
+    apply(apply(c, second), first'). Inserts of `first` come first when
+    both sides insert at the same offset.
+    """
+    first_prime, second_prime = [], []
+    first, second = iter(first), iter(second)
+    a, b = next(first, None), next(second, None)
+    while a is not None or b is not None:
+        if isinstance(a, str):
+            first_prime.append(a)
+            second_prime.append(len(a))
+            a = next(first, None)
+            continue
+        if isinstance(b, str):
+            first_prime.append(len(b))
+            second_prime.append(b)
+            b = next(second, None)
+            continue
+        if a is None or b is None:
+            raise EditError("Edits were made against content of different lengths")
+        # Both retain or delete; consume the overlap of the two
+        length = min(abs(a), abs(b))
+        if a > 0 and b > 0:
+            first_prime.append(length)
+            second_prime.append(length)
+        elif a < 0 and b > 0:
+            first_prime.append(-length)
+        elif a > 0 and b < 0:
+            second_prime.append(-length)
+        # Deleted on both sides: nothing left to do for either
+        a = a - length if a > 0 else a + length
+        b = b - length if b > 0 else b + length
+        if not a:
+            a = next(first, None)
+        if not b:
+            b = next(second, None)
+    return first_prime, second_prime
+
+
+def transform_edits(edits, applied, applied_first=True):
+    """
+    Rebase edits onto content that concurrent `applied` edits were made to
+
+    Both lists refer to the same base content, and text the other side
+    deleted is no longer touched. The server transforms incoming edits
+    against its history with applied_first=True; a client transforms
+    incoming server edits against its own unacknowledged ones with
+    applied_first=False, so both sides order inserts at the same offset
+    alike and end up with the same content.
+
+    Args:
+        edits: (start, end, text) tuples to rebase
+        applied: (start, end, text) tuples already applied
+        applied_first (bool): Which side's text comes first when both
+            insert at the same offset
+
+    Returns:
+        list: (start, end, text) tuples against the edited content
+    """
+    if not applied or not edits:
+        return list(edits)
+    # Anything past the furthest edit is retained by both, so a common
+    # length is enough; the real content length isn't needed
+    length = max(end for _, end, _ in list(edits) + list(applied))
+    if applied_first:
+        _, rebased = _transform(_components(applied, length), _components(edits, length))
+    else:
+        rebased, _ = _transform(_components(edits, length), _components(applied, length))
+    return _edits(rebased)
+
+
+def diff_edits(old, new):
+    """
+    A single edit turning `old` into `new` (replacing what lies between
+    their common prefix and suffix)
+
+    Returns:
+        list: [] if the strings are equal, otherwise one (start, end, text)
+    """
+    if old == new:
+        return []
+    prefix = 0
+    limit = min(len(old), len(new))
+    while prefix < limit and old[prefix] == new[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and old[len(old) - 1 - suffix] == new[len(new) - 1 - suffix]:
+        suffix += 1
+    return [(prefix, len(old) - suffix, new[prefix:len(new) - suffix])]
@@ -0,0 +1,179 @@
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from django.conf import settings
+from .builddirs import safe_join
+from .cache import DiskLRUCache, hash_inputs
+from . import metrics
+
+# The \begin{document} token itself (group 1), when it isn't commented out;
+# whatever precedes it on its line is still part of the preamble
+BEGIN_DOCUMENT_RE = re.compile(r'^[^%\n]*?(\\begin\s*\{document\})', re.MULTILINE)
+
+
+def extract_preamble(main_tex_content):
+    """
+    Return everything before \\begin{document} in the main file, or None
+    when the file has no usable preamble.
+    """
+    match = BEGIN_DOCUMENT_RE.search(main_tex_content)
+    if match is None:
+        return None
+    preamble = main_tex_content[:match.start(1)]
+    if '\\documentclass' not in preamble:
+        return None
+    # Files that already pick a format (%&fmt) or mark their own dump point
+    # are left alone
+    if preamble.lstrip().startswith('%&') or '\\endofdump' in preamble:
+        return None
+    return preamble
+
+
+def preamble_dependencies(preamble, related_files):
+    """Project files the preamble may load (\\input{macros}, \\usepackage{mystyle}, ...)"""
+    dependencies = {}
+    for filename, content in related_files.items():
+        stem = os.path.splitext(os.path.basename(filename))[0]
+        if stem and stem in preamble:
+            dependencies[filename] = content
+    return dependencies
+
+
+class PreambleFormatCache:
+    """
+    Cache of precompiled pdflatex formats, one per distinct preamble.
+
+    A format is built with `pdflatex -ini` and mylatexformat, which dumps
+    the state of TeX at \\begin{document}. Compiles that load the format
+    skip their preamble, so packages like tikz and hyperref are not read
+    again. Formats are keyed only by the preamble and the local files it
+    loads, so projects with identical preambles share one format.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.store = DiskLRUCache('format_cache', cache_dir, max_bytes, suffix='.fmt')
+        # Preambles that failed to dump (e.g. packages that can't live in a
+        # format); remembered so we don't retry the build on every compile
+        self._failed = set()
+        self._lock = threading.Lock()
+
+    def format_key(self, preamble, dependencies, env):
+        parts = ['cotex-format-v2', env.get('SOURCE_DATE_EPOCH', ''), preamble]
+        for filename in sorted(dependencies):
+            parts.append(filename)
+            parts.append(dependencies[filename])
+        return hash_inputs(*parts)
+
+    def get_format(self, main_tex_content, related_files, env, timeout=None, preexec_fn=None):
+        """
+        Return the path of a format for this document's preamble, building
+        it if needed, or None if the document can't use a format.
+
+        Args:
+            timeout (float): Seconds the format build may take
+            preexec_fn: Run in the pdflatex child before exec (resource limits)
+        """
+        preamble = extract_preamble(main_tex_content)
+        if preamble is None:
+            return None
+
+        dependencies = preamble_dependencies(preamble, related_files)
+        key = self.format_key(preamble, dependencies, env)
+        if key in self._failed:
+            return None
+
+        path = self.store.lookup(key)
+        if path is not None:
+            return path
+
+        with self._lock:
+            # Another thread may have built it while we waited
+            path = self.store.path_for(key)
+            if os.path.exists(path):
+                return path
+            if key in self._failed:
+                return None
+            return self.build_format(key, main_tex_content, dependencies, env, timeout, preexec_fn)
+
+    def mark_failed(self, fmt_path):
+        """Stop using a format that built but broke the compile that loaded it"""
+        key = os.path.basename(fmt_path)[:-len(self.store.suffix)]
+        self._failed.add(key)
+        try:
+            os.remove(fmt_path)
+        except FileNotFoundError:
+            pass
+
+    def build_format(self, key, main_tex_content, dependencies, env, timeout=None, preexec_fn=None):
+        """
+        Dump the preamble into a format file and store it in the cache
+
+        A build that fails, runs out of time or hits a resource limit marks
+        the preamble as failed, so the compile goes ahead without a format.
+        """
+        started = time.monotonic()
+        build_dir = tempfile.mkdtemp(dir=os.path.dirname(self.store.cache_dir))
+        try:
+            with open(os.path.join(build_dir, 'main.tex'), 'w') as f:
+                f.write(main_tex_content)
+            for filename, content in dependencies.items():
+                file_path = safe_join(build_dir, filename)
+                os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                with open(file_path, 'w') as f:
+                    f.write(content)
+
+            process = subprocess.run(
+                ['pdflatex', '-ini', '-interaction=nonstopmode', '-jobname=preamble',
+                 '&pdflatex', 'mylatexformat.ltx', 'main.tex'],
+                cwd=build_dir,
+                capture_output=True,
+                text=True,
+                env=env,
+                timeout=timeout,
+                preexec_fn=preexec_fn
+            )
+            fmt_path = os.path.join(build_dir, 'preamble.fmt')
+            if process.returncode != 0 or not os.path.exists(fmt_path):
+                self._failed.add(key)
+                metrics.incr('format_cache.build_failures')
+                return None
+
+            metrics.incr('format_cache.builds')
+            return self.store.put_file(key, fmt_path)
+        except (OSError, subprocess.TimeoutExpired):
+            self._failed.add(key)
+            metrics.incr('format_cache.build_failures')
+            return None
+        finally:
+            metrics.observe('format_cache.build', time.monotonic() - started)
+            shutil.rmtree(build_dir, ignore_errors=True)
+
+    def stats(self):
+        stats = self.store.stats()
+        counters = metrics.snapshot()['counters']
+        stats['builds'] = counters.get('format_cache.builds', 0)
+        stats['build_failures'] = counters.get('format_cache.build_failures', 0)
+        stats['fallbacks'] = counters.get('format_cache.fallbacks', 0)
+        return stats
+
+
+_format_cache = None
+_format_cache_lock = threading.Lock()
+
+
+def get_format_cache():
+    """Return the process-wide preamble format cache"""
+    global _format_cache
+    if _format_cache is None:
+        with _format_cache_lock:
+            if _format_cache is None:
+                base_dir = getattr(settings, 'LATEX_TEMP_DIR', '/tmp/cotex')
+                _format_cache = PreambleFormatCache(
+                    os.path.join(base_dir, 'cache', 'fmt'),
+                    getattr(settings, 'LATEX_FORMAT_CACHE_MAX_BYTES', 1024 * 1024 * 1024),
+                )
+    return _format_cache
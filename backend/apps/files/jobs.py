@@ -0,0 +1,491 @@
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from .models import CompileJob
+from .pipeline import load_project_sources, compile_sources
+from .scheduler import SchedulerBusy, get_scheduler
+from .artifacts import record_artifact
+from . import metrics
+
+# Asynchronous compiles are persisted as CompileJob rows so any web worker
+# can answer status polls. With LATEX_COMPILE_QUEUE = 'local' (the default)
+# the pdflatex runs happen on this process's pool threads; with 'database'
+# the rows are left for `manage.py compile_worker` processes to claim, so
+# compile load spreads across every node that runs workers.
+#
+# Local jobs are claimed under this process's worker id and kept alive by a
+# LocalJobMonitor thread, so when a process dies (e.g. a restart) another
+# one requeues its running jobs, like compile_worker does, and resubmits
+# queued jobs that no live process picked up.
+#
+# Projects with speculative_compile enabled also get a speculative job after
+# each file save. It waits out a debounce window, is cancelled by the next
+# save, and compiles only when a slot is idle (see scheduler.py), into its
+# own build directory so it never holds the project's directory lock. A
+# speculative job that finds no idle slot stays queued and is retried once
+# a slot is released (or after LATEX_SPECULATIVE_RETRY seconds with the
+# database queue), so the last save of a burst still gets compiled.
+
+_executor = None
+_executor_lock = threading.Lock()
+_speculative_executor = None
+_speculative_timers = {}
+# {project id: speculative job id} waiting for a compile slot to be released
+_speculative_pending = {}
+# Scheduler whose slot releases retry them
+_speculative_scheduler = None
+_speculative_lock = threading.Lock()
+_monitor = None
+_monitor_lock = threading.Lock()
+
+
+def local_worker_id():
+    """Worker id of local jobs run by this process"""
+    return f"local:{socket.gethostname()}:{os.getpid()}"
+
+
+def get_executor():
+    """Return the process-wide compile worker pool, starting the local job monitor on first use"""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'LATEX_COMPILE_CONCURRENCY', 2),
+                    thread_name_prefix='cotex-compile',
+                )
+        start_local_monitor()
+    return _executor
+
+
+def get_speculative_executor():
+    """Return the single thread that runs speculative jobs, apart from requested ones"""
+    global _speculative_executor
+    if _speculative_executor is None:
+        with _speculative_lock:
+            if _speculative_executor is None:
+                _speculative_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cotex-speculative')
+        start_local_monitor()
+    return _speculative_executor
+
+
+def start_local_monitor():
+    """Start this process's LocalJobMonitor, which first recovers jobs left behind by a restart"""
+    global _monitor
+    if _monitor is None:
+        with _monitor_lock:
+            if _monitor is None:
+                _monitor = LocalJobMonitor(getattr(settings, 'LATEX_WORKER_HEARTBEAT', 10))
+                _monitor.start()
+    return _monitor
+
+
+def uses_database_queue():
+    return getattr(settings, 'LATEX_COMPILE_QUEUE', 'local') == 'database'
+
+
+def enqueue_compile(project, user=None):
+    """Create a queued CompileJob for `project` and hand it to the worker pool"""
+    job = CompileJob.objects.create(project=project, requested_by=user)
+    metrics.incr('compile_jobs.enqueued')
+    if not uses_database_queue():
+        # Only submit once the row is visible to the worker thread's connection
+        transaction.on_commit(lambda: get_executor().submit(run_compile_job, job.id))
+    return job
+
+
+def schedule_speculative_compile(project, user=None):
+    """
+    Queue a speculative compile of `project` after a file save, cancelling
+    the one queued by the previous save
+
+    A speculative job that is already running can't be stopped mid-pdflatex;
+    it is marked cancelled and its result dropped (the PDF still lands in the
+    compile cache).
+    """
+    debounce = getattr(settings, 'LATEX_SPECULATIVE_DEBOUNCE', 3)
+    now = timezone.now()
+    cancelled = CompileJob.objects.filter(
+        project=project, speculative=True, status__in=['queued', 'running']
+    ).update(status='cancelled', finished_at=now)
+    metrics.incr('compile_jobs.speculative_cancelled', cancelled)
+    job = CompileJob.objects.create(
+        project=project, requested_by=user, speculative=True, run_after=now + timedelta(seconds=debounce)
+    )
+    metrics.incr('compile_jobs.speculative')
+    if not uses_database_queue():
+        transaction.on_commit(lambda: _start_debounce_timer(project.id, job.id, debounce))
+    return job
+
+
+def _start_debounce_timer(project_id, job_id, debounce):
+    timer = threading.Timer(debounce, _submit_speculative, args=(project_id, job_id))
+    timer.daemon = True
+    with _speculative_lock:
+        previous = _speculative_timers.pop(project_id, None)
+        if previous is not None:
+            previous.cancel()
+        _speculative_timers[project_id] = timer
+    timer.start()
+
+
+def _submit_speculative(project_id, job_id):
+    with _speculative_lock:
+        if _speculative_timers.get(project_id) is threading.current_thread():
+            del _speculative_timers[project_id]
+    get_speculative_executor().submit(run_compile_job, job_id)
+
+
+def defer_speculative_job(job):
+    """
+    Put a speculative job that found no idle compile slot back in the queue
+
+    Returns:
+        bool: False if the job no longer belongs to this worker
+    """
+    global _speculative_scheduler
+    database = uses_database_queue()
+    deferred = CompileJob.objects.filter(id=job.id, status='running', worker_id=job.worker_id).update(
+        # Not turned away by a dead worker, so this doesn't count as an attempt
+        status='queued', worker_id='', heartbeat_at=None, started_at=None, attempts=F('attempts') - 1,
+        run_after=timezone.now() + timedelta(seconds=getattr(settings, 'LATEX_SPECULATIVE_RETRY', 5))
+        if database else None,
+    )
+    if not deferred:
+        metrics.incr('compile_jobs.dropped_results')
+        return False
+    metrics.incr('compile_jobs.speculative_deferred')
+    if not database:
+        with _speculative_lock:
+            # A newer save's job replaces an older one still waiting
+            _speculative_pending[job.project_id] = job.id
+            scheduler = get_scheduler()
+            hook = _speculative_scheduler is not scheduler
+            _speculative_scheduler = scheduler
+        if hook:
+            scheduler.on_release(_retry_speculative)
+        # The slot may have been released before the job was marked pending
+        if scheduler.has_idle_slot():
+            _retry_speculative()
+    return True
+
+
+def _retry_speculative():
+    """Hand deferred speculative jobs back to the speculative thread after a slot was released"""
+    with _speculative_lock:
+        pending = list(_speculative_pending.values())
+        _speculative_pending.clear()
+    for job_id in pending:
+        get_speculative_executor().submit(run_compile_job, job_id)
+
+
+def run_compile_job(job_id):
+    """Process a single CompileJob on a local worker thread"""
+    close_old_connections()
+    try:
+        now = timezone.now()
+        started = CompileJob.objects.filter(id=job_id, status='queued').update(
+            status='running', worker_id=local_worker_id(), heartbeat_at=now, started_at=now,
+            attempts=F('attempts') + 1,
+        )
+        if not started:
+            # Cancelled by a newer save, or the project was deleted
+            return
+        job = CompileJob.objects.select_related('project').get(id=job_id)
+        metrics.observe('compile_jobs.wait', (job.started_at - job.created_at).total_seconds())
+        execute_job(job)
+    except CompileJob.DoesNotExist:
+        # Project was deleted before the job ran
+        pass
+    finally:
+        close_old_connections()
+
+
+def execute_job(job):
+    """
+    Compile a job that is marked as running and record the result
+
+    Returns:
+        bool: False if the job no longer belongs to this worker (it was
+        handed to another worker after missed heartbeats, or deleted) and
+        the result was dropped
+    """
+    main_file, related_files = load_project_sources(job.project)
+    if main_file is None:
+        job.status = 'failed'
+        job.error = "No main file marked for this project"
+    else:
+        try:
+            # Queued jobs aren't rejected when the scheduler is full; they
+            # wait for their fair share of compile slots
+            outcome = compile_sources(
+                main_file.content, related_files,
+                build_key=f'{job.project_id}-speculative' if job.speculative else job.project_id,
+                user_id=job.requested_by_id, admission=False, speculative=job.speculative
+            )
+        except SchedulerBusy:
+            # Only speculative jobs are turned away; they never wait for a
+            # slot, but stay pending until one is free
+            return defer_speculative_job(job)
+        except Exception as e:
+            job.status = 'failed'
+            job.error = str(e)
+        else:
+            job.cache_key = outcome.cache_key or ''
+            job.cache_hit = outcome.cache_hit
+            job.passes = outcome.passes
+            job.usage = outcome.usage
+            artifact = record_artifact(job.project_id, outcome)
+            job.artifact_id = artifact.id if artifact else None
+            if outcome.success:
+                job.status = 'succeeded'
+            else:
+                job.status = 'failed'
+                job.error = outcome.error or ''
+
+    job.finished_at = timezone.now()
+    # Only the worker that owns the job may finish it
+    finished = CompileJob.objects.filter(id=job.id, status='running', worker_id=job.worker_id).update(
+        status=job.status,
+        cache_key=job.cache_key,
+        cache_hit=job.cache_hit,
+        passes=job.passes,
+        usage=job.usage,
+        artifact_id=job.artifact_id,
+        error=job.error,
+        finished_at=job.finished_at,
+    )
+    if not finished:
+        metrics.incr('compile_jobs.dropped_results')
+        return False
+    metrics.incr(f'compile_jobs.{job.status}')
+    return True
+
+
+def claim_job(worker_id):
+    """
+    Claim the oldest queued job for `worker_id`
+
+    Rows locked by another worker's claim are skipped rather than waited
+    for, so any number of workers can poll the same table.
+
+    Returns:
+        CompileJob: The claimed job, or None if the queue is empty
+    """
+    with transaction.atomic():
+        job = (
+            CompileJob.objects.select_for_update(skip_locked=True)
+            .filter(Q(run_after__isnull=True) | Q(run_after__lte=timezone.now()), status='queued')
+            # Requested jobs always go before speculative ones
+            .order_by('speculative', 'created_at')
+            .only('id')
+            .first()
+        )
+        if job is None:
+            return None
+        now = timezone.now()
+        # The status condition keeps claims exclusive on databases without
+        # row locks (e.g. SQLite in development)
+        claimed = CompileJob.objects.filter(id=job.id, status='queued').update(
+            status='running', worker_id=worker_id, heartbeat_at=now, started_at=now,
+            attempts=F('attempts') + 1,
+        )
+    if not claimed:
+        return None
+    job = CompileJob.objects.select_related('project').get(id=job.id)
+    metrics.incr('compile_jobs.claimed')
+    metrics.observe('compile_jobs.wait', (job.started_at - job.created_at).total_seconds())
+    return job
+
+
+def send_heartbeats(running):
+    """Mark running jobs as alive; `running` maps job ids to the worker id that claimed them"""
+    if running:
+        CompileJob.objects.filter(
+            id__in=list(running), worker_id__in=set(running.values()), status='running'
+        ).update(heartbeat_at=timezone.now())
+
+
+def requeue_dead_jobs():
+    """
+    Put jobs whose worker stopped sending heartbeats back in the queue, or
+    fail them once they've used up LATEX_COMPILE_MAX_ATTEMPTS
+
+    Returns:
+        tuple: (requeued, failed) counts
+    """
+    now = timezone.now()
+    cutoff = now - timedelta(seconds=getattr(settings, 'LATEX_WORKER_DEAD_AFTER', 60))
+    max_attempts = getattr(settings, 'LATEX_COMPILE_MAX_ATTEMPTS', 3)
+    requeued = failed = 0
+    with transaction.atomic():
+        dead = list(
+            CompileJob.objects.select_for_update(skip_locked=True)
+            .filter(status='running', heartbeat_at__lt=cutoff)
+            .exclude(worker_id='')
+            .values_list('id', 'attempts')[:100]
+        )
+        for job_id, attempts in dead:
+            stale = CompileJob.objects.filter(id=job_id, status='running', heartbeat_at__lt=cutoff)
+            if attempts >= max_attempts:
+                failed += stale.update(
+                    status='failed', error="Compile worker stopped responding", finished_at=now
+                )
+            else:
+                requeued += stale.update(status='queued', worker_id='', heartbeat_at=None)
+    metrics.incr('compile_jobs.requeued', requeued)
+    metrics.incr('compile_jobs.abandoned', failed)
+    return requeued, failed
+
+
+def recover_local_jobs(submitted=()):
+    """
+    Pick up local jobs that no live process will run: requeue (or fail)
+    running jobs whose process stopped sending heartbeats, then submit
+    queued jobs that have waited longer than LATEX_WORKER_DEAD_AFTER to
+    this process's threads
+
+    A job that is also still queued in a live process's pool only runs
+    once; whichever thread starts it first wins (see run_compile_job).
+
+    Args:
+        submitted: Ids handed to this process by an earlier call, not
+            submitted again
+
+    Returns:
+        set: Ids of the stale queued jobs, all now submitted here
+    """
+    requeue_dead_jobs()
+    cutoff = timezone.now() - timedelta(seconds=getattr(settings, 'LATEX_WORKER_DEAD_AFTER', 60))
+    stale = list(
+        CompileJob.objects.filter(status='queued', created_at__lt=cutoff)
+        .filter(Q(run_after__isnull=True) | Q(run_after__lte=timezone.now()))
+        .order_by('created_at')
+        .values_list('id', 'speculative')
+    )
+    recovered = 0
+    for job_id, speculative in stale:
+        if job_id in submitted:
+            continue
+        executor = get_speculative_executor() if speculative else get_executor()
+        executor.submit(run_compile_job, job_id)
+        recovered += 1
+    metrics.incr('compile_jobs.recovered', recovered)
+    return {job_id for job_id, _ in stale}
+
+
+class LocalJobMonitor(threading.Thread):
+    """
+    Keeps heartbeats going for the local jobs this process is running, and
+    runs recover_local_jobs() at start and every `interval` seconds
+    """
+
+    def __init__(self, interval):
+        super().__init__(name='cotex-job-monitor', daemon=True)
+        self.interval = interval
+        self.submitted = set()
+
+    def run(self):
+        while True:
+            try:
+                self.submitted = recover_local_jobs(self.submitted)
+            except Exception:
+                metrics.incr('compile_jobs.monitor_errors')
+            finally:
+                close_old_connections()
+            time.sleep(self.interval)
+            try:
+                CompileJob.objects.filter(status='running', worker_id=local_worker_id()).update(
+                    heartbeat_at=timezone.now()
+                )
+            except Exception:
+                metrics.incr('compile_jobs.monitor_errors')
+
+
+class CompileWorker:
+    """
+    Runs queued CompileJobs from the database, `concurrency` at a time.
+
+    Started by `manage.py compile_worker`. Each slot is a thread that claims
+    a job, compiles it (on the compile worker pool, see workers.py) and
+    claims the next one. A separate thread keeps heartbeats going for
+    running jobs and requeues jobs of workers that died.
+    """
+
+    def __init__(self, worker_id=None, concurrency=1, poll_interval=1.0, max_jobs=None):
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        # Exit after this many jobs (None runs until stopped)
+        self.max_jobs = max_jobs
+        self.heartbeat_interval = getattr(settings, 'LATEX_WORKER_HEARTBEAT', 10)
+        self.processed = 0
+        self._running = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def stop(self):
+        """Stop claiming jobs; running jobs are finished first"""
+        self._stop.set()
+
+    def run(self):
+        slots = [
+            threading.Thread(target=self._slot, args=(n,), name=f'cotex-worker-{n}')
+            for n in range(self.concurrency)
+        ]
+        monitor = threading.Thread(target=self._monitor, name='cotex-worker-monitor', daemon=True)
+        monitor.start()
+        for slot in slots:
+            slot.start()
+        for slot in slots:
+            slot.join()
+        self._stop.set()
+
+    def _take_slot(self):
+        with self._lock:
+            if self.max_jobs is not None and self.processed >= self.max_jobs:
+                return False
+            self.processed += 1
+            return True
+
+    def _slot(self, n):
+        slot_id = f"{self.worker_id}/{n}"
+        try:
+            while not self._stop.is_set():
+                if not self._take_slot():
+                    break
+                job = claim_job(slot_id)
+                if job is None:
+                    with self._lock:
+                        self.processed -= 1
+                    self._stop.wait(self.poll_interval)
+                    continue
+                with self._lock:
+                    self._running[job.id] = slot_id
+                try:
+                    execute_job(job)
+                finally:
+                    with self._lock:
+                        self._running.pop(job.id, None)
+                    close_old_connections()
+        finally:
+            close_old_connections()
+
+    def _monitor(self):
+        try:
+            requeue_dead_jobs()
+            while not self._stop.wait(self.heartbeat_interval):
+                with self._lock:
+                    running = dict(self._running)
+                send_heartbeats(running)
+                requeue_dead_jobs()
+                close_old_connections()
+        finally:
+            close_old_connections()
@@ -0,0 +1,45 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from apps.files.collab_benchmark import CollabLoadTest
+
+
+class Command(BaseCommand):
+    help = (
+        "Simulate editors on the collaborative editing channel (in memory, no server needed) "
+        "and print operations per second, latency, fan-out and persistence lag as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--files', type=int, default=2, help="Files open at once")
+        parser.add_argument('--clients', type=int, default=4, help="Editors per file")
+        parser.add_argument('--operations', type=int, default=200, help="Edits sent by each editor")
+        parser.add_argument(
+            '--interval', type=float, default=0.0,
+            help="Seconds an editor waits after each acknowledged edit",
+        )
+        parser.add_argument(
+            '--flush-interval', type=float, default=0.5,
+            help="Seconds between saves of the open files (COLLAB_FLUSH_INTERVAL in production)",
+        )
+        parser.add_argument('--seed', type=int, default=0, help="Seed for the generated edits")
+        parser.add_argument('--output', default=None, help="Write the JSON report to this file")
+        parser.add_argument(
+            '--keep', action='store_true',
+            help="Keep the generated users and project instead of deleting them afterwards",
+        )
+
+    def handle(self, *args, **options):
+        if min(options['files'], options['clients'], options['operations']) < 1:
+            raise CommandError("--files, --clients and --operations must be positive")
+        report = CollabLoadTest(
+            options['files'], options['clients'], options['operations'], options['interval'],
+            options['flush_interval'], seed=options['seed'], keep=options['keep'],
+        ).run()
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+            self.stderr.write(f"Wrote the report to {options['output']}")
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,63 @@
+import json
+from django.core.management.base import BaseCommand, CommandError
+from apps.files.benchmark import GENERATORS, CompileBenchmark
+
+
+def int_list(value):
+    return [int(part) for part in value.split(',') if part.strip()]
+
+
+class Command(BaseCommand):
+    help = (
+        "Compile synthetic projects (article, 300-page book, TikZ, bibliography) at several "
+        "concurrency levels and print latency percentiles, throughput and peak memory as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--projects', default=','.join(GENERATORS),
+            help=f"Comma separated project kinds ({', '.join(GENERATORS)})",
+        )
+        parser.add_argument(
+            '--concurrency', type=int_list, default=[1, 2, 4],
+            help="Comma separated numbers of concurrent users, e.g. 1,2,4",
+        )
+        parser.add_argument(
+            '--requests', type=int, default=8,
+            help="Compiles per project kind and concurrency level",
+        )
+        parser.add_argument(
+            '--mode', choices=['view', 'compiler', 'both'], default='view',
+            help="Go through ProjectViewSet.compile (cache, scheduler, worker pool) or call LatexCompiler directly",
+        )
+        parser.add_argument(
+            '--warm', action='store_true',
+            help="Leave the sources unchanged between requests, measuring compile cache hits",
+        )
+        parser.add_argument('--output', default=None, help="Write the JSON report to this file")
+        parser.add_argument(
+            '--keep', action='store_true',
+            help="Keep the generated users and projects instead of deleting them afterwards",
+        )
+
+    def handle(self, *args, **options):
+        kinds = [kind.strip() for kind in options['projects'].split(',') if kind.strip()]
+        unknown = [kind for kind in kinds if kind not in GENERATORS]
+        if unknown:
+            raise CommandError(f"Unknown project kinds: {', '.join(unknown)}")
+        levels = options['concurrency']
+        if not levels or min(levels) < 1:
+            raise CommandError("Concurrency levels must be positive integers")
+
+        modes = ['view', 'compiler'] if options['mode'] == 'both' else [options['mode']]
+        report = CompileBenchmark(
+            kinds, levels, max(1, options['requests']), modes, warm=options['warm'], keep=options['keep']
+        ).run()
+
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output + '\n')
+            self.stderr.write(f"Wrote {len(report['results'])} results to {options['output']}")
+        else:
+            self.stdout.write(output)
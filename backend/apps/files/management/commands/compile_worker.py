@@ -0,0 +1,49 @@
+import signal
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from apps.files.jobs import CompileWorker
+
+
+class Command(BaseCommand):
+    help = (
+        "Run compile jobs from the database queue (LATEX_COMPILE_QUEUE = 'database'). "
+        "Start one or more per node; each claims jobs with SELECT ... FOR UPDATE SKIP LOCKED."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency', type=int,
+            default=getattr(settings, 'LATEX_COMPILE_CONCURRENCY', 2),
+            help="Jobs to run at the same time in this process",
+        )
+        parser.add_argument(
+            '--poll-interval', type=float, default=1.0,
+            help="Seconds to wait before polling an empty queue again",
+        )
+        parser.add_argument(
+            '--worker-id', default=None,
+            help="Name recorded on claimed jobs (default: hostname:pid)",
+        )
+        parser.add_argument(
+            '--max-jobs', type=int, default=None,
+            help="Exit after this many jobs, e.g. to let a supervisor recycle the process",
+        )
+
+    def handle(self, *args, **options):
+        worker = CompileWorker(
+            worker_id=options['worker_id'],
+            concurrency=max(1, options['concurrency']),
+            poll_interval=options['poll_interval'],
+            max_jobs=options['max_jobs'],
+        )
+
+        def shutdown(signum, frame):
+            self.stdout.write("Finishing running jobs before exiting...")
+            worker.stop()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+
+        self.stdout.write(f"Compile worker {worker.worker_id} started with {worker.concurrency} slot(s)")
+        worker.run()
+        self.stdout.write(f"Compile worker {worker.worker_id} stopped")
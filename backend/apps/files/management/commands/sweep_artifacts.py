@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from apps.files.artifacts import get_artifact_store
+
+
+class Command(BaseCommand):
+    help = (
+        "Apply the compile artifact retention policy (LATEX_ARTIFACTS_PER_PROJECT, "
+        "LATEX_ARTIFACT_MAX_AGE) and delete stored files no compile references any more."
+    )
+
+    def handle(self, *args, **options):
+        removed = get_artifact_store().sweep()
+        self.stdout.write(
+            f"Removed {removed['rows']} compiles and {removed['files']} files ({removed['bytes']} bytes)"
+        )
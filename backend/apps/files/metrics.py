@@ -0,0 +1,60 @@
+import threading
+from collections import defaultdict
+
+# Simple in-process metrics registry for the compile pipeline.
+# Counters and timings are kept per worker process; they reset on restart.
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_timings = {}
+
+
+def incr(name, amount=1):
+    """Increment the counter called `name`"""
+    with _lock:
+        _counters[name] += amount
+
+
+def observe(name, seconds):
+    """Record a duration (in seconds) for the timing called `name`"""
+    with _lock:
+        timing = _timings.get(name)
+        if timing is None:
+            timing = _timings[name] = {'count': 0, 'total': 0.0, 'max': 0.0}
+        timing['count'] += 1
+        timing['total'] += seconds
+        timing['max'] = max(timing['max'], seconds)
+
+
+def snapshot():
+    """Return a JSON-serializable copy of every counter and timing"""
+    with _lock:
+        timings = {}
+        for name, timing in _timings.items():
+            timings[name] = dict(timing)
+            timings[name]['avg'] = timing['total'] / timing['count'] if timing['count'] else 0.0
+        return {
+            'counters': dict(_counters),
+            'timings': timings,
+        }
+
+
+def reset():
+    """Clear every counter and timing"""
+    with _lock:
+        _counters.clear()
+        _timings.clear()
+
+
+def merge(other):
+    """Add a snapshot() taken in another process (e.g. a compile worker) into this registry"""
+    with _lock:
+        for name, amount in other.get('counters', {}).items():
+            _counters[name] += amount
+        for name, timing in other.get('timings', {}).items():
+            mine = _timings.get(name)
+            if mine is None:
+                mine = _timings[name] = {'count': 0, 'total': 0.0, 'max': 0.0}
+            mine['count'] += timing['count']
+            mine['total'] += timing['total']
+            mine['max'] = max(mine['max'], timing['max'])
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-17 12:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0007_compilejob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='compilejob',
+            name='passes',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-17 12:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0008_compilejob_passes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='compilejob',
+            name='usage',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.1 on 2026-10-17 12:59
+
+from django.db import migrations, models
+from apps.files.deps import scan_dependencies, should_scan
+
+
+def scan_existing_files(apps, schema_editor):
+    File = apps.get_model('files', 'File')
+    for file in File.objects.only('id', 'name', 'content').iterator():
+        dependencies = scan_dependencies(file.content) if should_scan(file.name) else []
+        File.objects.filter(id=file.id).update(dependencies=dependencies)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0009_compilejob_usage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='dependencies',
+            field=models.JSONField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(scan_existing_files, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.1 on 2026-10-17 13:07
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0010_file_dependencies'),
+        ('projects', '0003_project_is_github_repo'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='compilejob',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='compilejob',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='compilejob',
+            name='worker_id',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name='compilejob',
+            index=models.Index(fields=['status', 'heartbeat_at'], name='files_compi_status_5248c8_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.1 on 2026-10-17 13:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0011_compilejob_worker_heartbeat'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='compilejob',
+            name='run_after',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='compilejob',
+            name='speculative',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterField(
+            model_name='compilejob',
+            name='status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('succeeded', 'Succeeded'), ('failed', 'Failed'), ('cancelled', 'Cancelled')], default='queued', max_length=20),
+        ),
+    ]
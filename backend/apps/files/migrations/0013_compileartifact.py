@@ -0,0 +1,46 @@
+# Generated by Django 5.2.1 on 2026-10-17 13:15
+
+import django.db.models.deletion
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0012_compilejob_speculative'),
+        ('projects', '0004_project_speculative_compile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CompileArtifact',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('cache_key', models.CharField(blank=True, max_length=64)),
+                ('success', models.BooleanField(default=False)),
+                ('passes', models.PositiveSmallIntegerField(default=0)),
+                ('seconds', models.FloatField(default=0)),
+                ('usage', models.JSONField(blank=True, default=dict)),
+                ('error', models.TextField(blank=True)),
+                ('pdf_digest', models.CharField(blank=True, max_length=64)),
+                ('log_digest', models.CharField(blank=True, max_length=64)),
+                ('synctex_digest', models.CharField(blank=True, max_length=64)),
+                ('sizes', models.JSONField(blank=True, default=dict)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('project', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='compile_artifacts', to='projects.project')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.AddField(
+            model_name='compilejob',
+            name='artifact',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='jobs', to='files.compileartifact'),
+        ),
+        migrations.AddIndex(
+            model_name='compileartifact',
+            index=models.Index(fields=['project', 'created_at'], name='files_compi_project_4a9aed_idx'),
+        ),
+    ]
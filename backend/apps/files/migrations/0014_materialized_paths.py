@@ -0,0 +1,54 @@
+# Generated by Django 5.2.1 on 2026-10-17 13:18
+
+from django.db import migrations, models
+
+
+def backfill_paths(apps, schema_editor):
+    Folder = apps.get_model('files', 'Folder')
+    File = apps.get_model('files', 'File')
+    project_ids = Folder.objects.values_list('project_id', flat=True).distinct()
+    for project_id in project_ids:
+        folders = {
+            folder.id: folder
+            for folder in Folder.objects.filter(project_id=project_id).only('id', 'name', 'parent_id')
+        }
+        paths = {}
+
+        def path_of(folder_id):
+            if folder_id not in paths:
+                folder = folders[folder_id]
+                parent_path = path_of(folder.parent_id) if folder.parent_id else None
+                paths[folder_id] = f"{parent_path}/{folder.name}" if parent_path else folder.name
+            return paths[folder_id]
+
+        for folder in folders.values():
+            folder.path = path_of(folder.id)
+        Folder.objects.bulk_update(folders.values(), ['path'], batch_size=500)
+
+        files = list(File.objects.filter(project_id=project_id, folder__isnull=False).only('id', 'name', 'folder_id'))
+        for file in files:
+            file.path = f"{paths[file.folder_id]}/{file.name}"
+        File.objects.bulk_update(files, ['path'], batch_size=500)
+    # Files at the project root
+    File.objects.filter(folder__isnull=True).update(path=models.F('name'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0013_compileartifact'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='file',
+            name='path',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=1024),
+        ),
+        migrations.AddField(
+            model_name='folder',
+            name='path',
+            field=models.CharField(db_index=True, default='', editable=False, max_length=1024),
+        ),
+        migrations.RunPython(backfill_paths, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.2.1 on 2026-10-17 13:20
+
+import hashlib
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def move_content_to_blobs(apps, schema_editor):
+    File = apps.get_model('files', 'File')
+    FileBlob = apps.get_model('files', 'FileBlob')
+    stored = set()
+    for file in File.objects.only('id', 'content').iterator():
+        encoded = file.content.encode('utf-8')
+        digest = hashlib.sha256(encoded).hexdigest()
+        if digest not in stored:
+            FileBlob.objects.get_or_create(hash=digest, defaults={'content': file.content, 'size': len(encoded)})
+            stored.add(digest)
+        File.objects.filter(id=file.id).update(blob_id=digest)
+
+
+def restore_content(apps, schema_editor):
+    File = apps.get_model('files', 'File')
+    for file in File.objects.filter(blob__isnull=False).select_related('blob').iterator():
+        File.objects.filter(id=file.id).update(content=file.blob.content)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0014_materialized_paths'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FileBlob',
+            fields=[
+                ('hash', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('content', models.TextField(blank=True)),
+                ('size', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='file',
+            name='blob',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='files', to='files.fileblob'),
+        ),
+        migrations.RunPython(move_content_to_blobs, restore_content),
+        migrations.RemoveField(
+            model_name='file',
+            name='content',
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.2.1 on 2026-10-17 15:02
+
+from django.db import migrations
+
+
+def clear_dependencies(apps, schema_editor):
+    # Stored lists predate theme, \import and candidate references;
+    # project_dependency_graph() rescans files whose list is NULL
+    File = apps.get_model('files', 'File')
+    File.objects.update(dependencies=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0015_file_blobs'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_dependencies, migrations.RunPython.noop),
+    ]
@@ -1,10 +1,22 @@
-from django.db import models
+import hashlib
+import uuid
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import Value
+from django.db.models.functions import Concat, Substr
+from django.contrib.auth.models import User
+from django.utils import timezone
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from apps.projects.models import Project
+from .deps import scan_dependencies, should_scan
 
 class Folder(models.Model):
     name = models.CharField(max_length=255)
     project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name='folders')
     parent = models.ForeignKey('self', null=True, blank=True, on_delete=models.CASCADE, related_name='subfolders')
+    # "parent/child/name" from the project root, kept in sync on save so
+    # subtrees are one indexed prefix query (see subtree_folders)
+    path = models.CharField(max_length=1024, db_index=True, editable=False, default='')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -19,23 +31,111 @@ class Folder(models.Model):
         ]
 
     def __str__(self):
-        if self.parent:
-            return f"{self.parent}/{self.name}"
-        return self.name
+        return self.full_path
 
     @property
     def full_path(self):
         """Returns the full path of the folder from project root"""
-        if self.parent:
-            return f"{self.parent.full_path}/{self.name}"
-        return self.name
+        return self.path or self.build_path()
+
+    def build_path(self):
+        if self.parent_id is None:
+            return self.name
+        # Read the parent's stored path rather than walking up the tree
+        parent_path = Folder.objects.filter(id=self.parent_id).values_list('path', flat=True).first()
+        return f"{parent_path}/{self.name}"
+
+    def save(self, *args, **kwargs):
+        old_path = self.path
+        self.path = self.build_path()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = set(update_fields) | {'path'}
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if old_path and old_path != self.path:
+                self.move_subtree(old_path)
+
+    def move_subtree(self, old_path):
+        """Rewrite the stored paths of everything below this folder after a rename or move"""
+        prefix = old_path + '/'
+        new_path = Concat(Value(self.path + '/'), Substr('path', len(prefix) + 1), output_field=models.CharField())
+        Folder.objects.filter(project_id=self.project_id, path__startswith=prefix).update(path=new_path)
+        File.objects.filter(project_id=self.project_id, path__startswith=prefix).update(path=new_path)
+
+    def subtree_folders(self):
+        """All folders below this one, at any depth"""
+        return Folder.objects.filter(project_id=self.project_id, path__startswith=self.path + '/')
+
+    def subtree_files(self):
+        """All files in this folder and the folders below it"""
+        return File.objects.filter(project_id=self.project_id, path__startswith=self.path + '/')
+
+class FileBlobManager(models.Manager):
+    def for_content(self, content):
+        """Return the blob holding `content`, storing it first if no file has this text yet"""
+        encoded = content.encode('utf-8')
+        blob = FileBlob(hash=hashlib.sha256(encoded).hexdigest(), content=content, size=len(encoded))
+        if not self.filter(hash=blob.hash).exists():
+            try:
+                with transaction.atomic():
+                    blob.save(force_insert=True)
+            except IntegrityError:
+                # Stored by a concurrent save of the same text
+                pass
+        return blob
+
+    def release(self, blob_hash):
+        """
+        Delete a blob once no file refers to it any more
+
+        The delete waits for the caller's transaction to commit, so a save
+        that is about to reuse the blob (see for_content) isn't undone by a
+        rollback, and it only goes ahead if no committed file uses the blob.
+        """
+        transaction.on_commit(lambda: self.delete_unused(blob_hash), using=self.db)
+
+    def delete_unused(self, blob_hash):
+        """Delete the blob `blob_hash` unless a file refers to it, in a single statement"""
+        connection = connections[self.db]
+        quote = connection.ops.quote_name
+        blob_table = quote(self.model._meta.db_table)
+        file_table = quote(self.model._meta.get_field('files').related_model._meta.db_table)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {blob_table} WHERE {quote('hash')} = %s"
+                f" AND NOT EXISTS (SELECT 1 FROM {file_table} WHERE {quote('blob_id')} = %s)",
+                [blob_hash, blob_hash],
+            )
+
+
+class FileBlob(models.Model):
+    """Text of a file, stored once and shared by every File with identical content"""
+    hash = models.CharField(max_length=64, primary_key=True)  # sha256 of the UTF-8 content
+    content = models.TextField(blank=True)
+    size = models.PositiveIntegerField(default=0)  # Bytes of UTF-8
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = FileBlobManager()
+
+    def __str__(self):
+        return self.hash
+
 
 class File(models.Model):
     name = models.CharField(max_length=255)
-    content = models.TextField(blank=True)
+    # The content lives in a FileBlob so metadata queries never load it;
+    # read and assign it through the `content` property
+    blob = models.ForeignKey(
+        FileBlob, on_delete=models.PROTECT, related_name='files', null=True, blank=True, editable=False
+    )
     project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name='files')
     folder = models.ForeignKey(Folder, on_delete=models.CASCADE, related_name='files', null=True, blank=True)
     is_main = models.BooleanField(default=False)  # Indicates if this is the main .tex file
+    # "folder/subfolder/name" from the project root, kept in sync on save (see Folder.path)
+    path = models.CharField(max_length=1024, db_index=True, editable=False, default='')
+    # Files referenced by this one, as [kind, target] pairs (see deps.py); null until scanned
+    dependencies = models.JSONField(null=True, blank=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -51,19 +151,105 @@ class File(models.Model):
             )
         ]
 
+    # Content assigned since the last save, written to a blob by save()
+    _new_content = None
+
     def __str__(self):
-        if self.folder:
-            return f"{self.folder}/{self.name}"
-        return self.name
+        return self.full_path
+
+    @property
+    def content(self):
+        """Text of the file; loads its blob on first access unless fetched with select_related('blob')"""
+        if self._new_content is not None:
+            return self._new_content
+        if self.blob_id is None:
+            return ''
+        return self.blob.content
+
+    @content.setter
+    def content(self, value):
+        self._new_content = value
+
+    def build_path(self):
+        if self.folder_id is None:
+            return self.name
+        folder_path = Folder.objects.filter(id=self.folder_id).values_list('path', flat=True).first()
+        return f"{folder_path}/{self.name}"
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            update_fields = set(update_fields)
+            if 'content' in update_fields:
+                # The row only stores which blob holds the content
+                update_fields = (update_fields - {'content'}) | {'blob'}
+        if self._state.adding and self.blob_id is None and self._new_content is None:
+            # Every file has a blob, so its hash can serve as the version of its content
+            self._new_content = ''
+        content_changed = self._new_content is not None and (update_fields is None or 'blob' in update_fields)
+        old_blob_id = self.blob_id
+        if content_changed:
+            self.blob = FileBlob.objects.for_content(self._new_content)
+            self._new_content = None
+
+        # Rescan on every content save so the project's dependency graph stays current
+        if content_changed or update_fields is None or 'name' in update_fields:
+            self.dependencies = scan_dependencies(self.content) if should_scan(self.name) else []
+            if update_fields is not None:
+                update_fields.add('dependencies')
+        if update_fields is None or {'name', 'folder', 'folder_id'} & update_fields:
+            self.path = self.build_path()
+            if update_fields is not None:
+                update_fields.add('path')
+        if update_fields is not None:
+            kwargs['update_fields'] = update_fields
+
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if content_changed and old_blob_id and old_blob_id != self.blob_id:
+                FileBlob.objects.release(old_blob_id)
+
+    def replace_content(self, base_hash, content):
+        """
+        Save new content only if the file still holds the blob `base_hash`
+
+        The check and the write are a single conditional UPDATE, so of two
+        saves made against the same version exactly one wins.
+
+        Returns:
+            bool: False if the content changed since `base_hash`
+        """
+        blob = FileBlob.objects.for_content(content)
+        dependencies = scan_dependencies(content) if should_scan(self.name) else []
+        updated_at = timezone.now()
+        with transaction.atomic():
+            updated = File.objects.filter(pk=self.pk, blob_id=base_hash).update(
+                blob=blob, dependencies=dependencies, updated_at=updated_at
+            )
+            if not updated:
+                FileBlob.objects.release(blob.hash)
+                return False
+            if base_hash != blob.hash:
+                FileBlob.objects.release(base_hash)
+        self.blob = blob
+        self._new_content = None
+        self.dependencies = dependencies
+        self.updated_at = updated_at
+        return True
 
     @property
     def full_path(self):
         """Returns the full path of the file from project root"""
-        if self.folder:
-            return f"{self.folder.full_path}/{self.name}"
-        return self.name
+        return self.path or self.build_path()
     
 
+# Drop the content of deleted files (including cascades from folders and projects)
+@receiver(post_delete, sender=File)
+def release_file_blob(sender, instance, **kwargs):
+    if instance.blob_id:
+        FileBlob.objects.release(instance.blob_id)
+
+
 # Add this new model after your existing File and Folder models
 class GitFile(models.Model):
     """Model representing a file from a Git repository"""
@@ -87,4 +273,75 @@ class GitFile(models.Model):
     def folder_path(self):
         """Returns just the directory portion of the path"""
         import os
-        return os.path.dirname(self.path)
\ No newline at end of file
+        return os.path.dirname(self.path)
+
+class CompileArtifact(models.Model):
+    """Outputs of one pdflatex run, kept for download after the build directory has moved on"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name='compile_artifacts')
+    cache_key = models.CharField(max_length=64, blank=True)  # Compile cache key of the sources
+    success = models.BooleanField(default=False)
+    passes = models.PositiveSmallIntegerField(default=0)
+    seconds = models.FloatField(default=0)  # Wall time of the compile
+    usage = models.JSONField(default=dict, blank=True)  # CPU/wall time and memory reported by the worker
+    error = models.TextField(blank=True)
+    # sha256 of each stored file in the artifact store (see artifacts.py), blank when not produced
+    pdf_digest = models.CharField(max_length=64, blank=True)
+    log_digest = models.CharField(max_length=64, blank=True)
+    synctex_digest = models.CharField(max_length=64, blank=True)
+    sizes = models.JSONField(default=dict, blank=True)  # Bytes per artifact kind
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['project', 'created_at']),
+        ]
+
+    def __str__(self):
+        return f"Artifacts of {self.project} ({self.created_at})"
+
+
+class CompileJob(models.Model):
+    """A queued request to compile a project, processed by a background worker"""
+    STATUS_CHOICES = (
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('succeeded', 'Succeeded'),
+        ('failed', 'Failed'),
+        ('cancelled', 'Cancelled'),
+    )
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    project = models.ForeignKey(Project, on_delete=models.CASCADE, related_name='compile_jobs')
+    requested_by = models.ForeignKey(User, on_delete=models.SET_NULL, related_name='compile_jobs', null=True, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    cache_key = models.CharField(max_length=64, blank=True)  # Compile cache entry holding the PDF
+    cache_hit = models.BooleanField(default=False)
+    passes = models.PositiveSmallIntegerField(default=0)  # pdflatex passes that ran
+    usage = models.JSONField(default=dict, blank=True)  # CPU/wall time and memory reported by the worker
+    error = models.TextField(blank=True)
+    # Set when a compile_worker process claims the job from the database queue
+    worker_id = models.CharField(max_length=255, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)  # Last sign of life from the worker
+    attempts = models.PositiveSmallIntegerField(default=0)  # Claims so far, including retries after a worker died
+    # Background compile started by a file save rather than the user; runs
+    # after requested jobs and is cancelled by the next save
+    speculative = models.BooleanField(default=False)
+    run_after = models.DateTimeField(null=True, blank=True)  # Not claimed before this time (save debounce)
+    artifact = models.ForeignKey(
+        CompileArtifact, on_delete=models.SET_NULL, related_name='jobs', null=True, blank=True
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['status', 'created_at']),
+            models.Index(fields=['status', 'heartbeat_at']),
+        ]
+
+    def __str__(self):
+        return f"Compile {self.project} ({self.status})"
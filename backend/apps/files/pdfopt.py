@@ -0,0 +1,79 @@
+import os
+import subprocess
+import time
+from django.conf import settings
+from .cache import hash_inputs
+from . import metrics
+
+# Linearize for fast first-page display and pack objects into compressed
+# object streams. --deterministic-id keeps the output reproducible, so the
+# optimized file is as content-addressed as the raw one.
+QPDF_COMMAND = [
+    'qpdf', '--linearize', '--object-streams=generate', '--compress-streams=y',
+    '--recompress-flate', '--deterministic-id',
+]
+
+
+def optimized_key(raw_key):
+    """Cache key of the optimized version of the PDF stored under `raw_key`"""
+    return hash_inputs('cotex-optimized-v1', raw_key)
+
+
+def optimize_pdf(cache, raw_key, raw_path):
+    """
+    Return an optimized copy of a cached PDF, building it with qpdf if needed
+
+    The result is stored in the same cache as the raw PDF.
+
+    Returns:
+        dict: key, path, original_size, optimized_size, seconds and cached,
+        or None if qpdf is unavailable or fails (callers serve the raw PDF)
+    """
+    key = optimized_key(raw_key)
+    original_size = os.path.getsize(raw_path)
+
+    path = cache.lookup(key)
+    if path is not None:
+        return {
+            'key': key,
+            'path': path,
+            'original_size': original_size,
+            'optimized_size': os.path.getsize(path),
+            'seconds': 0.0,
+            'cached': True,
+        }
+
+    output_path = cache.reserve()
+    started = time.monotonic()
+    try:
+        process = subprocess.run(
+            QPDF_COMMAND + [raw_path, output_path],
+            capture_output=True,
+            text=True,
+            timeout=getattr(settings, 'LATEX_OPTIMIZE_TIMEOUT', 60)
+        )
+        # qpdf exits with 3 when it succeeded with warnings
+        if process.returncode not in (0, 3):
+            metrics.incr('pdf_optimize.failures')
+            return None
+        seconds = time.monotonic() - started
+        optimized_size = os.path.getsize(output_path)
+        path = cache.commit(key, output_path)
+        output_path = None
+    except (OSError, subprocess.TimeoutExpired):
+        metrics.incr('pdf_optimize.failures')
+        return None
+    finally:
+        if output_path is not None:
+            cache.discard(output_path)
+
+    metrics.observe('pdf_optimize', seconds)
+    metrics.incr('pdf_optimize.bytes_saved', original_size - optimized_size)
+    return {
+        'key': key,
+        'path': path,
+        'original_size': original_size,
+        'optimized_size': optimized_size,
+        'seconds': round(seconds, 3),
+        'cached': False,
+    }
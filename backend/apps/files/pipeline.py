@@ -0,0 +1,371 @@
+import json
+import os
+import threading
+import time
+from contextlib import nullcontext
+from django.conf import settings
+from .artifacts import LOG_SUFFIX, SYNCTEX_SUFFIX, get_artifact_store
+from .cache import get_compile_cache, hash_inputs
+from .LaTeX import LatexCompiler
+from .deps import DependencyGraph, scan_dependencies, should_scan
+from .models import File
+from .pdfopt import optimize_pdf, optimized_key
+from .profiler import record_profile
+from .diagnostics import get_diagnostics_store
+from .synctex import SYNCTEX_DATA_SUFFIX, get_synctex_store
+from .scheduler import get_scheduler
+from .singleflight import SingleFlight
+from .workers import get_worker_pool
+from . import metrics
+
+
+class CompileOutcome:
+    """Result of compiling a project through the cache"""
+
+    def __init__(self, success, pdf_path=None, error=None, cache_key=None, cache_hit=False, passes=0,
+                 usage=None, joined=False, optimization=None, partial=False, profile=None,
+                 diagnostics=None, seconds=None, artifacts=None):
+        self.success = success
+        # Location of the PDF in the compile cache
+        self.pdf_path = pdf_path
+        self.error = error
+        self.cache_key = cache_key
+        # Cache key of the PDF at pdf_path, and so its ETag: cache_key, or
+        # the optimized copy's key after optimize_outcome()
+        self.pdf_key = cache_key
+        self.cache_hit = cache_hit
+        # pdflatex passes run for this result (0 when served from the cache)
+        self.passes = passes
+        # Resource usage reported by the compile worker, if one was used
+        self.usage = usage or {}
+        # True when this result came from an identical compile already in flight
+        self.joined = joined
+        # Sizes and timing of the linearize/compress step (see pdfopt.py), if requested
+        self.optimization = optimization
+        # True when only some chapters were typeset (\includeonly)
+        self.partial = partial
+        # Timing report of a profiled compile (see profiler.py)
+        self.profile = profile
+        # Errors and warnings from the log (see diagnostics.py); for cached
+        # results they are in the diagnostics store instead
+        self.diagnostics = diagnostics or []
+        # Wall time of the pdflatex run, None when none ran
+        self.seconds = seconds
+        # {kind: (digest, size)} of the outputs put in the artifact store
+        # (see artifacts.py), None when pdflatex didn't run here
+        self.artifacts = artifacts
+        # Set once record_artifact() saved the CompileArtifact row
+        self.artifact_id = None
+
+
+def project_dependency_graph(project):
+    """
+    Build the reference graph of a project from the stored per-file dependencies
+
+    Returns:
+        tuple: (main_name, graph) where main_name is None if no file is marked as main
+    """
+    main_name = None
+    edges = {}
+    rows = File.objects.filter(project=project).values_list('id', 'name', 'is_main', 'dependencies')
+    for file_id, name, is_main, dependencies in rows:
+        if dependencies is None:
+            # Written without File.save (e.g. a bulk import); scan it once now
+            content = File.objects.filter(id=file_id).values_list('blob__content', flat=True).first() or ''
+            dependencies = scan_dependencies(content) if should_scan(name) else []
+            File.objects.filter(id=file_id).update(dependencies=dependencies)
+        edges[name] = dependencies
+        if is_main:
+            main_name = name
+    return main_name, DependencyGraph(edges)
+
+
+def project_file_ids(project):
+    """
+    Map compile file names to File ids
+
+    The main file is always compiled as main.tex, whatever its name.
+    """
+    file_ids = {}
+    for file_id, name, is_main in File.objects.filter(project=project).values_list('id', 'name', 'is_main'):
+        if is_main:
+            file_ids['main.tex'] = file_id
+        else:
+            file_ids.setdefault(name, file_id)
+    return file_ids
+
+
+def load_project_sources(project):
+    """
+    Load the main file and the files it references.
+
+    Only files reachable from the main file in the dependency graph are
+    loaded, so edits to unreferenced files don't change the compile cache
+    key. Every file is loaded if the graph can't be resolved statically or
+    LATEX_SELECTIVE_SOURCES is False.
+
+    Returns:
+        tuple: (main_file, related_files) where related_files is a dict of
+        {filename: content}. main_file is None if no file is marked as main.
+    """
+    try:
+        main_file = File.objects.select_related('blob').get(project=project, is_main=True)
+    except File.DoesNotExist:
+        return None, {}
+
+    other_files = File.objects.filter(project=project, is_main=False)
+    if getattr(settings, 'LATEX_SELECTIVE_SOURCES', True):
+        _, graph = project_dependency_graph(project)
+        reachable, complete = graph.reachable(main_file.name)
+        if complete:
+            other_files = other_files.filter(name__in=reachable)
+            metrics.incr('sources.skipped', len(graph.edges) - len(reachable))
+        else:
+            metrics.incr('sources.dynamic_graphs')
+    # Names and content straight from the blob table, without building File objects
+    related_files = {name: content or '' for name, content in other_files.values_list('name', 'blob__content')}
+    metrics.incr('sources.loaded', len(related_files) + 1)
+    return main_file, related_files
+
+
+def project_compile_keys(project):
+    """
+    Compile cache keys of the project's current sources
+
+    Returns:
+        tuple: (full key, preview key), empty if no file is marked as main
+    """
+    main_file, related_files = load_project_sources(project)
+    if main_file is None:
+        return ()
+    compiler = get_settings_compiler()
+    return (
+        compile_cache_key(compiler, main_file.content, related_files),
+        compile_cache_key(compiler, main_file.content, related_files, preview=True),
+    )
+
+
+_compile_flight = None
+_compile_flight_lock = threading.Lock()
+_settings_compiler = None
+
+
+def get_compile_flight():
+    """Concurrent requests for the same inputs share one pdflatex run"""
+    global _compile_flight
+    if _compile_flight is None:
+        with _compile_flight_lock:
+            if _compile_flight is None:
+                base_dir = getattr(settings, 'LATEX_TEMP_DIR', '/tmp/cotex')
+                _compile_flight = SingleFlight('compile_flight', os.path.join(base_dir, 'locks', 'compile'))
+    return _compile_flight
+
+
+def get_settings_compiler():
+    """A shared LatexCompiler, only used to read its settings for cache keys"""
+    global _settings_compiler
+    if _settings_compiler is None:
+        _settings_compiler = LatexCompiler()
+    return _settings_compiler
+
+
+def compile_cache_key(compiler, main_tex_content, related_files, preview=False, include_only=None):
+    """Hash of every compile input: main file, related files and compiler settings"""
+    settings_fingerprint = compiler.settings_fingerprint()
+    if preview:
+        settings_fingerprint['preview'] = True
+    if include_only:
+        settings_fingerprint['include_only'] = sorted(include_only)
+    parts = [
+        # v2: PDFs built from formats that had lost the preamble's last line
+        'cotex-compile-v2',
+        json.dumps(settings_fingerprint, sort_keys=True),
+        main_tex_content,
+    ]
+    for filename in sorted(related_files):
+        parts.append(filename)
+        parts.append(related_files[filename])
+    return hash_inputs(*parts)
+
+
+def lookup_compiled_pdf(main_tex_content, related_files):
+    """
+    Find the cached PDF for these sources without compiling
+
+    Returns:
+        tuple: (cache_key, pdf_path) where pdf_path is None if not compiled yet
+    """
+    key = compile_cache_key(get_settings_compiler(), main_tex_content, related_files)
+    return key, get_compile_cache().lookup(key)
+
+
+def compile_sources(main_tex_content, related_files, compiler=None, build_key=None, preview=False,
+                    optimize=False, include_only=None, profile=False, user_id=None, admission=True,
+                    speculative=False):
+    """
+    Compile the given sources, returning a cached PDF when the inputs are unchanged.
+
+    `build_key` selects a persistent build directory (see LatexCompiler.compile_latex).
+    Compiles run on the worker pool (see workers.py) unless a `compiler` is
+    given or LATEX_WORKER_POOL is False. `preview` builds a fast single-pass
+    draft PDF, cached separately from the full PDF. `optimize` serves a
+    linearized, object-stream compressed copy (see optimize_outcome).
+    `include_only` typesets only the listed \\include'd chapters (see
+    LatexCompiler.compile_latex). `profile` always runs pdflatex, bypassing
+    the cache lookup, and attaches a timing report to the outcome.
+
+    Cache misses wait for a slot from the compile scheduler (see
+    scheduler.py), shared fairly between users; `build_key` is the project
+    for its per-project limit. With `admission`, a full queue raises
+    SchedulerBusy instead of waiting. `speculative` compiles only run on
+    an idle slot and raise SchedulerBusy otherwise.
+    """
+    use_pool = compiler is None and getattr(settings, 'LATEX_WORKER_POOL', True)
+    cache = get_compile_cache()
+    key = compile_cache_key(
+        compiler or get_settings_compiler(), main_tex_content, related_files, preview, include_only
+    )
+
+    scheduler = get_scheduler()
+
+    if profile:
+        with scheduler.slot(user_id, build_key, admission):
+            outcome = run_compile(
+                cache, key, main_tex_content, related_files, compiler, use_pool, build_key, preview,
+                include_only, profile=True
+            )
+        return optimize_outcome(outcome) if optimize else outcome
+
+    pdf_path = cache.lookup(key)
+    if pdf_path is not None:
+        outcome = CompileOutcome(True, pdf_path=pdf_path, cache_key=key, cache_hit=True)
+        return optimize_outcome(outcome) if optimize else outcome
+
+    flight = get_compile_flight()
+
+    def build(slot):
+        with slot, flight.key_lock(key):
+            # Another process may have finished this exact build while we
+            # waited for the lock
+            pdf_path = cache.lookup(key, record_stats=False)
+            if pdf_path is not None:
+                metrics.incr('compile_flight.cross_process_joins')
+                return CompileOutcome(True, pdf_path=pdf_path, cache_key=key, joined=True)
+            return run_compile(
+                cache, key, main_tex_content, related_files, compiler, use_pool, build_key, preview,
+                include_only
+            )
+
+    if speculative:
+        # Take the slot before leading the flight, so requested compiles that
+        # join this build never see the speculative lane's SchedulerBusy
+        with scheduler.slot(user_id, build_key, speculative=True):
+            outcome, joined = flight.do(key, lambda: build(nullcontext()))
+    else:
+        outcome, joined = flight.do(key, lambda: build(scheduler.slot(user_id, build_key, admission)))
+    if joined:
+        outcome.joined = True
+    return optimize_outcome(outcome) if optimize else outcome
+
+
+def optimize_outcome(outcome):
+    """
+    Point a successful outcome at the optimized copy of its PDF
+
+    The optimized PDF is cached next to the raw one under a key derived from
+    the raw key, so it's built once per distinct output. If qpdf is missing
+    or fails, the raw PDF is served unchanged.
+
+    `cache_key` stays the raw key, which diagnostics and SyncTeX data are
+    stored under; `pdf_key` becomes the optimized copy's key, so the two
+    byte streams never share an ETag.
+    """
+    if not outcome.success:
+        return outcome
+    cache = get_compile_cache()
+    with get_compile_flight().key_lock(optimized_key(outcome.cache_key)):
+        try:
+            optimization = optimize_pdf(cache, outcome.cache_key, outcome.pdf_path)
+        except FileNotFoundError:
+            # The raw PDF was evicted under us; serve it as-is (the view reports 410)
+            return outcome
+    if optimization is None:
+        return outcome
+    outcome.pdf_path = optimization.pop('path')
+    outcome.pdf_key = optimization['key']
+    outcome.optimization = optimization
+    return outcome
+
+
+def run_compile(cache, key, main_tex_content, related_files, compiler, use_pool, build_key, preview=False,
+                include_only=None, profile=False):
+    """Run pdflatex for a cache miss and store the PDF"""
+    # The PDF is written straight into the cache directory, never into memory
+    output_path = reserved_path = cache.reserve()
+    started = time.monotonic()
+    try:
+        if use_pool:
+            run = get_worker_pool().compile(
+                main_tex_content, related_files, build_key=build_key, output_path=output_path,
+                preview=preview, include_only=include_only, profile=profile
+            )
+            success, result, passes, usage = run['success'], run['result'], run['passes'], run['usage']
+            partial, report, diagnostics = run['partial'], run['profile'], run['diagnostics']
+        else:
+            compiler = compiler or LatexCompiler()
+            success, result = compiler.compile_latex(
+                main_tex_content, related_files, build_key=build_key, output_path=output_path,
+                preview=preview, include_only=include_only, profile=profile
+            )
+            passes, usage, partial, report = compiler.passes, None, compiler.partial, compiler.profile
+            diagnostics = compiler.diagnostics
+        seconds = time.monotonic() - started
+        metrics.observe('compile.latex', seconds)
+        metrics.incr('compile.passes', passes)
+        if report is not None:
+            record_profile(report)
+        artifacts = collect_artifacts(output_path, success)
+
+        if not success:
+            metrics.incr('compile.failures')
+            return CompileOutcome(
+                False, error=result, cache_key=key, passes=passes, usage=usage, profile=report,
+                diagnostics=diagnostics, seconds=seconds, artifacts=artifacts
+            )
+
+        get_diagnostics_store().put(key, diagnostics)
+        if os.path.exists(output_path + SYNCTEX_DATA_SUFFIX):
+            get_synctex_store().put_data(key, output_path + SYNCTEX_DATA_SUFFIX)
+        pdf_path = cache.commit(key, output_path)
+        output_path = None
+        return CompileOutcome(
+            True, pdf_path=pdf_path, cache_key=key, passes=passes, usage=usage, partial=partial,
+            profile=report, diagnostics=diagnostics, seconds=seconds, artifacts=artifacts
+        )
+    finally:
+        for suffix in (SYNCTEX_DATA_SUFFIX, LOG_SUFFIX, SYNCTEX_SUFFIX):
+            cache.discard(reserved_path + suffix)
+        if output_path is not None:
+            cache.discard(output_path)
+
+
+def collect_artifacts(output_path, success):
+    """Put a compile's PDF, log and SyncTeX into the artifact store (see artifacts.py)"""
+    if not getattr(settings, 'LATEX_ARTIFACTS', True):
+        return None
+    try:
+        return get_artifact_store().collect(output_path, success)
+    except OSError:
+        # Losing the downloadable copies must not fail the compile
+        metrics.incr('artifacts.errors')
+        return None
+
+
+def compile_flight_stats():
+    """How many compile requests ran pdflatex vs. joined an identical in-flight build"""
+    counters = metrics.snapshot()['counters']
+    return {
+        'leaders': counters.get('compile_flight.leaders', 0),
+        'joins': counters.get('compile_flight.joins', 0),
+        'cross_process_joins': counters.get('compile_flight.cross_process_joins', 0),
+    }
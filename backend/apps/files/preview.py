@@ -0,0 +1,134 @@
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from django.conf import settings
+from .cache import DiskLRUCache, hash_inputs
+from . import metrics
+
+PAGES_RE = re.compile(r'^Pages:\s+(\d+)\s*$', re.MULTILINE)
+
+
+def parse_page_list(value, limit=20):
+    """
+    Parse a page selection such as "1-3,7" into a sorted list of page numbers
+
+    Raises:
+        ValueError: If the selection is malformed or selects more than `limit` pages
+    """
+    pages = set()
+    for part in str(value).split(','):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            if '-' in part:
+                first, last = (int(n) for n in part.split('-', 1))
+            else:
+                first = last = int(part)
+        except ValueError:
+            raise ValueError(f"Invalid page selection: {part}")
+        if first < 1 or last < first:
+            raise ValueError(f"Invalid page selection: {part}")
+        if last - first >= limit:
+            raise ValueError(f"At most {limit} pages can be rendered per request")
+        pages.update(range(first, last + 1))
+        if len(pages) > limit:
+            raise ValueError(f"At most {limit} pages can be rendered per request")
+    if not pages:
+        raise ValueError("No pages selected")
+    return sorted(pages)
+
+
+class PreviewRenderer:
+    """
+    Renders single PDF pages to PNG tiles with pdftoppm.
+
+    Tiles are cached by the content-addressed key of the PDF plus page number
+    and resolution, so scrolling back to a page, or another user viewing the
+    same document, costs a file lookup. Page counts are cached by PDF key
+    too, so repeated previews don't run pdfinfo.
+    """
+
+    def __init__(self, cache_dir, max_bytes, dpi, page_count_dir=None):
+        self.tiles = DiskLRUCache('preview_tiles', cache_dir, max_bytes, suffix='.png')
+        self.page_counts = DiskLRUCache(
+            'preview_page_counts', page_count_dir or cache_dir + '-pages', 16 * 1024 * 1024, suffix='.pages'
+        )
+        self.dpi = dpi
+
+    def tile_key(self, pdf_key, page, dpi):
+        return hash_inputs('cotex-tile-v1', pdf_key, str(page), str(dpi))
+
+    def page_count(self, pdf_key, pdf_path):
+        """Number of pages in the PDF stored under `pdf_key`, or None if pdfinfo can't tell"""
+        cached = self.page_counts.get(pdf_key)
+        if cached is not None:
+            return int(cached)
+        try:
+            process = subprocess.run(['pdfinfo', pdf_path], capture_output=True, text=True, timeout=30)
+        except (OSError, subprocess.TimeoutExpired):
+            return None
+        match = PAGES_RE.search(process.stdout)
+        if match is None:
+            return None
+        self.page_counts.put(pdf_key, match.group(1).encode())
+        return int(match.group(1))
+
+    def render_page(self, pdf_key, pdf_path, page, dpi=None):
+        """
+        Return the path of the PNG tile for `page`, rendering it if needed
+
+        Returns None if the page could not be rendered (e.g. out of range).
+        """
+        dpi = dpi or self.dpi
+        key = self.tile_key(pdf_key, page, dpi)
+        path = self.tiles.lookup(key)
+        if path is not None:
+            return path
+        if pdf_path is None:
+            return None
+
+        started = time.monotonic()
+        render_dir = tempfile.mkdtemp(dir=os.path.dirname(self.tiles.cache_dir))
+        try:
+            prefix = os.path.join(render_dir, 'page')
+            process = subprocess.run(
+                ['pdftoppm', '-png', '-r', str(dpi), '-f', str(page), '-l', str(page),
+                 '-singlefile', pdf_path, prefix],
+                capture_output=True,
+                timeout=60
+            )
+            if process.returncode != 0 or not os.path.exists(prefix + '.png'):
+                metrics.incr('preview_tiles.render_failures')
+                return None
+            metrics.incr('preview_tiles.renders')
+            return self.tiles.put_file(key, prefix + '.png')
+        except (OSError, subprocess.TimeoutExpired):
+            metrics.incr('preview_tiles.render_failures')
+            return None
+        finally:
+            metrics.observe('preview_tiles.render', time.monotonic() - started)
+            shutil.rmtree(render_dir, ignore_errors=True)
+
+
+_renderer = None
+_renderer_lock = threading.Lock()
+
+
+def get_preview_renderer():
+    """Return the process-wide preview tile renderer"""
+    global _renderer
+    if _renderer is None:
+        with _renderer_lock:
+            if _renderer is None:
+                base_dir = getattr(settings, 'LATEX_TEMP_DIR', '/tmp/cotex')
+                _renderer = PreviewRenderer(
+                    os.path.join(base_dir, 'cache', 'tiles'),
+                    getattr(settings, 'LATEX_PREVIEW_CACHE_MAX_BYTES', 512 * 1024 * 1024),
+                    getattr(settings, 'LATEX_PREVIEW_DPI', 96),
+                )
+    return _renderer
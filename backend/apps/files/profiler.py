@@ -0,0 +1,122 @@
+import os
+import re
+from . import metrics
+
+# Prepended to the pdflatex input in profiling mode. LaTeX's file hooks log
+# \pdfelapsedtime (in 1/65536 s) around every file it loads, packages and
+# classes included. Kernels without hooks skip this and only get the file list.
+PROFILE_HOOKS = (
+    r'\ifdefined\AddToHook'
+    r'\pdfresettimer'
+    r'\AddToHook{file/before}{\wlog{cotex-profile:begin:\the\pdfelapsedtime:\CurrentFile}}'
+    r'\AddToHook{file/after}{\wlog{cotex-profile:end:\the\pdfelapsedtime:\CurrentFile}}'
+    r'\fi'
+)
+
+PROFILE_LINE_RE = re.compile(r'^cotex-profile:(begin|end):(\d+):(.*)$', re.MULTILINE)
+OPENED_FILE_RE = re.compile(r'\(((?:\./|/)[^\s()]+\.(?:tex|sty|cls|cfg|def|clo|fd|bbl))')
+OUTPUT_RE = re.compile(r'Output written on .*? \((\d+) pages?, (\d+) bytes\)')
+FONT_RE = re.compile(r'<([^<>\s]+\.(?:pfb|pfa|otf|ttf|ttc))>')
+
+FILE_KINDS = {'.sty': 'package', '.cls': 'class', '.tex': 'input', '.bbl': 'bibliography'}
+
+
+def file_kind(name):
+    return FILE_KINDS.get(os.path.splitext(name)[1], 'support')
+
+
+def parse_file_timings(log):
+    """
+    Per-file load times from the profile markers in a pdflatex log
+
+    Returns:
+        list: {name, kind, seconds, self_seconds, loads} dicts, slowest first.
+        `seconds` includes files loaded from within the file, `self_seconds`
+        doesn't. Empty if the log has no markers.
+    """
+    totals = {}
+    stack = []
+    for event, ticks, name in PROFILE_LINE_RE.findall(log):
+        elapsed = int(ticks) / 65536
+        if event == 'begin':
+            stack.append([name.strip(), elapsed, 0.0])
+            continue
+        if not stack:
+            continue
+        name, started, children = stack.pop()
+        seconds = elapsed - started
+        if stack:
+            stack[-1][2] += seconds
+        entry = totals.setdefault(name, {
+            'name': name, 'kind': file_kind(name), 'seconds': 0.0, 'self_seconds': 0.0, 'loads': 0,
+        })
+        entry['seconds'] += seconds
+        entry['self_seconds'] += seconds - children
+        entry['loads'] += 1
+
+    files = sorted(totals.values(), key=lambda entry: entry['seconds'], reverse=True)
+    for entry in files:
+        entry['seconds'] = round(entry['seconds'], 4)
+        entry['self_seconds'] = round(entry['self_seconds'], 4)
+    return files
+
+
+def parse_opened_files(log):
+    """Files pdflatex opened, in order, without timings"""
+    files = []
+    for path in OPENED_FILE_RE.findall(log):
+        name = os.path.basename(path)
+        if not any(entry['name'] == name for entry in files):
+            files.append({'name': name, 'kind': file_kind(name), 'seconds': None, 'self_seconds': None,
+                          'loads': 1})
+    return files
+
+
+def build_report(log, pass_stats, used_format):
+    """
+    Assemble the profile of one compile
+
+    Args:
+        log (str): The .log of the last pdflatex pass
+        pass_stats (list): {pass, wall_seconds, cpu_seconds, returncode} per pass
+        used_format (bool): Whether the preamble came from a cached format,
+            in which case its packages don't show up in the file timings
+    """
+    files = parse_file_timings(log) or parse_opened_files(log)
+    output = OUTPUT_RE.search(log)
+    fonts = sorted({os.path.basename(font) for font in FONT_RE.findall(log)})
+    return {
+        'passes': pass_stats,
+        'wall_seconds': round(sum(p['wall_seconds'] for p in pass_stats), 3),
+        'cpu_seconds': round(sum(p['cpu_seconds'] for p in pass_stats), 3),
+        'used_format': used_format,
+        'files': files,
+        'packages': [entry['name'] for entry in files if entry['kind'] in ('package', 'class')],
+        'pages': int(output.group(1)) if output else None,
+        'pdf_bytes': int(output.group(2)) if output else None,
+        'fonts': fonts,
+        'font_count': len(fonts),
+    }
+
+
+def record_profile(report):
+    """
+    Aggregate a profile report into the server-side metrics
+
+    File load times are summed per kind (package, class, input, ...).
+    File names are user data and would make one series per file, so the
+    per-file breakdown stays in the report returned for the compile.
+    """
+    metrics.incr('profile.compiles')
+    for stats in report['passes']:
+        metrics.observe('profile.pass_wall', stats['wall_seconds'])
+        metrics.observe('profile.pass_cpu', stats['cpu_seconds'])
+    if report['pages'] is not None:
+        metrics.incr('profile.pages', report['pages'])
+    metrics.incr('profile.fonts', report['font_count'])
+    kinds = {}
+    for entry in report['files']:
+        if entry['self_seconds'] is not None:
+            kinds[entry['kind']] = kinds.get(entry['kind'], 0.0) + entry['self_seconds']
+    for kind, seconds in kinds.items():
+        metrics.observe(f'profile.{kind}_seconds', seconds)
@@ -0,0 +1,108 @@
+import os
+import re
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.http import parse_etags, quote_etag
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+CHUNK_SIZE = 64 * 1024
+
+
+def _read_range(f, start, length):
+    try:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+def parse_range(header, size):
+    """
+    Parse a single-range `Range: bytes=...` header
+
+    Returns:
+        tuple: (start, end) inclusive, None to serve the whole file (absent or
+        unsupported header, e.g. multiple ranges), or False if the range
+        can't be satisfied
+    """
+    if not header:
+        return None
+    match = RANGE_RE.match(header.strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if start >= size or end < start:
+        return False
+    return start, min(end, size - 1)
+
+
+def file_response(request, path, content_type, filename=None, etag=None):
+    """
+    Stream a file from disk with ETag revalidation and HTTP Range support
+
+    Args:
+        request: The incoming request (its If-None-Match, Range and If-Range
+            headers are honoured)
+        path (str): File to serve
+        content_type (str): MIME type of the file
+        filename (str): Optional attachment file name
+        etag (str): Optional unquoted entity tag, e.g. a content hash
+
+    Raises:
+        FileNotFoundError: If the file does not exist (e.g. it was evicted)
+    """
+    quoted_etag = quote_etag(etag) if etag else None
+
+    if quoted_etag:
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match and (quoted_etag in parse_etags(if_none_match) or if_none_match.strip() == '*'):
+            response = HttpResponse(status=304)
+            response['ETag'] = quoted_etag
+            return response
+
+    f = open(path, 'rb')
+    size = os.fstat(f.fileno()).st_size
+
+    byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if byte_range and if_range and if_range != quoted_etag:
+        # The client's copy is stale, send the whole new file
+        byte_range = None
+
+    if byte_range is False:
+        f.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+    elif byte_range:
+        start, end = byte_range
+        length = end - start + 1
+        response = StreamingHttpResponse(_read_range(f, start, length), status=206, content_type=content_type)
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = str(length)
+    else:
+        # FileResponse uses the server's file wrapper (sendfile) when available
+        response = FileResponse(f, content_type=content_type)
+        response['Content-Length'] = str(size)
+
+    response['Accept-Ranges'] = 'bytes'
+    if quoted_etag:
+        response['ETag'] = quoted_etag
+        # Always revalidate; unchanged PDFs come back as a cheap 304
+        response['Cache-Control'] = 'private, no-cache'
+    if filename:
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
@@ -0,0 +1,243 @@
+import itertools
+import math
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from django.conf import settings
+from . import metrics
+
+# Used for Retry-After estimates until real compile timings are available
+DEFAULT_COMPILE_SECONDS = 5.0
+
+
+class SchedulerBusy(Exception):
+    """Raised when a compile can't be admitted; `retry_after` is a hint in seconds"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    def __init__(self, user_id, project_id, start, finish, seq):
+        self.user_id = user_id
+        self.project_id = project_id
+        self.start = start
+        self.finish = finish
+        self.seq = seq
+        self.granted = False
+        self.enqueued_at = time.monotonic()
+
+
+class FairScheduler:
+    """
+    Admission control and weighted fair queuing for compiles in this process.
+
+    At most `slots` compiles run at once, with at most `user_limit` per
+    user and `project_limit` per project. Waiting compiles are ordered by
+    virtual finish time (start + 1 / weight of the user), so a user who
+    submits many compiles only gets their weighted share of the slots
+    while others are waiting. When the queue is full, callers are rejected
+    straight away with a Retry-After estimate instead of piling up.
+
+    Speculative compiles (see jobs.schedule_speculative_compile) use a
+    separate lane: they never queue, only start when nobody is waiting,
+    and always leave `reserved` slots free for requested compiles.
+    """
+
+    def __init__(self, slots, user_limit, project_limit, max_queue, user_queue, max_wait, weights=None,
+                 reserved=1):
+        self.slots = slots
+        self.user_limit = user_limit
+        self.project_limit = project_limit
+        self.max_queue = max_queue
+        self.user_queue = user_queue
+        self.max_wait = max_wait
+        self.weights = weights or {}
+        self.reserved = min(reserved, slots - 1)
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._running = 0
+        self._running_users = Counter()
+        self._running_projects = Counter()
+        self._speculative = 0
+        self._virtual_time = 0.0
+        self._user_finish = {}
+        self._seq = itertools.count()
+        self._release_callbacks = []
+
+    def on_release(self, callback):
+        """Call `callback()` (outside the scheduler lock) every time a compile slot is released"""
+        with self._cond:
+            self._release_callbacks.append(callback)
+
+    def _released(self):
+        with self._cond:
+            callbacks = list(self._release_callbacks)
+        for callback in callbacks:
+            callback()
+
+    def weight(self, user_id):
+        return max(float(self.weights.get(str(user_id), 1)), 0.01)
+
+    def retry_after(self):
+        """Rough seconds until a new compile could start, from recent compile times"""
+        timing = metrics.snapshot()['timings'].get('compile.latex')
+        average = timing['avg'] if timing else DEFAULT_COMPILE_SECONDS
+        return max(1, math.ceil(average * (len(self._waiting) + 1) / self.slots))
+
+    @contextmanager
+    def slot(self, user_id, project_id, admission=True, speculative=False):
+        """
+        Hold a compile slot for the duration of the block
+
+        Args:
+            user_id: Requesting user (None for anonymous/system compiles)
+            project_id: Project being compiled
+            admission (bool): Reject with SchedulerBusy when the queue is
+                full or no slot frees up within max_wait. Background jobs
+                pass False; they are already queued in the database and
+                wait for their fair turn however long it takes.
+            speculative (bool): Take an idle slot in the low-priority lane.
+                Doesn't count towards the user and project limits, so it
+                never holds back the user's own compiles.
+
+        Raises:
+            SchedulerBusy: If the compile wasn't admitted
+        """
+        if speculative:
+            self._take_idle_slot()
+            try:
+                yield
+            finally:
+                self._release_idle_slot()
+            return
+        waiter = self._enqueue(user_id, project_id, admission)
+        self._wait(waiter, self.max_wait if admission else None)
+        metrics.observe('scheduler.wait', time.monotonic() - waiter.enqueued_at)
+        try:
+            yield
+        finally:
+            self._release(waiter)
+
+    def _enqueue(self, user_id, project_id, admission):
+        with self._cond:
+            if admission:
+                queued_for_user = sum(1 for waiter in self._waiting if waiter.user_id == user_id)
+                if len(self._waiting) >= self.max_queue or queued_for_user >= self.user_queue:
+                    metrics.incr('scheduler.rejected')
+                    raise SchedulerBusy("Too many compiles are queued, try again shortly", self.retry_after())
+            start = max(self._virtual_time, self._user_finish.get(user_id, 0.0))
+            finish = start + 1 / self.weight(user_id)
+            self._user_finish[user_id] = finish
+            waiter = _Waiter(user_id, project_id, start, finish, next(self._seq))
+            self._waiting.append(waiter)
+            metrics.incr('scheduler.enqueued')
+            self._dispatch()
+            return waiter
+
+    def has_idle_slot(self):
+        """Whether a speculative compile would be admitted right now"""
+        with self._cond:
+            return not self._waiting and self._running + self.reserved < self.slots
+
+    def _take_idle_slot(self):
+        with self._cond:
+            if self._waiting or self._running + self.reserved >= self.slots:
+                metrics.incr('scheduler.speculative_skipped')
+                raise SchedulerBusy("No idle compile slot", self.retry_after())
+            self._running += 1
+            self._speculative += 1
+
+    def _release_idle_slot(self):
+        with self._cond:
+            self._running -= 1
+            self._speculative -= 1
+            self._dispatch()
+        self._released()
+
+    def _eligible(self, waiter):
+        return (
+            self._running_users[waiter.user_id] < self.user_limit
+            and self._running_projects[waiter.project_id] < self.project_limit
+        )
+
+    def _dispatch(self):
+        """Grant free slots to the eligible waiters with the earliest finish times"""
+        granted = False
+        while self._running < self.slots:
+            candidates = [waiter for waiter in self._waiting if self._eligible(waiter)]
+            if not candidates:
+                break
+            waiter = min(candidates, key=lambda w: (w.finish, w.seq))
+            self._waiting.remove(waiter)
+            waiter.granted = True
+            self._running += 1
+            self._running_users[waiter.user_id] += 1
+            self._running_projects[waiter.project_id] += 1
+            self._virtual_time = max(self._virtual_time, waiter.start)
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
+    def _wait(self, waiter, timeout):
+        with self._cond:
+            if self._cond.wait_for(lambda: waiter.granted, timeout=timeout):
+                return
+            self._waiting.remove(waiter)
+            metrics.incr('scheduler.timeouts')
+            raise SchedulerBusy("Timed out waiting for a compile slot", self.retry_after())
+
+    def _release(self, waiter):
+        with self._cond:
+            self._running -= 1
+            self._running_users[waiter.user_id] -= 1
+            if not self._running_users[waiter.user_id]:
+                del self._running_users[waiter.user_id]
+            self._running_projects[waiter.project_id] -= 1
+            if not self._running_projects[waiter.project_id]:
+                del self._running_projects[waiter.project_id]
+            self._dispatch()
+        self._released()
+
+    def stats(self):
+        counters = metrics.snapshot()['counters']
+        with self._cond:
+            waiting_users = Counter(str(waiter.user_id) for waiter in self._waiting)
+            stats = {
+                'slots': self.slots,
+                'running': self._running,
+                'speculative': self._speculative,
+                'queued': len(self._waiting),
+                'max_queue': self.max_queue,
+                'running_by_user': {str(user): count for user, count in self._running_users.items()},
+                'queued_by_user': dict(waiting_users),
+            }
+        stats['rejected'] = counters.get('scheduler.rejected', 0)
+        stats['timeouts'] = counters.get('scheduler.timeouts', 0)
+        stats['wait'] = metrics.snapshot()['timings'].get('scheduler.wait')
+        return stats
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Return the process-wide compile scheduler"""
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = FairScheduler(
+                    slots=getattr(settings, 'LATEX_SCHEDULER_SLOTS', getattr(settings, 'LATEX_WORKER_PROCESSES', 2)),
+                    user_limit=getattr(settings, 'LATEX_USER_CONCURRENCY', 1),
+                    project_limit=getattr(settings, 'LATEX_PROJECT_CONCURRENCY', 1),
+                    max_queue=getattr(settings, 'LATEX_SCHEDULER_QUEUE', 32),
+                    user_queue=getattr(settings, 'LATEX_USER_QUEUE', 4),
+                    max_wait=getattr(settings, 'LATEX_SCHEDULER_MAX_WAIT', 60),
+                    weights=getattr(settings, 'LATEX_SCHEDULER_WEIGHTS', {}),
+                    reserved=getattr(settings, 'LATEX_SPECULATIVE_RESERVED_SLOTS', 1),
+                )
+    return _scheduler
@@ -1,9 +1,13 @@
 from rest_framework import serializers
-from .models import File, Folder, GitFile
+from .models import File, Folder, GitFile, CompileJob, CompileArtifact
 
 
 class FileSerializer(serializers.ModelSerializer):
     folder = serializers.SerializerMethodField()
+    # Stored in a FileBlob; see File.content
+    content = serializers.CharField(allow_blank=True, required=False, trim_whitespace=False)
+    # Version of the content, the base for FileViewSet.edits
+    hash = serializers.CharField(source='blob_id', read_only=True)
 
     def get_folder(self, obj): 
         if obj.folder: 
@@ -15,7 +19,14 @@ class FileSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = File
-        fields = ['id', 'name', 'content', 'is_main', 'created_at', 'updated_at', 'folder']
+        fields = ['id', 'name', 'path', 'content', 'hash', 'is_main', 'created_at', 'updated_at', 'folder']
+
+
+class FileMetadataSerializer(FileSerializer):
+    """FileSerializer without the content, for listings"""
+
+    class Meta(FileSerializer.Meta):
+        fields = [name for name in FileSerializer.Meta.fields if name != 'content']
 
 
 class GitFileSerializer(serializers.ModelSerializer):
@@ -47,4 +58,27 @@ class FolderSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = Folder
-        fields = ['id', 'name', 'parent', 'project', 'files', 'created_at', 'updated_at', 'file_count']
\ No newline at end of file
+        fields = ['id', 'name', 'path', 'parent', 'project', 'files', 'created_at', 'updated_at', 'file_count']
+
+
+class CompileJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = CompileJob
+        fields = ['id', 'project', 'status', 'speculative', 'cache_hit', 'passes', 'usage', 'error', 'attempts',
+                  'artifact',
+                  'created_at', 'started_at', 'finished_at']
+        read_only_fields = fields
+
+
+class CompileArtifactSerializer(serializers.ModelSerializer):
+    """Metadata of a compile's stored outputs; the files are downloaded separately"""
+    files = serializers.SerializerMethodField()
+
+    def get_files(self, obj):
+        return sorted(kind for kind in ('pdf', 'log', 'synctex') if getattr(obj, f'{kind}_digest'))
+
+    class Meta:
+        model = CompileArtifact
+        fields = ['id', 'project', 'cache_key', 'success', 'passes', 'seconds', 'usage', 'error', 'files',
+                  'sizes', 'created_at']
+        read_only_fields = fields
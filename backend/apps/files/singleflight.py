@@ -0,0 +1,107 @@
+import copy
+import fcntl
+import hashlib
+import os
+import re
+import threading
+from contextlib import contextmanager
+from . import metrics
+
+# Keys that can be used as lock file names as they are (cache keys are hex digests)
+SAFE_KEY_RE = re.compile(r'^[0-9A-Za-z_-]{1,128}$')
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Collapse concurrent calls with the same key into one execution.
+
+    Within a process, callers that arrive while a call for their key is in
+    flight wait for it and receive its result. Across processes (several web
+    workers), `key_lock` serializes work on the same key so the second
+    process can find the first one's result in the cache instead of
+    redoing it.
+    """
+
+    def __init__(self, name, lock_dir):
+        self.name = name
+        self.lock_dir = lock_dir
+        self._calls = {}
+        self._lock = threading.Lock()
+        os.makedirs(self.lock_dir, exist_ok=True)
+
+    def lock_path(self, key):
+        name = key if SAFE_KEY_RE.match(key or '') else hashlib.sha256((key or '').encode('utf-8')).hexdigest()
+        return os.path.join(self.lock_dir, f'{name}.lock')
+
+    @contextmanager
+    def key_lock(self, key):
+        """
+        Cross-process exclusive lock for `key`
+
+        Every key has its own lock file, so unrelated keys never wait on
+        each other. The holder deletes the file before unlocking; anyone who
+        locked the deleted file meanwhile notices and locks the new one.
+        """
+        path = self.lock_path(key)
+        while True:
+            lock_file = open(path, 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    current = os.stat(path)
+                except FileNotFoundError:
+                    current = None
+                if current is not None and current.st_ino == os.fstat(lock_file.fileno()).st_ino:
+                    break
+            except BaseException:
+                lock_file.close()
+                raise
+            lock_file.close()
+        try:
+            yield
+        finally:
+            try:
+                os.remove(path)
+            finally:
+                lock_file.close()
+
+    def do(self, key, fn):
+        """
+        Run `fn()` for `key`, or wait for the identical call already in flight
+
+        Returns:
+            tuple: (result, joined) where joined is True if this caller
+            received another caller's result
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            metrics.incr(f'{self.name}.joins')
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            # Callers may annotate their result; don't share the object
+            return copy.copy(call.result), True
+
+        metrics.incr(f'{self.name}.leaders')
+        try:
+            call.result = fn()
+            return call.result, False
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
@@ -0,0 +1,298 @@
+import bisect
+import gzip
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from .cache import DiskLRUCache
+from . import metrics
+
+# TeX scaled points per PostScript point
+SP_PER_BP = 65781.76
+
+INPUT_RE = re.compile(r'^Input:(\d+):(.*)$')
+# <type><tag>,<line>[,<column>]:<h>,<v>[:<width>,<height>,<depth>]
+RECORD_RE = re.compile(r'^([\[(hvxkg$])(\d+),(\d+)(?:,-?\d+)?:(-?\d+),(-?\d+)(?::(-?\d+)(?:,(-?\d+),(-?\d+))?)?')
+
+# Raw SyncTeX data, written by the compiler next to the PDF's output path and
+# then moved into the store; it's only indexed on the first lookup
+SYNCTEX_DATA_SUFFIX = '.synctex.data.gz'
+
+# First line of stored SyncTeX data: the build directory its input paths are in
+WORK_DIR_PREFIX = 'CoTeX-Work-Dir:'
+
+# Parsed indexes kept in memory per process, so repeated clicks don't re-read the file
+MEMORY_ENTRIES = 16
+
+
+def source_name(path, work_dir):
+    """Project-relative name of a SyncTeX input, or None for files outside the project"""
+    path = os.path.normpath(os.path.join(work_dir, path))
+    root = os.path.normpath(work_dir)
+    if os.path.commonpath([root, path]) != root:
+        return None
+    return os.path.relpath(path, root)
+
+
+def _rounded(values):
+    return [round(value, 2) for value in values]
+
+
+def write_synctex_data(synctex_path, work_dir, data_path):
+    """
+    Store a compile's SyncTeX file at `data_path` for build_index, gzipped
+    (quickly) and prefixed with the build directory
+
+    Returns:
+        bool: False if the compile wrote no SyncTeX file
+    """
+    if not os.path.exists(synctex_path):
+        return False
+    with open(synctex_path, 'rb') as src, gzip.open(data_path, 'wb', compresslevel=1) as dst:
+        dst.write(f'{WORK_DIR_PREFIX}{work_dir}\n'.encode())
+        shutil.copyfileobj(src, dst)
+    return True
+
+
+def build_index(synctex_path, work_dir=None):
+    """
+    Parse a SyncTeX file into a compact lookup index
+
+    Args:
+        synctex_path: Uncompressed SyncTeX file, or data stored by
+            write_synctex_data (.gz)
+        work_dir: Directory of the compile, for files that don't record it
+
+    Positions are in PDF points from the top-left corner of the page.
+
+    Returns:
+        dict: files (list of names), lines ({file index: {line: [[page, x0,
+        y0, x1, y1], ...]}}, one box per page covering everything typeset
+        from that line) and pages ({page: [[y0, x0, x1, y1, file index,
+        line], ...]} sorted by y0), or None if the file can't be read
+    """
+    try:
+        if synctex_path.endswith('.gz'):
+            f = gzip.open(synctex_path, 'rt', errors='replace')
+        else:
+            f = open(synctex_path, 'r', errors='replace')
+    except FileNotFoundError:
+        return None
+
+    files = []
+    tags = {}
+    unit = 1.0
+    magnification = 1000.0
+    lines = {}
+    pages = {}
+    page = 0
+    with f:
+        for raw in f:
+            if raw.startswith('{'):
+                page = int(raw[1:].strip() or 0)
+                continue
+            match = RECORD_RE.match(raw)
+            if match is None:
+                if raw.startswith(WORK_DIR_PREFIX):
+                    work_dir = raw[len(WORK_DIR_PREFIX):].rstrip('\n')
+                    continue
+                input_match = INPUT_RE.match(raw)
+                if input_match:
+                    name = source_name(input_match.group(2).strip(), work_dir)
+                    if name is not None:
+                        if name not in files:
+                            files.append(name)
+                        tags[input_match.group(1)] = files.index(name)
+                elif raw.startswith('Unit:'):
+                    unit = float(raw[5:])
+                elif raw.startswith('Magnification:'):
+                    magnification = float(raw[14:])
+                continue
+
+            kind, tag, line = match.group(1), match.group(2), int(match.group(3))
+            file_index = tags.get(tag)
+            if file_index is None or line <= 0 or page <= 0:
+                continue
+            scale = unit * magnification / 1000 / SP_PER_BP
+            x = int(match.group(4)) * scale
+            y = int(match.group(5)) * scale
+            width = int(match.group(6) or 0) * scale if kind in '[(hvk' else 0.0
+            height = int(match.group(7) or 0) * scale
+            depth = int(match.group(8) or 0) * scale
+            box = [x, y - height, x + width, y + depth]
+
+            per_page = lines.setdefault(file_index, {}).setdefault(line, {})
+            current = per_page.get(page)
+            per_page[page] = box if current is None else [
+                min(current[0], box[0]), min(current[1], box[1]),
+                max(current[2], box[2]), max(current[3], box[3]),
+            ]
+            if kind in 'h[(x':
+                pages.setdefault(page, []).append([box[1], box[0], box[2], box[3], file_index, line])
+
+    return {
+        'version': 1,
+        'files': files,
+        'lines': {
+            str(file_index): {
+                str(line): [[page] + _rounded(box) for page, box in sorted(per_page.items())]
+                for line, per_page in by_line.items()
+            }
+            for file_index, by_line in lines.items()
+        },
+        'pages': {
+            str(page): [_rounded(record[:4]) + record[4:] for record in sorted(records)]
+            for page, records in pages.items()
+        },
+    }
+
+
+class SyncTexIndex:
+    """Forward (source to PDF) and inverse (PDF to source) search over a built index"""
+
+    def __init__(self, data):
+        self.files = data['files']
+        self.lines = {
+            int(file_index): {int(line): boxes for line, boxes in by_line.items()}
+            for file_index, by_line in data['lines'].items()
+        }
+        self.sorted_lines = {file_index: sorted(by_line) for file_index, by_line in self.lines.items()}
+        self.pages = {int(page): records for page, records in data['pages'].items()}
+        self.page_tops = {page: [record[0] for record in records] for page, records in self.pages.items()}
+
+    def forward(self, filename, line):
+        """
+        PDF boxes typeset from `line` of `filename`, falling back to the
+        nearest following line that produced output
+
+        Returns:
+            list: {page, x0, y0, x1, y1} dicts, empty if nothing matches
+        """
+        if filename not in self.files:
+            return []
+        file_index = self.files.index(filename)
+        candidates = self.sorted_lines.get(file_index, [])
+        position = bisect.bisect_left(candidates, line)
+        if position == len(candidates):
+            position -= 1
+        if position < 0:
+            return []
+        boxes = self.lines[file_index][candidates[position]]
+        return [
+            {'page': page, 'x0': x0, 'y0': y0, 'x1': x1, 'y1': y1, 'line': candidates[position]}
+            for page, x0, y0, x1, y1 in boxes
+        ]
+
+    def inverse(self, page, x, y):
+        """
+        Source position of the point (x, y) on `page`: the smallest box
+        containing it, or else the closest one
+
+        Returns:
+            dict: {file, line}, or None if the page has no records
+        """
+        records = self.pages.get(page)
+        if not records:
+            return None
+        # Only boxes starting above the point can contain it
+        end = bisect.bisect_right(self.page_tops[page], y)
+        best = None
+        for y0, x0, x1, y1, file_index, line in records[:end]:
+            if y1 >= y and x0 <= x <= x1:
+                area = (x1 - x0) * (y1 - y0)
+                if best is None or area < best[0]:
+                    best = (area, file_index, line)
+        if best is None:
+            def distance(record):
+                y0, x0, x1, y1 = record[:4]
+                dx = max(x0 - x, 0, x - x1)
+                dy = max(y0 - y, 0, y - y1)
+                return dx * dx + dy * dy
+            record = min(records, key=distance)
+            best = (None, record[4], record[5])
+        return {'file': self.files[best[1]], 'line': best[2]}
+
+
+class SyncTexStore:
+    """
+    SyncTeX data and indexes of compiled PDFs, stored by compile cache key
+
+    Compiles only store their raw SyncTeX data (see write_synctex_data);
+    parsing it into an index waits for the first lookup, so compiles
+    nobody searches never pay for it.
+    """
+
+    def __init__(self, cache_dir, max_bytes, data_dir=None, data_max_bytes=None):
+        self.store = DiskLRUCache('synctex_index', cache_dir, max_bytes, suffix='.json')
+        self.data = DiskLRUCache(
+            'synctex_data', data_dir or cache_dir + '-data', data_max_bytes or max_bytes, suffix='.gz'
+        )
+        self._loaded = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put_data(self, key, data_path):
+        self.data.put_file(key, data_path)
+
+    def load(self, key):
+        """Return the SyncTexIndex for a compile, or None if there is none"""
+        with self._lock:
+            index = self._loaded.get(key)
+            if index is not None:
+                self._loaded.move_to_end(key)
+                return index
+        data = self.store.get(key)
+        if data is None:
+            data = self.build(key)
+            if data is None:
+                return None
+        index = SyncTexIndex(json.loads(data))
+        with self._lock:
+            self._loaded[key] = index
+            while len(self._loaded) > MEMORY_ENTRIES:
+                self._loaded.popitem(last=False)
+        return index
+
+
+    def build(self, key):
+        """
+        Index the stored SyncTeX data of a compile
+
+        Returns:
+            bytes: The JSON index, or None if the compile left no SyncTeX data
+        """
+        data_path = self.data.lookup(key, record_stats=False)
+        if data_path is None:
+            return None
+        started = time.monotonic()
+        index = build_index(data_path)
+        if index is None:
+            # Evicted since the lookup
+            return None
+        data = json.dumps(index, separators=(',', ':')).encode()
+        self.store.put(key, data)
+        metrics.observe('synctex.index', time.monotonic() - started)
+        return data
+
+
+_synctex_store = None
+_synctex_store_lock = threading.Lock()
+
+
+def get_synctex_store():
+    """Return the process-wide SyncTeX index store"""
+    global _synctex_store
+    if _synctex_store is None:
+        with _synctex_store_lock:
+            if _synctex_store is None:
+                base_dir = getattr(settings, 'LATEX_TEMP_DIR', '/tmp/cotex')
+                _synctex_store = SyncTexStore(
+                    os.path.join(base_dir, 'cache', 'synctex'),
+                    getattr(settings, 'LATEX_SYNCTEX_CACHE_MAX_BYTES', 256 * 1024 * 1024),
+                    os.path.join(base_dir, 'cache', 'synctex-data'),
+                    getattr(settings, 'LATEX_SYNCTEX_DATA_MAX_BYTES', 512 * 1024 * 1024),
+                )
+    return _synctex_store
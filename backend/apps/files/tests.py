@@ -0,0 +1,1203 @@
+import hashlib
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.migrations.executor import MigrationExecutor
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APITestCase
+from apps.projects.models import Project
+from . import jobs
+from .artifacts import ArtifactStore
+from .benchmark import create_project
+from .bibliography import BibliographyCache, bibliography_inputs
+from .builddirs import BuildDirectoryManager, UnsafePathError
+from .cache import DiskLRUCache, get_compile_cache, hash_inputs
+from .deps import DependencyGraph, scan_dependencies
+from .diagnostics import parse_log
+from .edits import EditError, apply_edits, transform_edits
+from .formats import PreambleFormatCache, extract_preamble
+from .LaTeX import LatexCompiler
+from .models import CompileArtifact, CompileJob, File, FileBlob, Folder
+from .pdfopt import optimized_key
+from .pipeline import load_project_sources, lookup_compiled_pdf, project_compile_keys
+from .preview import PreviewRenderer, get_preview_renderer, parse_page_list
+from .responses import file_response
+from .scheduler import FairScheduler, SchedulerBusy
+from .singleflight import SingleFlight
+from .synctex import SyncTexStore, write_synctex_data
+from .workers import CompileWorkerPool
+from . import metrics
+
+# Stand-in for pdflatex: builds formats instantly and writes a tiny PDF,
+# sleeping first when the document asks for it (SLOW) or hanging (HANG)
+FAKE_PDFLATEX = '''#!{python}
+import sys, time
+args = sys.argv[1:]
+if '-ini' in args:
+    job = [arg for arg in args if arg.startswith('-jobname=')][0].split('=', 1)[1]
+    open(job + '.fmt', 'w').close()
+    sys.exit(0)
+source = open('main.tex').read()
+if 'HANG' in source:
+    time.sleep(600)
+if 'SLOW' in source:
+    time.sleep(2)
+open('main.pdf', 'wb').write(b'%PDF-1.5\\n%%EOF\\n')
+open('main.log', 'w').write('Output written on main.pdf (1 page, 16 bytes).\\n')
+'''
+
+
+class FakeTeXMixin:
+    """Runs compiles against FAKE_PDFLATEX, first on PATH, in a scratch directory"""
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+        bin_dir = os.path.join(self.tmp, 'bin')
+        os.makedirs(bin_dir)
+        with open(os.path.join(bin_dir, 'pdflatex'), 'w') as f:
+            f.write(FAKE_PDFLATEX.format(python=sys.executable))
+        os.chmod(os.path.join(bin_dir, 'pdflatex'), 0o755)
+        environ = mock.patch.dict(os.environ, {'PATH': bin_dir + os.pathsep + os.environ['PATH']})
+        environ.start()
+        self.addCleanup(environ.stop)
+
+    def document(self, body):
+        return '\\documentclass{article}\n\\begin{document}\n%s\n\\end{document}\n' % body
+
+
+class ProjectTestCase(APITestCase):
+    """A signed-in owner with a two-file project"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('owner', 'owner@example.com', 'password')
+        self.project = Project.objects.create(name='Thesis', owner=self.user)
+        self.main = File.objects.create(
+            project=self.project, name='main.tex', is_main=True,
+            content='\\documentclass{article}\\begin{document}\\include{ch1}\\end{document}',
+        )
+        self.chapter = File.objects.create(project=self.project, name='ch1.tex', content='hello world')
+        self.client.force_authenticate(self.user)
+
+
+class DiskLRUCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+        self.cache = DiskLRUCache('test_cache', self.tmp, max_bytes=30, suffix='.pdf')
+        metrics.reset()
+
+    def test_hash_inputs_is_stable_and_unambiguous(self):
+        self.assertEqual(hash_inputs('a', b'b'), hash_inputs('a', 'b'))
+        self.assertNotEqual(hash_inputs('ab', 'c'), hash_inputs('a', 'bc'))
+        # Keys stay valid across releases: length-prefixed parts, sha256
+        self.assertEqual(hash_inputs('cotex', 'x'), hashlib.sha256(b'5:cotex1:x').hexdigest())
+
+    def test_hits_and_misses(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.put('a', b'pdf')
+        self.assertEqual(self.cache.get('a'), b'pdf')
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries'], stats['bytes']), (1, 1, 1, 3))
+
+    def test_evicts_least_recently_used(self):
+        for age, key in ((300, 'a'), (200, 'b'), (100, 'c')):
+            self.cache.put(key, b'x' * 10)
+            # The mtime is the last access time
+            os.utime(self.cache.path_for(key), (time.time() - age,) * 2)
+        self.cache.lookup('a')
+        self.cache.put('d', b'x' * 10)
+        self.assertIsNone(self.cache.lookup('b', record_stats=False))
+        for key in 'acd':
+            self.assertIsNotNone(self.cache.lookup(key, record_stats=False))
+        self.assertEqual(self.cache.stats()['bytes'], 30)
+
+    def test_stores_under_budget_do_not_scan(self):
+        self.cache.put('a', b'x')
+        self.cache.put('b', b'x')
+        self.cache.put('b', b'xy')
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(counters['test_cache.scans'], 1)
+        self.assertEqual((self.cache.stats()['entries'], self.cache.stats()['bytes']), (2, 3))
+
+
+class OptimizedPdfTests(ProjectTestCase):
+    def test_optimized_pdf_has_its_own_etag(self):
+        main_file, related_files = load_project_sources(self.project)
+        key, _ = lookup_compiled_pdf(main_file.content, related_files)
+        cache = get_compile_cache()
+        cache.put(key, b'%PDF-raw')
+        cache.put(optimized_key(key), b'%PDF-optimized')
+
+        url = f'/api/projects/{self.project.id}/pdf/'
+        raw = self.client.get(url)
+        optimized = self.client.get(url + '?optimize=1')
+        self.assertEqual(raw['ETag'], f'"{key}"')
+        self.assertEqual(optimized['ETag'], f'"{optimized_key(key)}"')
+        self.assertEqual(b''.join(optimized.streaming_content), b'%PDF-optimized')
+        # Lookups by compile key work for either
+        self.assertEqual(raw['X-Compile-Key'], key)
+        self.assertEqual(optimized['X-Compile-Key'], key)
+
+        # The raw PDF's ETag doesn't revalidate the optimized one
+        response = self.client.get(url + '?optimize=1', HTTP_IF_NONE_MATCH=raw['ETag'])
+        self.assertEqual(response.status_code, 200)
+        response.close()
+        raw.close()
+
+
+class WorkerPoolTests(FakeTeXMixin, SimpleTestCase):
+    def pool(self, processes, job_timeout):
+        pool = CompileWorkerPool(processes, job_timeout=job_timeout)
+        pool.start()
+        self.addCleanup(lambda: [worker.shutdown(cancel_futures=True) for worker in pool._idle.queue if worker])
+        return pool
+
+    def compile(self, pool, body, results=None):
+        output_path = os.path.join(self.tmp, f'{len(os.listdir(self.tmp))}-{threading.get_ident()}.pdf')
+        outcome = pool.compile(self.document(body), {}, output_path=output_path)
+        if results is not None:
+            results.append(outcome)
+        return outcome
+
+    def test_hung_job_is_killed_without_failing_other_workers(self):
+        pool = self.pool(2, job_timeout=3)
+        hung = []
+        thread = threading.Thread(target=self.compile, args=(pool, 'HANG', hung))
+        thread.start()
+        # Still running when the hung worker is killed
+        time.sleep(1.5)
+        outcome = self.compile(pool, 'SLOW')
+        thread.join()
+        self.assertEqual(hung[0]['result'], "Compile worker stopped responding")
+        self.assertTrue(outcome['success'], outcome['result'])
+        # The killed worker was replaced
+        self.assertTrue(self.compile(pool, 'again')['success'])
+        self.assertTrue(self.compile(pool, 'and again')['success'])
+
+    def test_waiting_for_a_worker_is_not_timed(self):
+        pool = self.pool(1, job_timeout=3)
+        results = []
+        threads = [threading.Thread(target=self.compile, args=(pool, f'SLOW {n}', results)) for n in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([outcome['success'] for outcome in results], [True, True])
+
+    def test_crashed_worker_is_replaced(self):
+        pool = self.pool(1, job_timeout=30)
+        for process in pool._idle.queue[0]._processes.values():
+            os.killpg(process.pid, signal.SIGKILL)
+        time.sleep(0.5)
+        self.assertEqual(self.compile(pool, 'crashed')['result'], "Compile worker crashed")
+        self.assertTrue(self.compile(pool, 'replaced')['success'])
+
+
+class SpeculativeCompileTests(ProjectTestCase):
+    def setUp(self):
+        super().setUp()
+        self.project.speculative_compile = True
+        self.project.save()
+        self.addCleanup(jobs._speculative_pending.clear)
+
+    def speculative_jobs(self):
+        return CompileJob.objects.filter(project=self.project, speculative=True)
+
+    def patch(self, data):
+        response = self.client.patch(f'/api/files/files/{self.chapter.id}/', data, format='json')
+        self.assertEqual(response.status_code, 200, response.content)
+
+    def test_only_content_changes_are_compiled(self):
+        self.patch({'name': 'chapter1.tex'})
+        self.patch({'content': 'hello world'})
+        self.assertFalse(self.speculative_jobs().exists())
+        self.patch({'content': 'hello again'})
+        self.assertEqual(self.speculative_jobs().count(), 1)
+
+    def test_new_save_cancels_the_previous_job(self):
+        self.patch({'content': 'one'})
+        self.patch({'content': 'two'})
+        first, second = self.speculative_jobs().order_by('created_at')
+        self.assertEqual((first.status, second.status), ('cancelled', 'queued'))
+        # Debounced: not claimable before the window is over
+        self.assertGreater(second.run_after, second.created_at)
+
+    def test_busy_job_is_retried_when_a_slot_frees_up(self):
+        scheduler = FairScheduler(
+            slots=2, user_limit=1, project_limit=1, max_queue=4, user_queue=4, max_wait=None, reserved=1
+        )
+        self.patch({'content': 'edited'})
+        job = self.speculative_jobs().get()
+        CompileJob.objects.filter(id=job.id).update(status='running', attempts=1)
+        job.refresh_from_db()
+        executor = mock.Mock()
+        with mock.patch('apps.files.jobs.get_scheduler', return_value=scheduler), \
+                mock.patch('apps.files.pipeline.get_scheduler', return_value=scheduler), \
+                mock.patch('apps.files.jobs.get_speculative_executor', return_value=executor):
+            with scheduler.slot(self.user.id, 'other', admission=False):
+                self.assertTrue(jobs.execute_job(job))
+                job.refresh_from_db()
+                self.assertEqual((job.status, job.attempts), ('queued', 0))
+                executor.submit.assert_not_called()
+            executor.submit.assert_called_once_with(jobs.run_compile_job, job.id)
+
+
+class FileBlobTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('owner')
+        self.project = Project.objects.create(name='Thesis', owner=self.user)
+
+    def create(self, name, content):
+        with self.captureOnCommitCallbacks(execute=True):
+            return File.objects.create(project=self.project, name=name, content=content)
+
+    def test_identical_content_is_stored_once(self):
+        first = self.create('a.tex', 'same text')
+        second = self.create('b.tex', 'same text')
+        self.assertEqual(first.blob_id, second.blob_id)
+        self.assertEqual(FileBlob.objects.filter(hash=first.blob_id).count(), 1)
+        self.assertEqual(File.objects.get(id=second.id).content, 'same text')
+
+    def test_unused_blob_is_released_after_commit(self):
+        file = self.create('a.tex', 'old text')
+        old_hash = file.blob_id
+        with self.captureOnCommitCallbacks() as callbacks:
+            file.content = 'new text'
+            file.save()
+        # Still there until the saving transaction commits
+        self.assertTrue(FileBlob.objects.filter(hash=old_hash).exists())
+        for callback in callbacks:
+            callback()
+        self.assertFalse(FileBlob.objects.filter(hash=old_hash).exists())
+
+    def test_blob_in_use_is_kept(self):
+        first = self.create('a.tex', 'shared')
+        self.create('b.tex', 'shared')
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(FileBlob.objects.filter(hash=first.blob_id).exists())
+
+    def test_rolled_back_release_keeps_the_blob(self):
+        file = self.create('a.tex', 'text')
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    File.objects.get(id=file.id).delete()
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        self.assertEqual(callbacks, [])
+        self.assertTrue(FileBlob.objects.filter(hash=file.blob_id).exists())
+
+
+class FileBlobMigrationTests(TransactionTestCase):
+    before = [('files', '0014_materialized_paths')]
+    after = [('files', '0015_file_blobs')]
+
+    def migrate(self, targets):
+        executor = MigrationExecutor(connection)
+        executor.loader.build_graph()
+        executor.migrate(targets)
+        return executor.loader.project_state(targets).apps
+
+    def tearDown(self):
+        self.migrate(MigrationExecutor(connection).loader.graph.leaf_nodes())
+
+    def test_content_moves_to_shared_blobs(self):
+        apps = self.migrate(self.before)
+        owner = apps.get_model('auth', 'User').objects.create(username='owner')
+        project = apps.get_model('projects', 'Project').objects.create(name='Thesis', owner_id=owner.id)
+        OldFile = apps.get_model('files', 'File')
+        for name in ('a.tex', 'b.tex'):
+            OldFile.objects.create(project_id=project.id, name=name, content='same text')
+        OldFile.objects.create(project_id=project.id, name='c.tex', content='other')
+
+        apps = self.migrate(self.after)
+        files = apps.get_model('files', 'File').objects.select_related('blob').order_by('name')
+        self.assertEqual([file.blob.content for file in files], ['same text', 'same text', 'other'])
+        self.assertEqual(apps.get_model('files', 'FileBlob').objects.count(), 2)
+        self.assertEqual(files[0].blob_id, hashlib.sha256(b'same text').hexdigest())
+
+
+class ParseLogTests(SimpleTestCase):
+    LOG = (
+        'This is pdfTeX\n'
+        '(./main.tex (/usr/share/texlive/article.cls)\n'
+        '(./chapters/intro.tex\n'
+        '! Undefined control sequence.\n'
+        'l.12 \\foo\n'
+        '\n'
+        "LaTeX Warning: Reference `sec:x' on page 1 undefined on input line 7.\n"
+        '\n'
+        ')\n'
+        'Overfull \\hbox (3.0pt too wide) in paragraph at lines 20--21\n'
+        './main.tex:30: Missing $ inserted.\n'
+        ')\n'
+    )
+
+    def test_maps_diagnostics_to_files(self):
+        self.assertEqual(parse_log(self.LOG), [
+            {'level': 'error', 'message': 'Undefined control sequence.', 'file': 'chapters/intro.tex', 'line': 12},
+            {'level': 'warning', 'message': "Reference `sec:x' on page 1 undefined on input line 7",
+             'file': 'chapters/intro.tex', 'line': 7},
+            {'level': 'badbox', 'message': 'Overfull \\hbox (3.0pt too wide)', 'file': 'main.tex', 'line': 20},
+            {'level': 'error', 'message': 'Missing $ inserted.', 'file': 'main.tex', 'line': 30},
+        ])
+
+    def test_empty_log(self):
+        self.assertEqual(parse_log(''), [])
+
+
+class SyncTexTests(SimpleTestCase):
+    SYNCTEX = (
+        'SyncTeX Version:1\n'
+        'Input:1:{work_dir}/./main.tex\n'
+        'Input:2:/usr/share/texlive/article.cls\n'
+        'Output:pdf\n'
+        'Magnification:1000\n'
+        'Unit:1\n'
+        'Content:\n'
+        '{{1\n'
+        '[1,3:4736286,5000000:10000000,600000,0\n'
+        'h1,3:4736286,5000000:100000,600000,0\n'
+        ']\n'
+        '}}1\n'
+    )
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+
+    def test_index_is_built_on_first_lookup(self):
+        work_dir = os.path.join(self.tmp, 'build')
+        os.makedirs(work_dir)
+        with open(os.path.join(work_dir, 'main.synctex'), 'w') as f:
+            f.write(self.SYNCTEX.format(work_dir=work_dir))
+        data_path = os.path.join(self.tmp, 'main.synctex.data.gz')
+        self.assertTrue(write_synctex_data(os.path.join(work_dir, 'main.synctex'), work_dir, data_path))
+        store = SyncTexStore(os.path.join(self.tmp, 'index'), 1024 * 1024)
+        store.put_data('key', data_path)
+        self.assertIsNone(store.store.lookup('key', record_stats=False))
+
+        index = store.load('key')
+        self.assertEqual(index.files, ['main.tex'])
+        self.assertEqual(index.forward('main.tex', 3)[0]['page'], 1)
+        self.assertEqual(index.inverse(1, 80, 70), {'file': 'main.tex', 'line': 3})
+        # Kept for other processes
+        self.assertIsNotNone(store.store.lookup('key', record_stats=False))
+        self.assertIsNone(store.load('unknown'))
+
+    def test_previews_skip_synctex(self):
+        compiler = LatexCompiler()
+        self.assertIn('-synctex=-1', compiler.command)
+        self.assertIn('-synctex=-1', compiler.format_command(self.tmp, __file__))
+        self.assertNotIn('-synctex=-1', compiler.preview_command)
+        self.assertNotIn('-synctex=-1', compiler.format_command(self.tmp, __file__, preview=True))
+
+
+class PreviewTileTests(ProjectTestCase):
+    def tile_url(self, project, pdf_key):
+        renderer = get_preview_renderer()
+        renderer.tiles.put(renderer.tile_key(pdf_key, 1, renderer.dpi), b'PNG')
+        return f'/api/projects/{project.id}/preview/{pdf_key}/1/'
+
+    def test_tiles_of_other_projects_are_not_served(self):
+        other = Project.objects.create(name='Other', owner=self.user)
+        pdf_key = hash_inputs('other project pdf')
+        CompileArtifact.objects.create(project=other, cache_key=pdf_key, success=True)
+        self.assertEqual(self.client.get(self.tile_url(other, pdf_key)).status_code, 200)
+        self.assertEqual(self.client.get(self.tile_url(self.project, pdf_key)).status_code, 404)
+
+    def test_tiles_of_current_sources_are_served(self):
+        _, preview_key = project_compile_keys(self.project)
+        self.assertEqual(self.client.get(self.tile_url(self.project, preview_key)).status_code, 200)
+
+    def test_page_selection(self):
+        self.assertEqual(parse_page_list('3, 1-2,2'), [1, 2, 3])
+        for value in ('', 'x', '0', '3-1', '1-50'):
+            with self.assertRaises(ValueError):
+                parse_page_list(value)
+
+    def test_page_count_is_cached(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp, True)
+        renderer = PreviewRenderer(os.path.join(tmp, 'tiles'), 1024 * 1024, 96)
+        pdfinfo = mock.Mock(stdout='Producer: pdfTeX\nPages:          12\n')
+        with mock.patch('subprocess.run', return_value=pdfinfo) as run:
+            self.assertEqual(renderer.page_count('key', '/unused.pdf'), 12)
+            self.assertEqual(renderer.page_count('key', '/unused.pdf'), 12)
+        self.assertEqual(run.call_count, 1)
+
+
+class BenchmarkProjectTests(TestCase):
+    def test_files_are_ready_to_compile(self):
+        project = create_project(User.objects.create_user('bench'), 'book')
+        files = File.objects.filter(project=project)
+        self.assertGreater(files.count(), 1)
+        self.assertFalse(files.filter(dependencies__isnull=True).exists())
+        self.assertFalse(files.filter(blob__isnull=True).exists())
+        main = files.get(is_main=True)
+        self.assertTrue(any(kind in ('include', 'input') for kind, _ in main.dependencies))
+
+
+class LocalJobRecoveryTests(ProjectTestCase):
+    def setUp(self):
+        super().setUp()
+        self.long_ago = timezone.now() - timedelta(hours=1)
+
+    def job(self, **fields):
+        job = CompileJob.objects.create(project=self.project, requested_by=self.user)
+        CompileJob.objects.filter(id=job.id).update(created_at=self.long_ago, **fields)
+        return job
+
+    def test_jobs_left_by_a_restart_are_resubmitted(self):
+        dead = self.job(status='running', worker_id='local:host:1', heartbeat_at=self.long_ago, attempts=1)
+        stranded = self.job()
+        fresh = CompileJob.objects.create(project=self.project, requested_by=self.user)
+        alive = self.job(status='running', worker_id='local:host:2', heartbeat_at=timezone.now())
+        executor = mock.Mock()
+        with mock.patch('apps.files.jobs.get_executor', return_value=executor):
+            submitted = jobs.recover_local_jobs()
+            self.assertEqual(submitted, {dead.id, stranded.id})
+            self.assertEqual(
+                {call.args[1] for call in executor.submit.call_args_list}, {dead.id, stranded.id}
+            )
+            # Not handed over twice by the same monitor
+            jobs.recover_local_jobs(submitted)
+        self.assertEqual(executor.submit.call_count, 2)
+        self.assertEqual(CompileJob.objects.get(id=fresh.id).status, 'queued')
+        self.assertEqual(CompileJob.objects.get(id=alive.id).status, 'running')
+
+    def test_jobs_out_of_attempts_fail(self):
+        dead = self.job(status='running', worker_id='local:host:1', heartbeat_at=self.long_ago, attempts=3)
+        with mock.patch('apps.files.jobs.get_executor') as get_executor:
+            self.assertEqual(jobs.recover_local_jobs(), set())
+        get_executor.assert_not_called()
+        self.assertEqual(CompileJob.objects.get(id=dead.id).status, 'failed')
+
+
+class BuildDirectoryTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+        self.build_dirs = BuildDirectoryManager(self.tmp, quota_bytes=200)
+
+    def fill(self, build_key, age):
+        with self.build_dirs.acquire(build_key) as build_dir:
+            self.build_dirs.sync_sources(build_dir, {'main.tex': 'x' * 10})
+        os.utime(build_dir, (time.time() - age,) * 2)
+        return build_dir
+
+    def test_sync_rewrites_only_changed_sources(self):
+        with self.build_dirs.acquire(1) as build_dir:
+            self.assertEqual(self.build_dirs.sync_sources(build_dir, {'main.tex': 'a', 'ch/1.tex': 'b'}), 2)
+            self.assertEqual(self.build_dirs.sync_sources(build_dir, {'main.tex': 'a', 'ch/1.tex': 'c'}), 1)
+            self.assertEqual(self.build_dirs.sync_sources(build_dir, {'main.tex': 'a'}), 0)
+            self.assertFalse(os.path.exists(os.path.join(build_dir, 'ch', '1.tex')))
+            with self.assertRaises(UnsafePathError):
+                self.build_dirs.sync_sources(build_dir, {'../escape.tex': ''})
+
+    def test_quota_evicts_least_recently_used_with_its_lock_file(self):
+        oldest = self.fill(1, age=300)
+        self.fill(2, age=200)
+        # About 90 bytes each with the manifest, so a third one goes over quota
+        newest = self.fill(3, age=100)
+        self.assertFalse(os.path.exists(oldest))
+        self.assertFalse(os.path.exists(oldest + '.lock'))
+        self.assertTrue(os.path.exists(newest))
+
+    def test_directory_in_use_is_not_evicted(self):
+        build_dir = self.fill(1, age=300)
+        lock_file = self.build_dirs.lock(build_dir)
+        self.addCleanup(lock_file.close)
+        self.assertFalse(self.build_dirs.remove(build_dir))
+        self.assertTrue(os.path.exists(build_dir + '.lock'))
+
+    def test_waiter_relocks_after_eviction(self):
+        build_dir = self.fill(1, age=0)
+        holder = self.build_dirs.lock(build_dir)
+        locked = []
+        waiter = threading.Thread(target=lambda: locked.append(self.build_dirs.lock(build_dir)))
+        waiter.start()
+        time.sleep(0.2)
+        # Evict while the waiter is blocked on the old lock file
+        shutil.rmtree(build_dir)
+        os.remove(build_dir + '.lock')
+        holder.close()
+        waiter.join()
+        self.addCleanup(locked[0].close)
+        self.assertEqual(os.stat(build_dir + '.lock').st_ino, os.fstat(locked[0].fileno()).st_ino)
+
+
+@override_settings(LATEX_WORKER_POOL=False)
+class CompileCacheTests(FakeTeXMixin, ProjectTestCase):
+    def test_unchanged_sources_are_served_from_the_cache(self):
+        # Unique sources, so earlier runs sharing the cache directory don't count
+        self.chapter.content = f'cached {time.time_ns()}'
+        self.chapter.save()
+        url = f'/api/projects/{self.project.id}/compile/'
+        first = self.client.post(url)
+        second = self.client.post(url)
+        self.assertEqual((first.status_code, second.status_code), (200, 200))
+        self.assertEqual((first['X-Compile-Cache'], second['X-Compile-Cache']), ('miss', 'hit'))
+        self.assertEqual(first['ETag'], second['ETag'])
+        self.assertEqual(b''.join(second.streaming_content), b''.join(first.streaming_content))
+
+    def test_compile_without_main_file(self):
+        self.main.delete()
+        response = self.client.post(f'/api/projects/{self.project.id}/compile/')
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(LATEX_WORKER_POOL=False, LATEX_COMPILE_QUEUE='local')
+class CompileJobTests(FakeTeXMixin, ProjectTestCase):
+    def setUp(self):
+        super().setUp()
+        # Status polls would start the recovery thread
+        monitor = mock.patch('apps.projects.views.start_local_monitor')
+        monitor.start()
+        self.addCleanup(monitor.stop)
+
+    def test_job_runs_and_serves_its_pdf(self):
+        executor = mock.Mock()
+        with mock.patch('apps.files.jobs.get_executor', return_value=executor), \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f'/api/projects/{self.project.id}/compile-async/')
+        self.assertEqual(response.status_code, 202)
+        job_url = f'/api/projects/{self.project.id}/jobs/{response.data["id"]}/'
+        self.assertEqual(self.client.get(job_url + 'result/').status_code, 409)
+
+        function, job_id = executor.submit.call_args.args
+        self.assertEqual((function, str(job_id)), (jobs.run_compile_job, response.data['id']))
+        # Closing connections would end the test's transaction
+        with mock.patch('apps.files.jobs.close_old_connections'):
+            jobs.run_compile_job(job_id)
+        job = self.client.get(job_url).data
+        self.assertEqual((job['status'], job['attempts']), ('succeeded', 1))
+        result = self.client.get(job_url + 'result/')
+        self.assertEqual(result.status_code, 200)
+        self.assertTrue(b''.join(result.streaming_content).startswith(b'%PDF'))
+
+    def test_unknown_job(self):
+        response = self.client.get(f'/api/projects/{self.project.id}/jobs/nope/')
+        self.assertEqual(response.status_code, 404)
+
+
+class RerunDetectionTests(SimpleTestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.work_dir, True)
+        self.compiler = LatexCompiler()
+        self.write('main.log', 'Output written on main.pdf (1 page).\n')
+
+    def write(self, name, content):
+        with open(os.path.join(self.work_dir, name), 'w') as f:
+            f.write(content)
+
+    def test_converged_pass_needs_no_rerun(self):
+        self.write('main.aux', '\\newlabel{x}{{1}{1}}')
+        before = self.compiler.aux_checksums(self.work_dir)
+        self.write('main.aux', '\\newlabel{x}{{1}{1}}')
+        self.assertFalse(self.compiler.needs_rerun(self.work_dir, before))
+
+    def test_changed_aux_file_needs_rerun(self):
+        self.write('main.toc', 'old')
+        before = self.compiler.aux_checksums(self.work_dir)
+        self.write('main.toc', 'new')
+        self.assertTrue(self.compiler.needs_rerun(self.work_dir, before))
+
+    def test_new_files(self):
+        before = self.compiler.aux_checksums(self.work_dir)
+        # LaTeX itself asks for a rerun when a new .aux has labels
+        self.write('main.aux', '\\relax')
+        self.write('main.lof', '')
+        self.assertFalse(self.compiler.needs_rerun(self.work_dir, before))
+        self.write('main.toc', '\\contentsline')
+        self.assertTrue(self.compiler.needs_rerun(self.work_dir, before))
+
+    def test_log_asks_for_rerun(self):
+        before = self.compiler.aux_checksums(self.work_dir)
+        self.write('main.log', 'LaTeX Warning: Label(s) may have changed. Rerun to get cross-references right.\n')
+        self.assertTrue(self.compiler.needs_rerun(self.work_dir, before))
+
+
+class ExtractPreambleTests(SimpleTestCase):
+    def test_stops_at_begin_document(self):
+        content = '\\documentclass{article}\n\\usepackage{amsmath}\n\\begin{document}\nhi\n\\end{document}'
+        self.assertEqual(extract_preamble(content), '\\documentclass{article}\n\\usepackage{amsmath}\n')
+
+    def test_keeps_command_on_the_begin_document_line(self):
+        content = '\\documentclass{article}\n\\usepackage[margin=1in]{geometry}\\begin{document}x\\end{document}'
+        self.assertTrue(extract_preamble(content).endswith('\\usepackage[margin=1in]{geometry}'))
+
+    def test_ignores_commented_out_begin_document(self):
+        content = '\\documentclass{article}\n% \\begin{document}\n\\usepackage{x}\n\\begin{document}\\end{document}'
+        self.assertIn('\\usepackage{x}', extract_preamble(content))
+
+    def test_no_preamble(self):
+        self.assertIsNone(extract_preamble('no document here'))
+        self.assertIsNone(extract_preamble('\\begin{document}\\end{document}'))
+        self.assertIsNone(extract_preamble('%&custom\n\\documentclass{article}\\begin{document}\\end{document}'))
+
+
+class PreambleFormatCacheTests(FakeTeXMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.formats = PreambleFormatCache(os.path.join(self.tmp, 'fmt'), 1024 * 1024)
+        self.env = dict(os.environ, SOURCE_DATE_EPOCH='0')
+        metrics.reset()
+
+    def test_documents_with_the_same_preamble_share_a_format(self):
+        first = self.formats.get_format(self.document('one'), {}, self.env)
+        second = self.formats.get_format(self.document('two'), {}, self.env)
+        self.assertIsNotNone(first)
+        self.assertEqual(first, second)
+        self.assertEqual(metrics.snapshot()['counters']['format_cache.builds'], 1)
+
+    def test_local_files_loaded_by_the_preamble_are_part_of_the_key(self):
+        content = '\\documentclass{article}\\input{macros}\\begin{document}x\\end{document}'
+        first = self.formats.get_format(content, {'macros.tex': 'a', 'ch1.tex': 'x'}, self.env)
+        self.assertEqual(self.formats.get_format(content, {'macros.tex': 'a', 'ch1.tex': 'y'}, self.env), first)
+        self.assertNotEqual(self.formats.get_format(content, {'macros.tex': 'b'}, self.env), first)
+
+    def test_broken_format_is_not_used_again(self):
+        fmt_path = self.formats.get_format(self.document('one'), {}, self.env)
+        self.formats.mark_failed(fmt_path)
+        self.assertIsNone(self.formats.get_format(self.document('one'), {}, self.env))
+
+
+class SingleFlightTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp, True)
+        self.flight = SingleFlight('test_flight', tmp)
+
+    def run_concurrently(self, fn, callers=4):
+        results = []
+        started = threading.Barrier(callers)
+
+        def call():
+            started.wait()
+            try:
+                results.append(self.flight.do('key', fn))
+            except Exception as e:
+                results.append(e)
+        threads = [threading.Thread(target=call) for _ in range(callers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_identical_calls_run_once(self):
+        calls = []
+
+        def build():
+            calls.append(1)
+            time.sleep(0.3)
+            return ['pdf']
+        results = self.run_concurrently(build)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(joined for _, joined in results), [False, True, True, True])
+        # Joiners get their own copy to annotate
+        self.assertEqual(len({id(result) for result, _ in results}), 4)
+
+    def test_errors_reach_every_caller(self):
+        def build():
+            time.sleep(0.3)
+            raise RuntimeError("compile failed")
+        results = self.run_concurrently(build)
+        self.assertTrue(all(isinstance(result, RuntimeError) for result in results))
+
+    def test_key_lock_is_exclusive_and_cleans_up(self):
+        events = []
+
+        def hold(name):
+            with self.flight.key_lock('a' * 64):
+                events.append(f'{name} in')
+                time.sleep(0.2)
+                events.append(f'{name} out')
+        threads = [threading.Thread(target=hold, args=(name,)) for name in 'ab']
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([event.split()[1] for event in events], ['in', 'out', 'in', 'out'])
+        self.assertEqual(os.listdir(self.flight.lock_dir), [])
+
+    def test_unsafe_keys_are_hashed(self):
+        path = self.flight.lock_path('../../etc/passwd')
+        self.assertEqual(os.path.dirname(path), self.flight.lock_dir)
+
+
+class FileResponseTests(SimpleTestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp()
+        with os.fdopen(handle, 'wb') as f:
+            f.write(b'0123456789')
+        self.addCleanup(os.remove, self.path)
+        self.factory = RequestFactory()
+
+    def get(self, **headers):
+        response = file_response(self.factory.get('/', **headers), self.path, 'application/pdf', etag='abc')
+        body = b''.join(response.streaming_content) if response.streaming else response.content
+        response.close()
+        return response, body
+
+    def test_whole_file(self):
+        response, body = self.get()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, b'0123456789')
+        self.assertEqual(response['ETag'], '"abc"')
+
+    def test_range(self):
+        response, body = self.get(HTTP_RANGE='bytes=2-4')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(body, b'234')
+        self.assertEqual(response['Content-Range'], 'bytes 2-4/10')
+
+    def test_suffix_range(self):
+        response, body = self.get(HTTP_RANGE='bytes=-3')
+        self.assertEqual((response.status_code, body), (206, b'789'))
+
+    def test_unsatisfiable_range(self):
+        response, _ = self.get(HTTP_RANGE='bytes=20-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */10')
+
+    def test_stale_if_range_sends_whole_file(self):
+        response, body = self.get(HTTP_RANGE='bytes=2-4', HTTP_IF_RANGE='"old"')
+        self.assertEqual((response.status_code, body), (200, b'0123456789'))
+
+    def test_not_modified(self):
+        response, _ = self.get(HTTP_IF_NONE_MATCH='"abc"')
+        self.assertEqual(response.status_code, 304)
+
+
+class DependencyGraphTests(SimpleTestCase):
+    def graph(self, main, names):
+        edges = {name: [] for name in names}
+        edges['main.tex'] = scan_dependencies(main)
+        return DependencyGraph(edges)
+
+    def test_follows_references(self):
+        graph = self.graph('\\input{ch1}\\includegraphics{fig}\\bibliography{refs}', [
+            'ch1.tex', 'fig.png', 'refs.bib', 'draft.tex',
+        ])
+        self.assertEqual(graph.reachable('main.tex'), ({'main.tex', 'ch1.tex', 'fig.png', 'refs.bib'}, True))
+
+    def test_dynamic_reference_is_incomplete(self):
+        graph = self.graph('\\input{\\chapterdir/intro}', ['intro.tex'])
+        self.assertFalse(graph.reachable('main.tex')[1])
+
+    def test_unrecognised_commands_keep_their_files(self):
+        graph = self.graph(
+            '\\usetheme{mytheme}\\import{sections/}{intro}\\InputIfFileExists{extra.tex}{}{}'
+            '\\includesvg{diagram}\\loadnotes{notes}\\input{chap1}',
+            ['chap1.tex', 'beamerthememytheme.sty', 'sections/intro.tex', 'extra.tex', 'diagram.svg',
+             'notes.txt', 'draft.tex'],
+        )
+        reachable, complete = graph.reachable('main.tex')
+        self.assertEqual(reachable, {
+            'main.tex', 'chap1.tex', 'beamerthememytheme.sty', 'sections/intro.tex', 'extra.tex',
+            'diagram.svg', 'notes.txt',
+        })
+        self.assertTrue(complete)
+        self.assertEqual(graph.unresolved('main.tex'), [])
+
+    def test_unreached_implicit_file_is_incomplete(self):
+        graph = self.graph('\\input{ch1}', ['ch1.tex', 'local.cfg'])
+        self.assertFalse(graph.reachable('main.tex')[1])
+
+
+class SelectiveSourcesTests(ProjectTestCase):
+    def test_unreferenced_files_are_not_loaded(self):
+        File.objects.create(project=self.project, name='draft.tex', content='unused')
+        main_file, related_files = load_project_sources(self.project)
+        self.assertEqual(main_file.id, self.main.id)
+        self.assertEqual(related_files, {'ch1.tex': 'hello world'})
+
+    def test_dynamic_references_load_everything(self):
+        File.objects.create(project=self.project, name='draft.tex', content='unused')
+        self.main.content = '\\documentclass{article}\\begin{document}\\input{\\dir/ch1}\\end{document}'
+        self.main.save()
+        _, related_files = load_project_sources(self.project)
+        self.assertEqual(set(related_files), {'ch1.tex', 'draft.tex'})
+
+
+class PartialCompileTests(ProjectTestCase):
+    def test_unknown_chapter(self):
+        response = self.client.post(
+            f'/api/projects/{self.project.id}/compile/', {'chapters': ['ch2']}, format='json'
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('ch2', response.data['error'])
+
+    def test_partial_compile_needs_aux_of_skipped_chapters(self):
+        work_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, work_dir, True)
+        compiler = LatexCompiler()
+        main = '\\include{ch1}\\include{ch2}'
+        self.assertFalse(compiler.can_compile_partially(work_dir, main, ['ch1']))
+        open(os.path.join(work_dir, 'ch2.aux'), 'w').close()
+        self.assertTrue(compiler.can_compile_partially(work_dir, main, ['ch1']))
+        self.assertEqual(
+            compiler.partial_command(compiler.command, ['ch1'])[-2:],
+            ['-jobname=main', '\\includeonly{ch1}\\input{main.tex}'],
+        )
+
+
+class BibliographyCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+        self.cache = BibliographyCache(os.path.join(self.tmp, 'bbl'), 1024 * 1024)
+        self.runs = []
+
+    def work_dir(self, aux, chapter_aux='', bib='@book{a, title={A}}'):
+        work_dir = tempfile.mkdtemp(dir=self.tmp)
+        for name, content in (('main.aux', aux), ('ch1.aux', chapter_aux), ('refs.bib', bib)):
+            with open(os.path.join(work_dir, name), 'w') as f:
+                f.write(content)
+        return work_dir
+
+    def fake_bibtex(self, command, cwd, **kwargs):
+        self.runs.append(command)
+        with open(os.path.join(cwd, 'main.bbl'), 'w') as f:
+            f.write(bibliography_inputs(cwd)[1][3])
+        return mock.Mock(returncode=0)
+
+    def update(self, work_dir):
+        with mock.patch('subprocess.run', side_effect=self.fake_bibtex):
+            return self.cache.update_bbl(work_dir, {}, timeout=10)
+
+    def test_inputs_follow_included_chapters_in_citation_order(self):
+        work_dir = self.work_dir(
+            '\\citation{b}\\@input{ch1.aux}\\bibdata{refs}\\bibstyle{plain}', '\\citation{a,b}'
+        )
+        tool, parts = bibliography_inputs(work_dir)
+        self.assertEqual(tool, 'bibtex')
+        self.assertEqual(parts[3], 'b\na')
+        self.assertIn('@book{a, title={A}}', parts)
+
+    def test_bbl_is_reused_until_citations_or_bib_change(self):
+        aux = '\\citation{a}\\bibdata{refs}\\bibstyle{plain}'
+        self.assertTrue(self.update(self.work_dir(aux)))
+        # Another edit (labels change, citations don't) reuses the cached .bbl
+        reused = self.work_dir(aux + '\\newlabel{x}{{1}{1}}')
+        self.assertTrue(self.update(reused))
+        self.assertFalse(self.update(reused))
+        self.assertEqual(len(self.runs), 1)
+
+        self.update(self.work_dir(aux.replace('{a}', '{a,b}')))
+        self.update(self.work_dir(aux, bib='@book{a, title={B}}'))
+        self.assertEqual(len(self.runs), 3)
+
+    def test_documents_without_bibliography_skip_bibtex(self):
+        self.assertFalse(self.update(self.work_dir('\\relax')))
+        self.assertEqual(self.runs, [])
+
+
+@override_settings(LATEX_WORKER_POOL=False, LATEX_COMPILE_QUEUE='database')
+class DatabaseQueueTests(FakeTeXMixin, ProjectTestCase):
+    def job(self, age=0, **fields):
+        job = CompileJob.objects.create(project=self.project, requested_by=self.user, **fields)
+        CompileJob.objects.filter(id=job.id).update(created_at=timezone.now() - timedelta(seconds=age))
+        return job
+
+    def test_claims_requested_jobs_first_then_oldest(self):
+        speculative = self.job(age=30, speculative=True)
+        newer = self.job(age=10)
+        older = self.job(age=20)
+        self.job(age=40, run_after=timezone.now() + timedelta(minutes=1))
+        claimed = [jobs.claim_job(f'worker/{n}') for n in range(4)]
+        self.assertEqual([job and job.id for job in claimed], [older.id, newer.id, speculative.id, None])
+        self.assertEqual((claimed[0].status, claimed[0].worker_id, claimed[0].attempts), ('running', 'worker/0', 1))
+
+    def test_dead_workers_jobs_are_requeued_then_failed(self):
+        self.job()
+        job = jobs.claim_job('worker/0')
+        stale = timezone.now() - timedelta(hours=1)
+        CompileJob.objects.filter(id=job.id).update(heartbeat_at=stale)
+        self.assertEqual(jobs.requeue_dead_jobs(), (1, 0))
+        self.assertEqual(jobs.claim_job('worker/1').id, job.id)
+
+        CompileJob.objects.filter(id=job.id).update(heartbeat_at=stale, attempts=3)
+        self.assertEqual(jobs.requeue_dead_jobs(), (0, 1))
+        self.assertEqual(CompileJob.objects.get(id=job.id).status, 'failed')
+
+    def test_result_of_a_requeued_job_is_dropped(self):
+        self.job()
+        job = jobs.claim_job('worker/0')
+        CompileJob.objects.filter(id=job.id).update(heartbeat_at=timezone.now() - timedelta(hours=1))
+        jobs.requeue_dead_jobs()
+        self.assertFalse(jobs.execute_job(job))
+        self.assertEqual(CompileJob.objects.get(id=job.id).status, 'queued')
+
+        job = jobs.claim_job('worker/1')
+        self.assertTrue(jobs.execute_job(job))
+        self.assertEqual(CompileJob.objects.get(id=job.id).status, 'succeeded')
+
+
+class FairSchedulerTests(SimpleTestCase):
+    def scheduler(self, slots=1, **options):
+        options = dict(dict(user_limit=1, project_limit=1, max_queue=8, user_queue=8, max_wait=0.2), **options)
+        return FairScheduler(slots=slots, **options)
+
+    def grant_order(self, scheduler, waiters):
+        """Users in the order their compiles get the single slot, releasing each as it's granted"""
+        order = []
+        while True:
+            running = [waiter for waiter in waiters if waiter.granted and waiter not in order]
+            if not running:
+                return [waiter.user_id for waiter in order]
+            order.append(running[0])
+            scheduler._release(running[0])
+
+    def test_users_share_slots_fairly(self):
+        scheduler = self.scheduler(project_limit=8)
+        enqueue = lambda user, project: scheduler._enqueue(user, project, admission=True)
+        waiters = [enqueue('a', 1), enqueue('a', 2), enqueue('a', 3), enqueue('b', 4)]
+        self.assertTrue(waiters[0].granted)
+        # b's first compile goes before a's second and third
+        self.assertEqual(self.grant_order(scheduler, waiters), ['a', 'b', 'a', 'a'])
+
+    def test_weights(self):
+        scheduler = self.scheduler(project_limit=8, weights={'heavy': 2})
+        enqueue = lambda user, project: scheduler._enqueue(user, project, admission=True)
+        waiters = [enqueue('light', 0)] + [enqueue(user, n) for n, user in enumerate(['light'] * 2 + ['heavy'] * 4, 1)]
+        # Twice the share while both are waiting
+        self.assertEqual(
+            self.grant_order(scheduler, waiters), ['light', 'heavy', 'heavy', 'heavy', 'light', 'heavy', 'light']
+        )
+
+    def test_per_user_limit(self):
+        scheduler = self.scheduler(slots=2)
+        first = scheduler._enqueue('a', 1, admission=True)
+        second = scheduler._enqueue('a', 2, admission=True)
+        other = scheduler._enqueue('b', 3, admission=True)
+        self.assertEqual((first.granted, second.granted, other.granted), (True, False, True))
+
+    def test_full_queue_is_rejected(self):
+        scheduler = self.scheduler(max_queue=1)
+        scheduler._enqueue('a', 1, admission=True)
+        scheduler._enqueue('b', 2, admission=True)
+        with self.assertRaises(SchedulerBusy) as busy:
+            scheduler._enqueue('c', 3, admission=True)
+        self.assertGreaterEqual(busy.exception.retry_after, 1)
+        # Background jobs are never turned away
+        scheduler._enqueue('c', 3, admission=False)
+
+    def test_waiting_past_max_wait_is_rejected(self):
+        scheduler = self.scheduler()
+        with scheduler.slot('a', 1):
+            with self.assertRaises(SchedulerBusy):
+                with scheduler.slot('b', 2):
+                    pass
+        self.assertEqual(scheduler.stats()['queued'], 0)
+
+    def test_speculative_compiles_leave_reserved_slots(self):
+        scheduler = self.scheduler(slots=3, reserved=1)
+        with scheduler.slot(None, 1, speculative=True), scheduler.slot(None, 2, speculative=True):
+            with self.assertRaises(SchedulerBusy):
+                with scheduler.slot(None, 3, speculative=True):
+                    pass
+            # Requested compiles still get the reserved slot
+            with scheduler.slot('a', 4):
+                self.assertEqual(scheduler.stats()['running'], 3)
+
+
+class ArtifactStoreTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, True)
+        self.store = ArtifactStore(os.path.join(self.tmp, 'store'), keep_per_project=2, max_age=3600, grace_seconds=60)
+        self.project = Project.objects.create(name='Thesis', owner=User.objects.create_user('owner'))
+
+    def output(self, name, content):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def artifact(self, pdf, age=0):
+        digest, size = self.store.put_file(self.output('main.pdf', pdf))
+        artifact = CompileArtifact.objects.create(project=self.project, pdf_digest=digest, sizes={'pdf': size})
+        CompileArtifact.objects.filter(id=artifact.id).update(created_at=timezone.now() - timedelta(seconds=age))
+        return artifact
+
+    def age(self, digest, seconds):
+        path = self.store.path_for(digest)
+        os.utime(path, (time.time() - seconds,) * 2)
+
+    def test_identical_outputs_are_stored_once(self):
+        first = self.store.collect(self.output('a.pdf', b'%PDF same'), success=True)
+        second = self.store.collect(self.output('b.pdf', b'%PDF same'), success=True)
+        self.assertEqual(first, second)
+        self.assertEqual(self.store.count(), (1, len(b'%PDF same')))
+
+    def test_failed_compiles_keep_only_the_log(self):
+        output = self.output('main.pdf', b'%PDF partial')
+        self.output('main.pdf.log', b'! Emergency stop.')
+        self.assertEqual(set(self.store.collect(output, success=False)), {'log'})
+
+    def test_prune_keeps_newest_rows(self):
+        artifacts = [self.artifact(b'%%PDF %d' % n, age=30 - n) for n in range(4)]
+        self.assertEqual(self.store.prune_project(self.project.id), 2)
+        kept = set(CompileArtifact.objects.values_list('id', flat=True))
+        self.assertEqual(kept, {artifacts[2].id, artifacts[3].id})
+
+    def test_sweep_removes_expired_rows_and_unreferenced_files(self):
+        expired = self.artifact(b'%PDF old', age=7200)
+        current = self.artifact(b'%PDF new')
+        orphan, _ = self.store.put_file(self.output('orphan.pdf', b'%PDF orphan'))
+        for digest in (expired.pdf_digest, current.pdf_digest, orphan):
+            self.age(digest, 120)
+        # Too new to tell from a compile whose row isn't saved yet
+        fresh, _ = self.store.put_file(self.output('fresh.pdf', b'%PDF fresh'))
+
+        removed = self.store.sweep()
+        self.assertEqual((removed['rows'], removed['files']), (1, 2))
+        self.assertEqual(list(CompileArtifact.objects.values_list('id', flat=True)), [current.id])
+        for digest, exists in ((expired.pdf_digest, False), (orphan, False), (current.pdf_digest, True), (fresh, True)):
+            self.assertEqual(os.path.exists(self.store.path_for(digest)), exists)
+        self.assertEqual(self.store.stats()['files'], 2)
+
+
+class MaterializedPathTests(ProjectTestCase):
+    def setUp(self):
+        super().setUp()
+        self.chapters = Folder.objects.create(project=self.project, name='chapters')
+        self.drafts = Folder.objects.create(project=self.project, name='drafts', parent=self.chapters)
+        self.intro = File.objects.create(project=self.project, folder=self.chapters, name='intro.tex')
+        self.old = File.objects.create(project=self.project, folder=self.drafts, name='old.tex')
+
+    def test_paths_are_stored_on_save(self):
+        self.assertEqual(self.drafts.path, 'chapters/drafts')
+        self.assertEqual(self.old.path, 'chapters/drafts/old.tex')
+        self.assertEqual(self.main.path, 'main.tex')
+
+    def test_rename_moves_the_subtree(self):
+        self.chapters.name = 'parts'
+        self.chapters.save()
+        self.assertEqual(Folder.objects.get(id=self.drafts.id).path, 'parts/drafts')
+        self.assertEqual(File.objects.get(id=self.old.id).path, 'parts/drafts/old.tex')
+
+    def test_move_into_another_folder(self):
+        archive = Folder.objects.create(project=self.project, name='archive')
+        self.drafts.parent = archive
+        self.drafts.save()
+        self.assertEqual(File.objects.get(id=self.old.id).path, 'archive/drafts/old.tex')
+        self.assertEqual(list(self.chapters.subtree_files()), [self.intro])
+
+    def test_subtree_queries(self):
+        self.assertEqual(list(self.chapters.subtree_folders()), [self.drafts])
+        self.assertEqual({f.id for f in self.chapters.subtree_files()}, {self.intro.id, self.old.id})
+
+    def test_recursive_listing(self):
+        response = self.client.get('/api/files/files/', {'folder': self.chapters.id, 'recursive': 'true'})
+        self.assertEqual(response.status_code, 200)
+        results = response.data['results'] if isinstance(response.data, dict) else response.data
+        self.assertEqual({item['id'] for item in results}, {self.intro.id, self.old.id})
+
+
+class ProjectTreeTests(ProjectTestCase):
+    def url(self, project_id=None):
+        return f'/api/projects/{project_id or self.project.id}/tree/'
+
+    def test_tree_lists_folders_and_files(self):
+        folder = Folder.objects.create(project=self.project, name='chapters')
+        intro = File.objects.create(project=self.project, folder=folder, name='intro.tex', content='x')
+        response = self.client.get(self.url())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['root'], {'folders': [folder.id], 'files': [self.chapter.id, self.main.id]})
+        self.assertEqual(response.data['folders'][folder.id]['files'], [intro.id])
+        self.assertEqual(response.data['files'][intro.id]['path'], 'chapters/intro.tex')
+        self.assertNotIn('content', response.data['files'][intro.id])
+
+    def test_not_modified_until_the_tree_changes(self):
+        etag = self.client.get(self.url())['ETag']
+        response = self.client.get(self.url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        File.objects.create(project=self.project, name='ch2.tex')
+        response = self.client.get(self.url(), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_other_users_projects_are_not_found(self):
+        other = Project.objects.create(name='Other', owner=User.objects.create_user('other'))
+        self.assertEqual(self.client.get(self.url(other.id)).status_code, 404)
+        self.assertEqual(self.client.get('/api/projects/abc/tree/').status_code, 404)
+
+
+class EditsTests(SimpleTestCase):
+    def test_apply_edits_uses_base_offsets(self):
+        self.assertEqual(apply_edits('hello world', [(6, 11, 'there'), (0, 0, '> ')]), '> hello there')
+
+    def test_apply_edits_rejects_bad_ranges(self):
+        with self.assertRaises(EditError):
+            apply_edits('hello', [(0, 3, ''), (2, 4, '')])
+        with self.assertRaises(EditError):
+            apply_edits('hello', [(4, 9, '')])
+
+    def assertConverges(self, content, ours, theirs):
+        # Server order: theirs first; client order: ours first, then theirs rebased
+        server = apply_edits(apply_edits(content, theirs), transform_edits(ours, theirs))
+        client = apply_edits(apply_edits(content, ours), transform_edits(theirs, ours, applied_first=False))
+        self.assertEqual(server, client)
+        return server
+
+    def test_transform_concurrent_inserts(self):
+        self.assertEqual(self.assertConverges('abc', [(1, 1, 'X')], [(1, 1, 'Y')]), 'aYXbc')
+
+    def test_transform_overlapping_deletes(self):
+        self.assertEqual(self.assertConverges('abcdef', [(1, 4, '')], [(2, 5, 'Z')]), 'aZf')
+
+    def test_transform_edit_inside_deleted_text(self):
+        self.assertEqual(self.assertConverges('abcdef', [(2, 3, 'X')], [(1, 5, '')]), 'aXf')
+
+
+class EditsEndpointTests(ProjectTestCase):
+    def post(self, base, edits):
+        return self.client.post(
+            f'/api/files/files/{self.chapter.id}/edits/', {'base': base, 'edits': edits}, format='json'
+        )
+
+    def test_edits_save_new_content(self):
+        response = self.post(self.chapter.blob_id, [{'start': 6, 'end': 11, 'text': 'there'}])
+        self.assertEqual(response.status_code, 200)
+        chapter = File.objects.get(id=self.chapter.id)
+        self.assertEqual(chapter.content, 'hello there')
+        self.assertEqual(response.data['hash'], chapter.blob_id)
+
+    def test_stale_base_conflicts(self):
+        base = self.chapter.blob_id
+        edits = [{'start': 6, 'end': 11, 'text': 'there'}]
+        self.assertEqual(self.post(base, edits).status_code, 200)
+        # The same edits against the old content conflict
+        response = self.post(base, edits)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data['hash'], File.objects.get(id=self.chapter.id).blob_id)
+
+    def test_invalid_edits_are_rejected(self):
+        self.assertEqual(self.post('', []).status_code, 400)
+        self.assertEqual(self.post(self.chapter.blob_id, [{'start': 4, 'end': 99, 'text': ''}]).status_code, 400)
+        self.assertEqual(File.objects.get(id=self.chapter.id).content, 'hello world')
+
+    def test_losing_a_race_conflicts(self):
+        base = self.chapter.blob_id
+        File.objects.filter(id=self.chapter.id).update(blob=FileBlob.objects.for_content('changed'))
+        self.assertFalse(self.chapter.replace_content(base, 'hello there'))
+        self.assertEqual(File.objects.get(id=self.chapter.id).content, 'changed')
@@ -0,0 +1,68 @@
+import hashlib
+from django.db.models import Count, Max, OuterRef, Subquery
+from .models import File, Folder
+
+
+def _aggregate(model, function):
+    return Subquery(
+        model.objects.filter(project=OuterRef('pk')).order_by().values('project')
+        .annotate(value=function).values('value')[:1]
+    )
+
+
+def with_tree_version(projects):
+    """
+    Annotate a Project queryset with what tree_version() needs, so fetching
+    the project and its version is a single query
+    """
+    return projects.annotate(
+        tree_folder_count=_aggregate(Folder, Count('id')),
+        tree_folder_updated=_aggregate(Folder, Max('updated_at')),
+        tree_file_count=_aggregate(File, Count('id')),
+        tree_file_updated=_aggregate(File, Max('updated_at')),
+    )
+
+
+def tree_version(project):
+    """
+    Version tag of a project's tree, from a project annotated by with_tree_version()
+
+    Creating, renaming, moving or deleting a folder or file changes either a
+    count or the latest updated_at, so the tag changes with the tree.
+    """
+    parts = (
+        project.pk, project.tree_folder_count, project.tree_folder_updated,
+        project.tree_file_count, project.tree_file_updated,
+    )
+    return hashlib.sha256(repr(parts).encode('utf-8')).hexdigest()[:32]
+
+
+def build_tree(project):
+    """
+    Load a project's folders and file metadata (never content) in two
+    queries and assemble the tree in memory
+
+    Returns:
+        dict: root ({folders, files} id lists), folders ({id: {name, path,
+        parent, folders, files}}) and files ({id: {name, path, folder,
+        is_main, updated_at}}); child id lists are sorted by name
+    """
+    folders = {
+        folder_id: {'name': name, 'path': path, 'parent': parent_id, 'folders': [], 'files': []}
+        for folder_id, name, path, parent_id in Folder.objects.filter(project=project)
+        .order_by('name').values_list('id', 'name', 'path', 'parent_id')
+    }
+    files = {
+        file_id: {'name': name, 'path': path, 'folder': folder_id, 'is_main': is_main, 'updated_at': updated_at}
+        for file_id, name, path, folder_id, is_main, updated_at in File.objects.filter(project=project)
+        .order_by('name').values_list('id', 'name', 'path', 'folder_id', 'is_main', 'updated_at')
+    }
+
+    root = {'folders': [], 'files': []}
+    for folder_id, folder in folders.items():
+        parent = folders.get(folder['parent'], root)
+        parent['folders'].append(folder_id)
+    for file_id, file in files.items():
+        parent = folders.get(file['folder'], root)
+        parent['files'].append(file_id)
+    return {'root': root, 'folders': folders, 'files': files}
@@ -3,7 +3,10 @@ from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from .models import File, Folder, GitFile
-from .serializers import FileSerializer, FolderSerializer, GitFileSerializer
+from .serializers import FileSerializer, FileMetadataSerializer, FolderSerializer, GitFileSerializer
+from .jobs import schedule_speculative_compile
+from .edits import EditError, apply_edits, parse_edits
+from . import metrics
 from apps.projects.models import Project
 from rest_framework.exceptions import ValidationError
 # Create your views here.
@@ -38,6 +41,13 @@ class FileViewSet(viewsets.ModelViewSet):
     serializer_class = FileSerializer
     permission_classes = [permissions.IsAuthenticated]
     
+    def include_content(self):
+        # Listings leave content out unless asked for (?content=true)
+        return self.action != 'list' or self.request.query_params.get('content') in ('1', 'true', 'yes')
+    
+    def get_serializer_class(self):
+        return FileSerializer if self.include_content() else FileMetadataSerializer
+    
     def get_queryset(self):
         # Check if this is a schema generation request
         if getattr(self, 'swagger_fake_view', False):
@@ -47,13 +57,22 @@ class FileViewSet(viewsets.ModelViewSet):
         project_id = self.request.query_params.get('project', None)
         folder_id = self.request.query_params.get('folder', None)
         
-        queryset = File.objects.filter(project__owner=self.request.user)
+        queryset = File.objects.filter(project__owner=self.request.user).select_related('folder')
+        if self.include_content():
+            queryset = queryset.select_related('blob')
         
         if project_id:
             queryset = queryset.filter(project_id=project_id)
         
         if folder_id:
-            queryset = queryset.filter(folder_id=folder_id)
+            if self.request.query_params.get('recursive') in ('1', 'true', 'yes'):
+                # Everything below the folder, in one prefix query on the stored path
+                folder = Folder.objects.filter(id=folder_id, project__owner=self.request.user).first()
+                if folder is None:
+                    return queryset.none()
+                queryset = queryset.filter(project_id=folder.project_id, path__startswith=folder.path + '/')
+            else:
+                queryset = queryset.filter(folder_id=folder_id)
         
         return queryset
     
@@ -89,6 +108,65 @@ class FileViewSet(viewsets.ModelViewSet):
         # Case 3: Neither project nor folder specified
         else:
             raise ValidationError({"error": "Either project or folder must be specified"})
+    
+    def perform_update(self, serializer):
+        previous_hash = serializer.instance.blob_id
+        file = serializer.save()
+        # Renames, moves and is_main toggles don't warrant a speculative compile
+        if 'content' in serializer.validated_data and file.blob_id != previous_hash:
+            self.content_saved(file)
+    
+    def content_saved(self, file):
+        if file.project.speculative_compile:
+            # Have the PDF ready by the time the user asks for a compile
+            schedule_speculative_compile(file.project, self.request.user)
+    
+    @action(detail=True, methods=['post'])
+    def edits(self, request, pk=None):
+        """
+        Save a change as a list of edits instead of the whole content
+        
+        Body: {"base": hash of the content the edits were made against,
+        "edits": [{"start": int, "end": int, "text": str}, ...]}. Offsets
+        are characters of the base content; see edits.apply_edits().
+        
+        Returns the new hash, or 409 with the current hash if the file
+        changed since `base` (fetch it again and rebase the edits).
+        """
+        base = request.data.get('base')
+        if not isinstance(base, str) or not base:
+            return Response({"error": "base (the hash the edits apply to) is required"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            edits = parse_edits(request.data.get('edits'))
+        except EditError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        
+        file = self.get_object()
+        if file.blob_id != base:
+            metrics.incr('files.edit_conflicts')
+            return Response({"error": "The file has changed since base", "hash": file.blob_id},
+                            status=status.HTTP_409_CONFLICT)
+        try:
+            content = apply_edits(file.content, edits)
+        except EditError as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        if not file.replace_content(base, content):
+            # Another save landed between reading and writing
+            metrics.incr('files.edit_conflicts')
+            current = File.objects.filter(pk=file.pk).values_list('blob_id', flat=True).first()
+            return Response({"error": "The file has changed since base", "hash": current},
+                            status=status.HTTP_409_CONFLICT)
+        
+        metrics.incr('files.edits')
+        metrics.incr('files.edit_bytes', sum(len(text.encode('utf-8')) for _, _, text in edits))
+        self.content_saved(file)
+        return Response({
+            'id': file.id,
+            'hash': file.blob_id,
+            'size': file.blob.size,
+            'updated_at': file.updated_at,
+        })
 
 class FolderViewSet(viewsets.ModelViewSet):
     """
@@ -110,7 +188,12 @@ class FolderViewSet(viewsets.ModelViewSet):
         if project_id:
             queryset = queryset.filter(project_id=project_id)
         
-        if parent_id:
+        if parent_id and self.request.query_params.get('recursive') in ('1', 'true', 'yes'):
+            parent = Folder.objects.filter(id=parent_id, project__owner=self.request.user).first()
+            if parent is None:
+                return queryset.none()
+            queryset = queryset.filter(project_id=parent.project_id, path__startswith=parent.path + '/')
+        elif parent_id:
             queryset = queryset.filter(parent_id=parent_id)
         else:
             # If no parent specified, get root folders
@@ -0,0 +1,195 @@
+import asyncio
+import json
+import re
+import time
+from urllib.parse import parse_qs
+from django.db.models import Q
+from .collab import StaleRevision, database_sync_to_async, get_collab_hub
+from .edits import EditError, parse_edits
+from .models import File
+from . import metrics
+
+# WebSocket protocol, JSON text frames, one connection per open file:
+#
+#   server: {"type": "init", "rev", "content", "hash", "client"}
+#   client: {"type": "op", "rev", "edits": [{"start", "end", "text"}], "id"}
+#       edits made against revision `rev`, as in FileViewSet.edits
+#   server: {"type": "ack", "rev", "id"} to the sender, and
+#           {"type": "op", "rev", "edits", "client"} to everyone else
+#   server: {"type": "batch", "messages": [...]} when several are queued
+#   server: {"type": "error", "error"}
+#
+# A client keeps at most one op unacknowledged. Ops arriving meanwhile
+# are applied after transform_edits(op, pending, applied_first=False),
+# and the pending edits are rebased with transform_edits(pending, op).
+
+FILE_PATH = re.compile(r'^/ws/files/(?P<file_id>\d+)/?$')
+
+# Close codes
+CLOSE_NOT_FOUND = 4404
+CLOSE_UNAUTHORIZED = 4401
+CLOSE_FORBIDDEN = 4403
+CLOSE_STALE = 4409  # Reconnect to get the current content
+CLOSE_GONE = 4410  # The file was deleted
+
+
+@database_sync_to_async
+def _authenticate(token):
+    from rest_framework_simplejwt.authentication import JWTAuthentication
+    from rest_framework_simplejwt.exceptions import InvalidToken, AuthenticationFailed
+
+    authentication = JWTAuthentication()
+    try:
+        return authentication.get_user(authentication.get_validated_token(token))
+    except (InvalidToken, AuthenticationFailed):
+        return None
+
+
+@database_sync_to_async
+def _can_edit(user, file_id):
+    return File.objects.filter(
+        Q(project__owner=user) | Q(project__collaborators=user), id=file_id
+    ).exists()
+
+
+async def authenticate(scope):
+    """The user of a connection: scope['user'] if middleware set one, else the JWT in ?token="""
+    user = scope.get('user')
+    if user is not None and user.is_authenticated:
+        return user
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    token = query.get('token', [None])[0]
+    return await _authenticate(token) if token else None
+
+
+def _wire_edits(edits):
+    return [{'start': start, 'end': end, 'text': text} for start, end, text in edits]
+
+
+class CollabConnection:
+    """One client's WebSocket connection to the document of a file"""
+
+    def __init__(self, hub, receive, send):
+        self.hub = hub
+        self.receive = receive
+        self.send = send
+        self.channel = hub.layer.new_channel()
+        self.document = None
+        self.client_id = None
+
+    async def run(self, file_id):
+        self.document, self.client_id = await self.hub.join(file_id, self.channel)
+        if self.document is None:
+            await self.close(CLOSE_NOT_FOUND)
+            return
+        await self.send_json({
+            'type': 'init',
+            'rev': self.document.revision,
+            'content': self.document.content,
+            'hash': self.document.saved_hash,
+            'client': self.client_id,
+        })
+        writer = asyncio.ensure_future(self.write())
+        try:
+            await self.read()
+        finally:
+            writer.cancel()
+            self.hub.layer.close_channel(self.channel)
+            await self.hub.leave(self.document, self.channel)
+
+    async def read(self):
+        while True:
+            event = await self.receive()
+            if event['type'] == 'websocket.disconnect':
+                return
+            if event['type'] != 'websocket.receive':
+                continue
+            try:
+                message = json.loads(event.get('text') or event.get('bytes') or '')
+            except ValueError:
+                await self.send_json({'type': 'error', 'error': "Messages must be JSON"})
+                continue
+            if not isinstance(message, dict) or message.get('type') != 'op':
+                await self.send_json({'type': 'error', 'error': "Unknown message type"})
+                continue
+            revision = message.get('rev')
+            try:
+                if type(revision) is not int:
+                    raise EditError("rev must be an integer")
+                edits = parse_edits(message.get('edits'))
+                await self.hub.submit(
+                    self.document, self.channel, self.client_id, revision, edits, message.get('id')
+                )
+            except EditError as e:
+                metrics.incr('collab.rejected')
+                await self.send_json({'type': 'error', 'error': str(e), 'id': message.get('id')})
+            except StaleRevision as e:
+                metrics.incr('collab.stale')
+                await self.send_json({'type': 'error', 'error': str(e), 'id': message.get('id')})
+                await self.close(CLOSE_STALE)
+                return
+
+    async def write(self):
+        """Forward the document's messages to the socket, batching whatever has queued up"""
+        layer = self.hub.layer
+        while True:
+            messages = [await layer.receive(self.channel)] + layer.pending(self.channel)
+            outgoing = []
+            for message in messages:
+                if message['type'] == 'overflow':
+                    await self.close(CLOSE_STALE)
+                    return
+                if message['type'] == 'close':
+                    await self.close(CLOSE_GONE)
+                    return
+                outgoing.append(self.outgoing(message))
+            if len(outgoing) == 1:
+                await self.send_json(outgoing[0])
+            else:
+                await self.send_json({'type': 'batch', 'messages': outgoing})
+            now = time.monotonic()
+            for message in messages:
+                metrics.observe('collab.fanout', now - message['sent_at'])
+
+    def outgoing(self, message):
+        if message['origin'] == self.channel:
+            return {'type': 'ack', 'rev': message['rev'], 'id': message['id']}
+        return {
+            'type': 'op',
+            'rev': message['rev'],
+            'edits': _wire_edits(message['edits']),
+            'client': message['client'],
+        }
+
+    async def send_json(self, message):
+        await self.send({'type': 'websocket.send', 'text': json.dumps(message)})
+
+    async def close(self, code):
+        await self.send({'type': 'websocket.close', 'code': code})
+
+
+async def collab_application(scope, receive, send):
+    """
+    ASGI application for collaborative editing, at /ws/files/<file id>/
+
+    Browsers can't set headers on WebSocket requests, so the JWT access
+    token goes in the query string (?token=...). Owners and collaborators
+    of the file's project may connect.
+    """
+    event = await receive()
+    if event['type'] != 'websocket.connect':
+        return
+    match = FILE_PATH.match(scope['path'])
+    if match is None:
+        await send({'type': 'websocket.close', 'code': CLOSE_NOT_FOUND})
+        return
+    file_id = int(match.group('file_id'))
+    user = await authenticate(scope)
+    if user is None:
+        await send({'type': 'websocket.close', 'code': CLOSE_UNAUTHORIZED})
+        return
+    if not await _can_edit(user, file_id):
+        await send({'type': 'websocket.close', 'code': CLOSE_FORBIDDEN})
+        return
+    await send({'type': 'websocket.accept'})
+    await CollabConnection(get_collab_hub(), receive, send).run(file_id)
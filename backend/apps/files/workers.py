@@ -0,0 +1,217 @@
+import multiprocessing
+import os
+import queue
+import signal
+import resource
+import subprocess
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from django.conf import settings
+from . import metrics
+
+# Pool of long-lived compile worker processes. Each worker builds its
+# LatexCompiler once, warms the TeX file-name database at startup and runs
+# pdflatex under CPU-time and memory rlimits. Jobs run in their own
+# processes, so the web workers never spawn pdflatex themselves.
+
+# Lookups that make kpathsea load its ls-R databases into memory (and the
+# OS page cache) before the first real compile
+KPATHSEA_WARMUP = ['kpsewhich', 'article.cls', 'amsmath.sty', 'hyperref.sty', 'tikz.sty']
+
+_compiler = None
+
+
+def _init_worker():
+    """Initializer for each worker process"""
+    global _compiler
+    # Lead a process group of our own, so a hung worker can be killed
+    # together with the pdflatex it is running
+    os.setsid()
+    import django
+    django.setup()
+
+    from .LaTeX import LatexCompiler
+    _compiler = LatexCompiler()
+    _compiler.apply_rlimits = True
+    try:
+        subprocess.run(KPATHSEA_WARMUP, capture_output=True, timeout=30)
+    except (OSError, subprocess.TimeoutExpired):
+        pass
+
+
+def _ping():
+    return True
+
+
+def _run_compile(main_tex_content, related_files, build_key, output_path, preview, include_only, profile):
+    """Compile inside a worker process and report what it cost"""
+    metrics.reset()
+    usage_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.monotonic()
+
+    success, result = _compiler.compile_latex(
+        main_tex_content, related_files, build_key=build_key, output_path=output_path, preview=preview,
+        include_only=include_only, profile=profile
+    )
+
+    usage_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    usage = {
+        'wall_seconds': round(time.monotonic() - started, 3),
+        'cpu_seconds': round(
+            (usage_after.ru_utime - usage_before.ru_utime)
+            + (usage_after.ru_stime - usage_before.ru_stime), 3
+        ),
+        # ru_maxrss of RUSAGE_CHILDREN: the largest pdflatex run of this
+        # worker process's lifetime, not of this job (workers are reused)
+        'worker_max_rss_kb': usage_after.ru_maxrss,
+    }
+    return {
+        'success': success,
+        'result': result,
+        'passes': _compiler.passes,
+        'partial': _compiler.partial,
+        'profile': _compiler.profile,
+        'diagnostics': _compiler.diagnostics,
+        'usage': usage,
+        'metrics': metrics.snapshot(),
+    }
+
+
+class CompileWorkerPool:
+    """
+    Hands compiles to a fixed set of pre-started worker processes
+
+    Every worker is a single-process executor of its own, used by one
+    compile at a time. A ProcessPoolExecutor shared by all workers breaks
+    as a whole when one of its processes dies, taking every running compile
+    with it; this way a worker that crashes or hangs is replaced alone.
+    """
+
+    def __init__(self, processes, max_jobs_per_worker=None, job_timeout=None):
+        self.processes = processes
+        self.max_jobs_per_worker = max_jobs_per_worker
+        # Longest a job may run once it has a worker; past it the worker is
+        # assumed hung and is killed and replaced. Waiting for a free
+        # worker doesn't count.
+        self.job_timeout = job_timeout
+        # Idle workers. None stands for a worker that has to be (re)started.
+        self._idle = queue.Queue()
+        self._started = False
+        self._lock = threading.Lock()
+
+    def _new_worker(self):
+        return ProcessPoolExecutor(
+            max_workers=1,
+            # spawn, not fork: the web process is multi-threaded
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            # Recycle the process now and then so leaks can't build up
+            max_tasks_per_child=self.max_jobs_per_worker,
+        )
+
+    def start(self):
+        """Start every worker now instead of on the first compiles"""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+            workers = [self._new_worker() for _ in range(self.processes)]
+            pings = [worker.submit(_ping) for worker in workers]
+            for worker, ping in zip(workers, pings):
+                try:
+                    ping.result()
+                except BrokenProcessPool:
+                    self._discard(worker)
+                    worker = None
+                self._idle.put(worker)
+
+    def _discard(self, worker, kill=False):
+        """Shut a failed worker down; the caller puts None back in its place"""
+        if kill:
+            # shutdown() waits for the running job, and a hung one never
+            # finishes. The worker leads its own process group (see
+            # _init_worker), so this takes its pdflatex along.
+            for process in list((getattr(worker, '_processes', None) or {}).values()):
+                try:
+                    os.killpg(process.pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+        worker.shutdown(wait=False, cancel_futures=True)
+
+    def compile(self, main_tex_content, related_files, build_key=None, output_path=None, preview=False,
+                include_only=None, profile=False):
+        """
+        Run a compile on a worker process
+
+        The PDF is moved to `output_path` by the worker, so it never has to
+        be sent back through the pool.
+
+        Returns:
+            dict: success, result (output_path or error message), passes, partial, usage, profile and diagnostics
+        """
+        self.start()
+        # Blocks while every worker is busy (the scheduler may admit more
+        # compiles than there are workers)
+        worker = self._idle.get()
+        try:
+            if worker is None:
+                worker = self._new_worker()
+                # Start it before the job's clock starts
+                worker.submit(_ping).result()
+            outcome = worker.submit(
+                _run_compile, main_tex_content, related_files, build_key, output_path, preview, include_only,
+                profile
+            ).result(timeout=self.job_timeout)
+        except BrokenProcessPool:
+            # The worker died (e.g. killed by the OOM killer); start a fresh one
+            metrics.incr('compile_workers.crashes')
+            self._discard(worker)
+            worker = None
+            return self.failed("Compile worker crashed")
+        except TimeoutError:
+            metrics.incr('compile_workers.timeouts')
+            self._discard(worker, kill=True)
+            worker = None
+            return self.failed("Compile worker stopped responding")
+        finally:
+            self._idle.put(worker)
+
+        metrics.merge(outcome.pop('metrics'))
+        usage = outcome['usage']
+        metrics.observe('compile_workers.cpu', usage['cpu_seconds'])
+        metrics.observe('compile_workers.wall', usage['wall_seconds'])
+        return outcome
+
+    @staticmethod
+    def failed(message):
+        return {
+            'success': False,
+            'result': message,
+            'passes': 0,
+            'partial': False,
+            'usage': {},
+            'profile': None,
+            'diagnostics': [],
+        }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_worker_pool():
+    """Return the process-wide compile worker pool"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = CompileWorkerPool(
+                    getattr(settings, 'LATEX_WORKER_PROCESSES', 2),
+                    getattr(settings, 'LATEX_WORKER_MAX_JOBS', 200),
+                    # The compile stops itself at the wall limit; allow for
+                    # starting a recycled worker and handing the result back
+                    job_timeout=getattr(settings, 'LATEX_WALL_TIME_LIMIT', 120) + 30,
+                )
+    return _pool
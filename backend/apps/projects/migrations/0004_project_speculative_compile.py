@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-17 13:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('projects', '0003_project_is_github_repo'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='speculative_compile',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -27,6 +27,9 @@ class Project(models.Model):
     github_repo = models.CharField(max_length=255, blank=True, null=True)  # e.g. 'username/repo-name'
     github_branch = models.CharField(max_length=255, default='main')
 
+    # Compile in the background after file saves so the PDF is ready when asked for
+    speculative_compile = models.BooleanField(default=False)
+
 
     def __str__(self):
         return self.name
@@ -35,7 +35,8 @@ class ProjectSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Project
-        fields = ['id', 'name', 'description', 'owner', 'files', 'folders', 'created_at', 'updated_at']
+        fields = ['id', 'name', 'description', 'owner', 'files', 'folders', 'speculative_compile',
+                  'created_at', 'updated_at']
         read_only_fields = ['owner']
 
 
@@ -1,13 +1,70 @@
+import re
 from rest_framework import viewsets, permissions, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from django.http import HttpResponse
+from django.core.exceptions import ValidationError
+from rest_framework.exceptions import NotFound
+from rest_framework.generics import get_object_or_404
+from django.urls import reverse
+from django.http import HttpResponseNotModified
+from django.utils.http import parse_etags, quote_etag
+from django.conf import settings
+from django.db.models import Prefetch
 from .models import Project
 from .serializers import ProjectSerializer, ProjectListSerializer, ProjectStructureSerializer
-from apps.files.models import File
-from apps.files.LaTeX import LatexCompiler
+from apps.files.cache import get_compile_cache
+from apps.files.formats import get_format_cache
+from apps.files.bibliography import get_bibliography_cache
+from apps.files.pipeline import (
+    load_project_sources, compile_sources, compile_flight_stats, lookup_compiled_pdf,
+    optimize_outcome, CompileOutcome, project_dependency_graph, project_file_ids, project_compile_keys
+)
+from apps.files.diagnostics import attach_file_ids, get_diagnostics_store
+from apps.files.synctex import get_synctex_store
+from apps.files.scheduler import SchedulerBusy, get_scheduler
+from apps.files.artifacts import ARTIFACT_KINDS, get_artifact_store, record_artifact
+from apps.files.tree import build_tree, tree_version, with_tree_version
+from apps.files.collab import collab_stats
+from apps.files.responses import file_response
+from apps.files.deps import scan_dependencies
+from apps.files.preview import get_preview_renderer, parse_page_list
+from apps.files.jobs import enqueue_compile, start_local_monitor, uses_database_queue
+from apps.files.models import File, CompileJob, CompileArtifact
+from apps.files.serializers import CompileJobSerializer, CompileArtifactSerializer
+from apps.files import metrics
 from rest_framework.pagination import PageNumberPagination
 
+def request_flag(request, name, default=False):
+    """Read a boolean option from the request body or query string"""
+    value = request.data.get(name, request.query_params.get(name))
+    if value is None:
+        return default
+    return str(value).lower() in ('1', 'true', 'yes')
+
+def requested_chapters(request, main_tex_content):
+    """
+    Read the `chapters` compile option: \\include targets of the main file
+    to typeset, as a list or a comma separated string
+
+    Raises:
+        ValueError: If a chapter isn't \\include'd by the main file
+    """
+    value = request.data.get('chapters', request.query_params.get('chapters'))
+    if not value:
+        return None
+    if isinstance(value, str):
+        value = value.split(',')
+    chapters = [str(name).strip() for name in value if str(name).strip()]
+    chapters = [name[:-4] if name.endswith('.tex') else name for name in chapters]
+    available = [target for kind, target in scan_dependencies(main_tex_content) if kind == 'include']
+    unknown = [name for name in chapters if name not in available]
+    if unknown:
+        raise ValueError(
+            f"Not included by the main file: {', '.join(unknown)}. "
+            f"Available chapters: {', '.join(available) or 'none'}"
+        )
+    return chapters or None
+
 class StandardResultsSetPagination(PageNumberPagination):
     page_size = 10
     page_size_query_param = 'page_size'
@@ -33,7 +90,13 @@ class ProjectViewSet(viewsets.ModelViewSet):
             return Project.objects.none()
             
         # Return only projects owned by the current user
-        return Project.objects.filter(owner=self.request.user)
+        queryset = Project.objects.filter(owner=self.request.user)
+        if self.action == 'retrieve':
+            # ProjectSerializer nests every file with its content
+            queryset = queryset.prefetch_related(
+                Prefetch('files', queryset=File.objects.select_related('blob', 'folder'))
+            )
+        return queryset
     
     def perform_create(self, serializer):
         serializer.save(owner=self.request.user)
@@ -42,31 +105,442 @@ class ProjectViewSet(viewsets.ModelViewSet):
     def compile(self, request, pk=None):
         project = self.get_object()
         
-        # Get main file
-        try:
-            main_file = File.objects.get(project=project, is_main=True)
-        except File.DoesNotExist:
+        main_file, related_files = load_project_sources(project)
+        if main_file is None:
             return Response(
                 {"error": "No main file marked for this project"}, 
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        # Get all other project files
-        other_files = File.objects.filter(project=project, is_main=False)
-        related_files = {file.name: file.content for file in other_files}
-        
-        # Compile LaTeX
-        compiler = LatexCompiler()
-        success, result = compiler.compile_latex(main_file.content, related_files)
+        try:
+            if request_flag(request, 'preview'):
+                return self.compile_preview(request, project, main_file, related_files)
+            try:
+                include_only = requested_chapters(request, main_file.content)
+            except ValueError as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            if request_flag(request, 'profile'):
+                return self.compile_profile(request, project, main_file, related_files, include_only)
+            # Compile LaTeX (served from the compile cache when nothing changed)
+            outcome = compile_sources(
+                main_file.content, related_files, build_key=project.id,
+                optimize=request_flag(request, 'optimize', getattr(settings, 'LATEX_OPTIMIZE_PDF', False)),
+                include_only=include_only, user_id=request.user.id
+            )
+        except SchedulerBusy as e:
+            return self.busy_response(e)
+        record_artifact(project.id, outcome)
         
-        if success:
-            # Return the PDF file
-            response = HttpResponse(result, content_type='application/pdf')
-            response['Content-Disposition'] = f'attachment; filename="{project.name}.pdf"'
+        if outcome.success:
+            # Stream the PDF file from the compile cache
+            response = self.pdf_response(request, project, outcome.pdf_path, outcome.pdf_key, outcome.cache_key)
+            if outcome.cache_hit:
+                response['X-Compile-Cache'] = 'hit'
+            else:
+                response['X-Compile-Cache'] = 'joined' if outcome.joined else 'miss'
+            response['X-Compile-Passes'] = str(outcome.passes)
+            if not outcome.cache_hit:
+                response['X-Compile-Warnings'] = str(
+                    sum(1 for diagnostic in outcome.diagnostics if diagnostic['level'] != 'error')
+                )
+            if include_only and not outcome.cache_hit:
+                # false when the other chapters had no .aux yet and everything was typeset
+                response['X-Compile-Partial'] = 'true' if outcome.partial else 'false'
+            if outcome.usage:
+                response['X-Compile-CPU-Seconds'] = str(outcome.usage['cpu_seconds'])
+            if outcome.artifact_id:
+                response['X-Compile-Id'] = str(outcome.artifact_id)
+            self.add_optimization_headers(response, outcome)
             return response
         else:
-            # Return the error
-            return Response({"error": result}, status=status.HTTP_400_BAD_REQUEST)
+            # Return the error, with the log's errors and warnings mapped to files
+            return Response(
+                {
+                    "error": outcome.error,
+                    "passes": outcome.passes,
+                    "diagnostics": attach_file_ids(outcome.diagnostics, project_file_ids(project)),
+                    # The full log stays downloadable from the artifacts endpoint
+                    "compile_id": outcome.artifact_id,
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
+    
+    def busy_response(self, error):
+        """429 for a compile the scheduler couldn't admit, with a Retry-After hint"""
+        response = Response(
+            {"error": str(error), "retry_after": error.retry_after},
+            status=status.HTTP_429_TOO_MANY_REQUESTS
+        )
+        response['Retry-After'] = str(error.retry_after)
+        return response
+    
+    def compile_profile(self, request, project, main_file, related_files, include_only):
+        """
+        Profiled compile: always runs pdflatex and returns a JSON timing
+        report (passes, slowest files and packages, pages, fonts) instead
+        of the PDF. The PDF is still cached for the pdf endpoint.
+        """
+        outcome = compile_sources(
+            main_file.content, related_files, build_key=project.id,
+            include_only=include_only, profile=True, user_id=request.user.id
+        )
+        record_artifact(project.id, outcome)
+        data = {
+            "compile_id": outcome.artifact_id,
+            "success": outcome.success,
+            "passes": outcome.passes,
+            "usage": outcome.usage,
+            "profile": outcome.profile,
+        }
+        if not outcome.success:
+            data["error"] = outcome.error
+            data["diagnostics"] = attach_file_ids(outcome.diagnostics, project_file_ids(project))
+            return Response(data, status=status.HTTP_400_BAD_REQUEST)
+        if not include_only:
+            data["pdf_url"] = reverse('project-pdf', kwargs={'pk': project.pk})
+        return Response(data)
+    
+    def compile_preview(self, request, project, main_file, related_files):
+        """
+        Fast preview: a single draft pass, with only the requested pages
+        rendered to PNG tiles. Takes `pages` (e.g. "1-3,7", default "1")
+        and an optional `dpi`.
+        """
+        renderer = get_preview_renderer()
+        try:
+            pages = parse_page_list(request.data.get('pages', request.query_params.get('pages', '1')))
+            dpi = int(request.data.get('dpi', request.query_params.get('dpi', renderer.dpi)))
+        except (TypeError, ValueError) as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        dpi = min(max(dpi, 36), 300)
+        
+        # A full PDF of the same sources is as good as a preview
+        pdf_key, pdf_path = lookup_compiled_pdf(main_file.content, related_files)
+        passes = 0
+        if pdf_path is None:
+            outcome = compile_sources(
+                main_file.content, related_files, build_key=project.id, preview=True, user_id=request.user.id
+            )
+            record_artifact(project.id, outcome)
+            if not outcome.success:
+                return Response(
+                    {"error": outcome.error, "passes": outcome.passes},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            pdf_key, pdf_path, passes = outcome.cache_key, outcome.pdf_path, outcome.passes
+        
+        page_count = renderer.page_count(pdf_key, pdf_path)
+        tiles = []
+        for page in pages:
+            if page_count is not None and page > page_count:
+                continue
+            if renderer.render_page(pdf_key, pdf_path, page, dpi) is None:
+                continue
+            url = reverse('project-preview-tile', kwargs={'pk': project.pk, 'pdf_key': pdf_key, 'page': page})
+            tiles.append({"page": page, "url": f"{url}?dpi={dpi}"})
+        
+        return Response({
+            "preview": pdf_key,
+            "page_count": page_count,
+            "passes": passes,
+            "dpi": dpi,
+            "pages": tiles,
+        })
+    
+    @action(detail=True, methods=['get'], url_path=r'preview/(?P<pdf_key>[0-9a-f]{64})/(?P<page>[0-9]+)')
+    def preview_tile(self, request, pk=None, pdf_key=None, page=None):
+        """PNG tile of one page of a preview (or full) PDF, rendered on first request"""
+        project = self.get_object()
+        if not self.owns_pdf_key(project, pdf_key):
+            raise NotFound("Preview page not available, please compile again")
+        renderer = get_preview_renderer()
+        try:
+            dpi = min(max(int(request.query_params.get('dpi', renderer.dpi)), 36), 300)
+        except ValueError:
+            return Response({"error": "Invalid dpi"}, status=status.HTTP_400_BAD_REQUEST)
+        
+        pdf_path = get_compile_cache().lookup(pdf_key, record_stats=False)
+        tile_path = renderer.render_page(pdf_key, pdf_path, int(page), dpi)
+        if tile_path is None:
+            raise NotFound("Preview page not available, please compile again")
+        try:
+            return file_response(request, tile_path, 'image/png', etag=renderer.tile_key(pdf_key, int(page), dpi))
+        except FileNotFoundError:
+            raise NotFound("Preview page not available, please compile again")
+    
+    def owns_pdf_key(self, project, pdf_key):
+        """
+        Whether `pdf_key` is the PDF of a compile of `project`: one recorded
+        as an artifact or job of the project, or one of its current sources
+        (served from the cache without a record)
+        """
+        if CompileArtifact.objects.filter(project=project, cache_key=pdf_key).exists():
+            return True
+        if CompileJob.objects.filter(project=project, cache_key=pdf_key).exists():
+            return True
+        return pdf_key in project_compile_keys(project)
+    
+    @action(detail=True, methods=['post'], url_path='compile-async')
+    def compile_async(self, request, pk=None):
+        """Queue a compile and return immediately with a job id to poll"""
+        project = self.get_object()
+        job = enqueue_compile(project, request.user)
+        serializer = CompileJobSerializer(job)
+        return Response(serializer.data, status=status.HTTP_202_ACCEPTED)
+    
+    def get_compile_job(self, job_id):
+        project = self.get_object()
+        if not uses_database_queue():
+            # Jobs left queued or running by a restart are picked up by the
+            # monitor, even before this process runs a compile of its own
+            start_local_monitor()
+        try:
+            return CompileJob.objects.get(id=job_id, project=project)
+        except (CompileJob.DoesNotExist, ValueError, ValidationError):
+            raise NotFound("Compile job not found")
+    
+    @action(detail=True, methods=['get'], url_path=r'jobs/(?P<job_id>[^/.]+)')
+    def compile_job(self, request, pk=None, job_id=None):
+        """Get the status of a queued compile"""
+        job = self.get_compile_job(job_id)
+        return Response(CompileJobSerializer(job).data)
+    
+    @action(detail=True, methods=['get'], url_path=r'jobs/(?P<job_id>[^/.]+)/result')
+    def compile_job_result(self, request, pk=None, job_id=None):
+        """Download the PDF of a finished compile job"""
+        job = self.get_compile_job(job_id)
+        
+        if job.status == 'failed':
+            return Response({"error": job.error}, status=status.HTTP_400_BAD_REQUEST)
+        if job.status == 'cancelled':
+            return Response(
+                {"error": job.error or "Compile job was cancelled", "status": job.status},
+                status=status.HTTP_409_CONFLICT
+            )
+        if job.status != 'succeeded':
+            return Response(
+                {"error": "Compile job has not finished", "status": job.status},
+                status=status.HTTP_409_CONFLICT
+            )
+        
+        pdf_path = get_compile_cache().lookup(job.cache_key)
+        return self.pdf_response(request, job.project, pdf_path, job.cache_key)
+    
+    @action(detail=True, methods=['get'])
+    def artifacts(self, request, pk=None):
+        """Recent compiles of this project whose outputs are still stored, newest first"""
+        project = self.get_object()
+        artifacts = CompileArtifact.objects.filter(project=project)
+        page = self.paginate_queryset(artifacts)
+        return self.get_paginated_response(CompileArtifactSerializer(page, many=True).data)
+    
+    @action(
+        detail=True, methods=['get'],
+        url_path=r'artifacts/(?P<artifact_id>[0-9a-f-]+)/(?P<kind>pdf|log|synctex)', url_name='artifact-file'
+    )
+    def artifact_file(self, request, pk=None, artifact_id=None, kind=None):
+        """Download the PDF, log or gzipped SyncTeX of a past compile without recompiling"""
+        project = self.get_object()
+        try:
+            artifact = CompileArtifact.objects.get(id=artifact_id, project=project)
+        except (CompileArtifact.DoesNotExist, ValueError, ValidationError):
+            raise NotFound("Compile not found or no longer retained")
+        digest = getattr(artifact, f'{kind}_digest')
+        if not digest:
+            raise NotFound(f"This compile produced no {kind}")
+        content_type, filename = ARTIFACT_KINDS[kind]
+        try:
+            return file_response(
+                request, get_artifact_store().path_for(digest), content_type, filename=filename, etag=digest
+            )
+        except FileNotFoundError:
+            raise NotFound(f"The {kind} of this compile is no longer stored")
+    
+    @action(detail=True, methods=['get'])
+    def pdf(self, request, pk=None):
+        """
+        Download the PDF for the project's current sources without compiling.
+        Supports Range and If-None-Match so PDF viewers can fetch pages
+        progressively and revalidate cheaply.
+        """
+        project = self.get_object()
+        main_file, related_files = load_project_sources(project)
+        if main_file is None:
+            return Response(
+                {"error": "No main file marked for this project"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        cache_key, pdf_path = lookup_compiled_pdf(main_file.content, related_files)
+        if pdf_path is None:
+            return Response(
+                {"error": "The current version of this project has not been compiled"},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        outcome = CompileOutcome(True, pdf_path=pdf_path, cache_key=cache_key, cache_hit=True)
+        if request_flag(request, 'optimize', getattr(settings, 'LATEX_OPTIMIZE_PDF', False)):
+            outcome = optimize_outcome(outcome)
+        response = self.pdf_response(request, project, outcome.pdf_path, outcome.pdf_key, outcome.cache_key)
+        self.add_optimization_headers(response, outcome)
+        return response
+    
+    def current_compile_key(self, request, project):
+        """
+        Compile cache key to look diagnostics and SyncTeX data up under: the
+        `key` query parameter (a PDF's X-Compile-Key), or the project's
+        current sources
+        """
+        key = request.query_params.get('key')
+        if key:
+            if not re.fullmatch(r'[0-9a-f]{64}', key):
+                raise ValidationError("Invalid compile key")
+            return key
+        main_file, related_files = load_project_sources(project)
+        if main_file is None:
+            raise NotFound("No main file marked for this project")
+        key, _ = lookup_compiled_pdf(main_file.content, related_files)
+        return key
+    
+    @action(detail=True, methods=['get'])
+    def diagnostics(self, request, pk=None):
+        """Errors, warnings and bad boxes of the last successful compile, mapped to File ids"""
+        project = self.get_object()
+        try:
+            key = self.current_compile_key(request, project)
+        except ValidationError as e:
+            return Response({"error": e.message}, status=status.HTTP_400_BAD_REQUEST)
+        diagnostics = get_diagnostics_store().get(key)
+        if diagnostics is None:
+            return Response(
+                {"error": "The current version of this project has not been compiled"},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        return Response({
+            "key": key,
+            "diagnostics": attach_file_ids(diagnostics, project_file_ids(project)),
+        })
+    
+    @action(detail=True, methods=['get'], url_path='synctex/forward')
+    def synctex_forward(self, request, pk=None):
+        """
+        Source to PDF: where `line` of File `file` (an id) appears in the
+        PDF, as boxes in PDF points from the top-left of each page
+        """
+        project = self.get_object()
+        try:
+            key = self.current_compile_key(request, project)
+            file_id = int(request.query_params.get('file', ''))
+            line = int(request.query_params.get('line', ''))
+        except ValueError:
+            return Response({"error": "file and line must be integers"}, status=status.HTTP_400_BAD_REQUEST)
+        except ValidationError as e:
+            return Response({"error": e.message}, status=status.HTTP_400_BAD_REQUEST)
+        
+        names = {value: name for name, value in project_file_ids(project).items()}
+        if file_id not in names:
+            raise NotFound("File not found in this project")
+        index = get_synctex_store().load(key)
+        if index is None:
+            raise NotFound("No SyncTeX data for the current version of this project")
+        return Response({"key": key, "boxes": index.forward(names[file_id], line)})
+    
+    @action(detail=True, methods=['get'], url_path='synctex/inverse')
+    def synctex_inverse(self, request, pk=None):
+        """PDF to source: the File id and line typeset at point (x, y) of `page`"""
+        project = self.get_object()
+        try:
+            key = self.current_compile_key(request, project)
+            page = int(request.query_params.get('page', ''))
+            x = float(request.query_params.get('x', ''))
+            y = float(request.query_params.get('y', ''))
+        except ValueError:
+            return Response({"error": "page, x and y must be numbers"}, status=status.HTTP_400_BAD_REQUEST)
+        except ValidationError as e:
+            return Response({"error": e.message}, status=status.HTTP_400_BAD_REQUEST)
+        
+        index = get_synctex_store().load(key)
+        if index is None:
+            raise NotFound("No SyncTeX data for the current version of this project")
+        position = index.inverse(page, x, y)
+        if position is None:
+            raise NotFound("Nothing on this page maps back to the sources")
+        position['file_id'] = project_file_ids(project).get(position['file'])
+        return Response(dict(position, key=key))
+    
+    def add_optimization_headers(self, response, outcome):
+        """Report the effect of the optimize step (sizes in bytes, time in seconds)"""
+        if outcome.optimization:
+            response['X-PDF-Original-Size'] = str(outcome.optimization['original_size'])
+            response['X-PDF-Optimized-Size'] = str(outcome.optimization['optimized_size'])
+            response['X-PDF-Optimize-Seconds'] = str(outcome.optimization['seconds'])
+            response['X-PDF-Optimize-Cache'] = 'hit' if outcome.optimization['cached'] else 'miss'
+    
+    def pdf_response(self, request, project, pdf_path, pdf_key, compile_key=None):
+        """
+        Stream a compiled PDF. Its cache key is content-addressed, so it
+        doubles as the ETag; X-Compile-Key carries the key of the compile
+        (differing from the ETag for optimized PDFs) for ?key= lookups.
+        """
+        try:
+            if pdf_path is None:
+                raise FileNotFoundError(pdf_key)
+            response = file_response(
+                request, pdf_path, 'application/pdf',
+                filename=f"{project.name}.pdf", etag=pdf_key
+            )
+            response['X-Compile-Key'] = compile_key or pdf_key
+            return response
+        except FileNotFoundError:
+            return Response(
+                {"error": "Compiled PDF is no longer cached, please compile again"},
+                status=status.HTTP_410_GONE
+            )
+    
+    @action(detail=True, methods=['get'])
+    def dependencies(self, request, pk=None):
+        """
+        The project's file reference graph: which files the main file pulls in
+        (and so which edits change the compiled PDF), and which it never uses.
+        """
+        project = self.get_object()
+        main_name, graph = project_dependency_graph(project)
+        if main_name is None:
+            return Response(
+                {"error": "No main file marked for this project"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        reachable, complete = graph.reachable(main_name)
+        return Response({
+            "main": main_name,
+            "complete": complete,
+            "reachable": sorted(reachable),
+            "unreferenced": sorted(set(graph.edges) - reachable),
+            "unresolved": graph.unresolved(main_name),
+            "files": {
+                name: {
+                    "references": graph.resolved(name),
+                    "referenced_by": sorted(graph.dependents(name)),
+                }
+                for name in sorted(graph.edges)
+            },
+        })
+    
+    @action(detail=False, methods=['get'], url_path='compile-metrics', permission_classes=[permissions.IsAdminUser])
+    def compile_metrics(self, request):
+        """
+        Compile cache statistics, pipeline counters and collaborative editing
+        stats for this worker process. Server-wide, so staff only.
+        """
+        return Response({
+            "cache": get_compile_cache().stats(),
+            "format_cache": get_format_cache().stats(),
+            "bibliography_cache": get_bibliography_cache().stats(),
+            "single_flight": compile_flight_stats(),
+            "scheduler": get_scheduler().stats(),
+            "artifacts": get_artifact_store().stats(),
+            "collab": collab_stats(),
+            "metrics": metrics.snapshot(),
+        })
         
     # change whether or not a project is a github repo
     # A github repo'd project can NOT be changed to a non-github repo'd project
@@ -82,4 +556,26 @@ class ProjectViewSet(viewsets.ModelViewSet):
         """Get project structure with files and folders but without file content"""
         project = self.get_object()
         serializer = ProjectStructureSerializer(project)
-        return Response(serializer.data)
\ No newline at end of file
+        return Response(serializer.data)
+    
+    @action(detail=True, methods=['get'])
+    def tree(self, request, pk=None):
+        """
+        Folder and file tree of a project (no file content) as id-indexed
+        maps, built from a fixed number of queries. Send the ETag back in
+        If-None-Match to get a 304 when nothing has changed.
+        """
+        # The project and its tree version come from one query, so an
+        # unchanged tree costs just that
+        project = get_object_or_404(with_tree_version(self.get_queryset()), pk=pk)
+        self.check_object_permissions(request, project)
+        version = tree_version(project)
+        
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match and quote_etag(version) in parse_etags(if_none_match):
+            response = HttpResponseNotModified()
+        else:
+            response = Response(dict(build_tree(project), version=version))
+        response['ETag'] = quote_etag(version)
+        response['Cache-Control'] = 'private, no-cache'
+        return response
\ No newline at end of file
@@ -1,7 +1,9 @@
 """
-ASGI config for your_django_project project.
+ASGI config for the CoTeX server.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+HTTP goes to Django; WebSocket connections go to the collaborative editing
+channel (apps.files.websocket).
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
@@ -11,6 +13,16 @@ import os
 
 from django.core.asgi import get_asgi_application
 
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'your_django_project.settings')
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'server.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported once Django is set up, since it loads models
+from apps.files.websocket import collab_application  # noqa: E402
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'websocket':
+        await collab_application(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)